@@ -0,0 +1,80 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the load time and the resident memory of the corpus in the columnar format
+# against json.loads of the jsonl file.  Each measure runs in its own process.
+#
+#   python benchmarks/bench_columnar.py --scale 1 10
+
+import argparse
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.corpus_fixtures import ROOT, write_scaled_corpus  # noqa: E402
+from corpus.columnar import ColumnarCorpus, jsonl_to_columnar  # noqa: E402
+
+
+def rss():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def child(mode, path):
+    before = rss()
+    start = time.perf_counter()
+    if mode == 'jsonl':
+        corpus = [json.loads(line) for line in open(path, encoding='utf-8')]
+        n_utterances = sum(len(record['dialog']) for record in corpus)
+    else:
+        corpus = ColumnarCorpus(path)
+        n_utterances = len(corpus.columns['speakers'])
+        if mode == 'columnar-text':
+            # Decodes every utterance, which pages the whole text buffer in.
+            n_utterances = sum(1 for j in range(n_utterances) if corpus.utterance(j) is not None)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"elapsed": elapsed, "rss": rss() - before, "utterances": n_utterances}))
+
+
+def measure(mode, path):
+    output = subprocess.run([sys.executable, __file__, '--child', mode, path],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in args.scale:
+            jsonl_path = write_scaled_corpus(ROOT / 'all.jsonl', scale, f"{tmp_dir}/all_x{scale}.jsonl")
+            columnar_path = f"{tmp_dir}/all_x{scale}.nccf"
+            start = time.perf_counter()
+            jsonl_to_columnar([jsonl_path], columnar_path)
+            convert_time = time.perf_counter() - start
+            print(f"scale={scale:4} jsonl {os.path.getsize(jsonl_path) / 2 ** 20:7.1f} MiB, "
+                  f"columnar {os.path.getsize(columnar_path) / 2 ** 20:7.1f} MiB (converted in {convert_time:5.2f} s)")
+            for mode, path in (('jsonl', jsonl_path), ('columnar', columnar_path), ('columnar-text', columnar_path)):
+                result = measure(mode, path)
+                print(f"{'':11}{mode:14} load {result['elapsed'] * 1000:9.1f} ms "
+                      f"rss +{result['rss'] / 2 ** 20:7.1f} MiB utterances={result['utterances']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the throughput of the merge of V1/V2/V3 and of the reconciliation with all.jsonl
+# when the files are copied 1, 10 and 100 times, to check that the cost stays linear.
+# Copies have new dialog_ids and the same texts, so they are all reported as duplicates.
+#
+#   python benchmarks/bench_merge.py --scale 1 10 100
+
+import argparse
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.corpus_fixtures import ROOT, write_scaled_corpus  # noqa: E402
+from corpus.merge import CorpusMerger  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10, 100])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in args.scale:
+            paths = [write_scaled_corpus(ROOT / f"{version}.jsonl", scale, f"{tmp_dir}/{version}.jsonl")
+                     for version in ("V1", "V2", "V3")]
+            reference = write_scaled_corpus(ROOT / "all.jsonl", scale, f"{tmp_dir}/all.jsonl")
+            merger = CorpusMerger()
+            start = time.perf_counter()
+            with open(os.devnull, 'w', encoding='utf-8') as output_file:
+                for path in paths:
+                    merger.add(path, output_file)
+            merge_time = time.perf_counter() - start
+            start = time.perf_counter()
+            reconciled = merger.reconcile(reference)
+            reconcile_time = time.perf_counter() - start
+
+            n_dialogs = sum(counts["dialogs"] for counts in merger.sources.values())
+            print(f"scale={scale:4} dialogs={n_dialogs:7} merged={merger.report()['merged']:5} "
+                  f"conflicts={len(merger.conflicts):7} | merge {n_dialogs / merge_time:7.0f} dialogs/s | "
+                  f"reconcile {reconciled['summary']['dialogs'] / reconcile_time:7.0f} dialogs/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the throughput of the tweet ranking on one core, in candidates per second, for the
+# examples of V1/V2 and for all the tweets of the news files as candidates of every query.
+# The batched scoring (TweetRanker.score, by rows or by columns) is compared with a loop over the
+# candidates, and the time spent building the query vectors is reported separately.
+#
+#   python benchmarks/bench_ranking.py --target 100000
+
+import argparse
+from pathlib import Path
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.corpus_fixtures import ROOT  # noqa: E402
+from corpus.ranking import TweetRanker, iter_examples, load_news  # noqa: E402
+
+
+def score_loop(ranker, query, candidates):
+    scores = []
+    for tweet_id in candidates:
+        row = ranker.rows[tweet_id]
+        score = 0.0
+        for i in range(ranker.indptr[row], ranker.indptr[row + 1]):
+            score += query.get(ranker.indices[i], 0.0) * ranker.weights[i]
+        scores.append(score)
+    return scores
+
+
+def measure(function, queries):
+    start = time.perf_counter()
+    candidates = 0
+    for query, choices in queries:
+        function(query, choices)
+        candidates += len(choices)
+    return candidates / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--method', choices=['bm25', 'tfidf'], default='bm25')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--target', type=float, default=100000, help="target throughput of the scoring (candidates/s)")
+    args = parser.parse_args()
+
+    tweets, titles = load_news([ROOT / "chat-server" / "used_news" / f"{version}.json" for version in ("V1", "V2")])
+    start = time.perf_counter()
+    ranker = TweetRanker(method=args.method).fit(tweets)
+    print(f"fit: {len(tweets)} tweets, {len(ranker.vocabulary)} n-grams, {len(ranker.indices)} non-zeros "
+          f"in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    examples = list(iter_examples([ROOT / "V1.jsonl", ROOT / "V2.jsonl"], tweets, titles))
+    start = time.perf_counter()
+    queries = [ranker.query_vector(texts) for _, _, texts, _, _ in examples]
+    query_time = time.perf_counter() - start
+    print(f"query vectors: {len(queries)} in {query_time * 1000:.1f} ms ({len(queries) / query_time:.0f} queries/s)")
+
+    all_tweets = list(tweets)
+    workloads = {
+        "tweet_choices": [(query, candidates) for query, (_, _, _, candidates, _) in zip(queries, examples)],
+        "all tweets": [(query, all_tweets) for query in queries],
+    }
+    for name, workload in workloads.items():
+        for query, candidates in workload:
+            expected = score_loop(ranker, query, candidates)
+            scores = ranker.score(query, candidates)
+            assert all(abs(a - b) < 1e-9 for a, b in zip(scores, expected)), name
+        workload = workload * args.repeat
+        batched = measure(ranker.score, workload)
+        loop = measure(lambda query, candidates: score_loop(ranker, query, candidates), workload)
+        status = "ok" if batched >= args.target else "below target"
+        print(f"{name:14} | batched {batched:9.0f} candidates/s | loop {loop:9.0f} candidates/s | "
+              f"x{batched / loop:.1f} | target {args.target:.0f}: {status}")
+
+    start = time.perf_counter()
+    candidates = 0
+    for _, _, texts, choices, _ in examples:
+        ranker.rank(texts, choices)
+        candidates += len(choices)
+    print(f"end to end (query vector + scoring + sort): {candidates / (time.perf_counter() - start):.0f} candidates/s")
+
+
+if __name__ == '__main__':
+    main()
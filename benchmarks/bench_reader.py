@@ -0,0 +1,91 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the full-scan throughput of the streaming reader and the latency of the lookups
+# by dialog_id and news_url through the sidecar index, against loading every line with
+# json.loads and searching the list.
+#
+#   python benchmarks/bench_reader.py --scale 1 10 100
+
+import argparse
+import json
+import os
+from pathlib import Path
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.corpus_fixtures import ROOT, write_scaled_corpus  # noqa: E402
+from corpus.reader import CorpusReader, iter_dialogs  # noqa: E402
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return statistics.median(latencies) * 1e6, latencies[int(len(latencies) * 0.99) - 1] * 1e6
+
+
+def run(path, n_lookups):
+    size = os.path.getsize(path)
+
+    start = time.perf_counter()
+    records = [json.loads(line) for line in open(path, encoding='utf-8')]
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    n_dialogs = sum(1 for _ in iter_dialogs(path))
+    scan_time = time.perf_counter() - start
+
+    rng = random.Random(0)
+    dialog_ids = [rng.choice(records)['dialog_id'] for _ in range(n_lookups)]
+    news_urls = [rng.choice(records)['news_url'] for _ in range(n_lookups)]
+
+    scan_latencies = []
+    for dialog_id in dialog_ids[:20]:
+        start = time.perf_counter()
+        next(record for record in records if record['dialog_id'] == dialog_id)
+        scan_latencies.append(time.perf_counter() - start)
+    del records
+
+    with CorpusReader(path) as reader:
+        start = time.perf_counter()
+        reader.get(dialog_ids[0])
+        index_time = time.perf_counter() - start
+        id_latencies = []
+        for dialog_id in dialog_ids:
+            start = time.perf_counter()
+            reader.get(dialog_id)
+            id_latencies.append(time.perf_counter() - start)
+        news_latencies = []
+        for news_url in news_urls[:100]:
+            start = time.perf_counter()
+            reader.find_by_news(news_url)
+            news_latencies.append(time.perf_counter() - start)
+
+    print(f"dialogs={n_dialogs:7} size={size / 2 ** 20:7.1f} MiB | "
+          f"json.loads all {load_time:6.2f} s, stream {n_dialogs / scan_time:8.0f} dialogs/s "
+          f"{size / 2 ** 20 / scan_time:5.1f} MiB/s | index build {index_time:6.2f} s")
+    print(f"{'':28} get(dialog_id) p50={percentiles(id_latencies)[0]:8.1f} us "
+          f"p99={percentiles(id_latencies)[1]:8.1f} us | list scan p50={percentiles(scan_latencies)[0]:9.1f} us | "
+          f"find_by_news p50={percentiles(news_latencies)[0] / 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', default=str(ROOT / 'all.jsonl'))
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in args.scale:
+            path = write_scaled_corpus(args.corpus, scale, f"{tmp_dir}/corpus_x{scale}.jsonl")
+            run(path, args.lookups)
+
+
+if __name__ == '__main__':
+    main()
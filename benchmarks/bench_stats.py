@@ -0,0 +1,86 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the time to compute the statistics from scratch, and to update them after
+# dialogs have been appended to the corpus files, against a loop over the json records.
+#
+#   python benchmarks/bench_stats.py --scale 100 --appended 1000
+
+import argparse
+import json
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.corpus_fixtures import ROOT, write_scaled_corpus  # noqa: E402
+from corpus.columnar import ColumnarCorpus, jsonl_to_columnar  # noqa: E402
+from corpus.stats import CorpusStats, compute, render_table_rows  # noqa: E402
+
+
+def record_loop(sources):
+    # Table columns only, one record at a time.
+    rows = []
+    for _, path in sources:
+        dialogs = utterances = presented = with_tweet = used = 0
+        for line in open(path, encoding='utf-8'):
+            record = json.loads(line)
+            dialogs += 1
+            utterances += len(record['dialog'])
+            presented += len(record['tweet_choices'])
+            n_used = sum(len(utt.get('used_tweet', ())) for utt in record['dialog'])
+            with_tweet += n_used > 0
+            used += n_used
+        rows.append((dialogs, utterances, presented, with_tweet, used))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, default=100)
+    parser.add_argument('--appended', type=int, default=1000, help="dialogs appended to V3 before the update")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sources = [(version, write_scaled_corpus(ROOT / f"{version}.jsonl", args.scale,
+                                                 f"{tmp_dir}/{version}.jsonl"))
+                   for version in ("V1", "V2", "V3")]
+        start = time.perf_counter()
+        record_loop(sources)
+        loop_time = time.perf_counter() - start
+
+        state = {}
+        start = time.perf_counter()
+        compute(sources, state)
+        full_time = time.perf_counter() - start
+
+        columnar_time = 0.0
+        for version, path in sources:
+            jsonl_to_columnar([path], f"{tmp_dir}/{version}.nccf")
+            with ColumnarCorpus(f"{tmp_dir}/{version}.nccf") as corpus:
+                start = time.perf_counter()
+                CorpusStats().add_columns(corpus.columns)
+                columnar_time += time.perf_counter() - start
+
+        lines = (ROOT / "V3.jsonl").read_text(encoding='utf-8').splitlines()
+        with open(sources[2][1], 'a', encoding='utf-8') as output_file:
+            for i in range(args.appended):
+                record = json.loads(lines[i % len(lines)])
+                record['dialog_id'] = f"{record['dialog_id']}-new{i}"
+                output_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        start = time.perf_counter()
+        results = compute(sources, state)
+        update_time = time.perf_counter() - start
+        assert render_table_rows(results) == render_table_rows(compute(sources))
+
+        n_dialogs = sum(stats.dialogs for stats in results.values())
+        print(f"dialogs={n_dialogs:7} | record loop (table only) {loop_time:6.2f} s | "
+              f"engine from scratch (table + distributions) {full_time:6.2f} s, "
+              f"from .nccf files {columnar_time:6.2f} s | update after {args.appended} appended dialogs {update_time * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the build and load time of the tweet usage index and the latency of its queries,
+# against answering the same questions with a full pass over the corpus files.
+#
+#   python benchmarks/bench_tweet_index.py --scale 1 100
+
+import argparse
+import json
+from pathlib import Path
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.corpus_fixtures import ROOT, write_scaled_corpus  # noqa: E402
+from corpus.tweet_index import TweetIndex  # noqa: E402
+
+
+def full_pass_usage_by_news(sources):
+    totals = {}
+    for _, path in sources:
+        for line in open(path, encoding='utf-8'):
+            record = json.loads(line)
+            choices = set(record['tweet_choices'])
+            used = {tweet_id for utt in record['dialog'] for tweet_id in utt.get('used_tweet', ())}
+            total = totals.setdefault(record['news_url'], [0, 0])
+            total[0] += len(choices)
+            total[1] += len(choices & used)
+    return totals
+
+
+def timed(function, *args, repeat=20):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - start)
+    return statistics.median(latencies) * 1000
+
+
+def run(sources, n_lookups):
+    start = time.perf_counter()
+    index = TweetIndex.build(sources)
+    build_time = time.perf_counter() - start
+    with tempfile.NamedTemporaryFile(suffix='.idx') as index_file:
+        index.save(index_file.name)
+        start = time.perf_counter()
+        index = TweetIndex.load(index_file.name)
+        load_time = time.perf_counter() - start
+
+    rng = random.Random(0)
+    tweet_ids = [rng.choice(index.arrays['presented_tweet']) for _ in range(n_lookups)]
+    latencies = []
+    for tweet_id in tweet_ids:
+        start = time.perf_counter()
+        index.postings(tweet_id)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    full_pass_usage_by_news(sources)
+    full_pass_time = time.perf_counter() - start
+
+    print(f"dialogs={len(index.dialog_ids):7} postings={len(index.arrays['used_tweet']):7} | "
+          f"build {build_time:6.2f} s load {load_time * 1000:7.1f} ms | "
+          f"postings p50={statistics.median(latencies) * 1e6:6.1f} us")
+    print(f"{'':33} usage_by_news {timed(index.usage_by_news):6.2f} ms "
+          f"by_version {timed(index.usage_by_version):6.2f} ms "
+          f"by_turn {timed(index.usage_by_turn):6.2f} ms | full pass by news {full_pass_time * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 100])
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in args.scale:
+            sources = [(version, write_scaled_corpus(ROOT / f"{version}.jsonl", scale,
+                                                     f"{tmp_dir}/{version}_x{scale}.jsonl"))
+                       for version in ("V1", "V2", "V3")]
+            run(sources, args.lookups)
+
+
+if __name__ == '__main__':
+    main()
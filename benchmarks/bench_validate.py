@@ -0,0 +1,45 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the throughput of the validation of all.jsonl copied 1, 10 and 100 times, with one
+# process and with a pool of processes, to check that the cost stays linear.
+#
+#   python benchmarks/bench_validate.py --scale 1 10 100 --jobs 1 4
+
+import argparse
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.corpus_fixtures import ROOT, write_scaled_corpus  # noqa: E402
+from corpus.validate import validate  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, os.cpu_count()])
+    parser.add_argument('--chunk-size', type=int, default=1 << 20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in args.scale:
+            path = write_scaled_corpus(ROOT / "all.jsonl", scale, f"{tmp_dir}/all.jsonl")
+            size = os.path.getsize(path)
+            for jobs in sorted(set(args.jobs)):
+                start = time.perf_counter()
+                report = validate([path], 6, 15, jobs, args.chunk_size)
+                elapsed = time.perf_counter() - start
+                dialogs = report["files"][path]["dialogs"]
+                print(f"scale={scale:4} dialogs={dialogs:7} jobs={jobs:2} | {elapsed:7.3f} s | "
+                      f"{dialogs / elapsed:8.0f} dialogs/s | {size / elapsed / 1e6:6.1f} MB/s | "
+                      f"issues={len(report['issues'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Larger corpora for the benchmarks, made of copies of a corpus file.
+
+from pathlib import Path
+import json
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def write_scaled_corpus(path, scale, output_path):
+    # The k-th copy of a dialog gets the dialog_id "<dialog_id>-<k>" so that the ids stay unique.
+    lines = Path(path).read_text(encoding='utf-8').splitlines()
+    with open(output_path, 'w', encoding='utf-8') as output_file:
+        for k in range(scale):
+            for line in lines:
+                if k > 0:
+                    record = json.loads(line)
+                    record['dialog_id'] = f"{record['dialog_id']}-{k}"
+                    line = json.dumps(record, ensure_ascii=False)
+                output_file.write(line + "\n")
+    return output_path
@@ -0,0 +1,118 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the startup time of BaseApp for several values of number_of_dialog, against precomputing
+# the hashes of all the URLs and writing them at startup as before, the time to check a token against
+# a lookup in the set of hashes, and the throughput of the URL generator (server/urls.py).
+#
+#   python benchmarks/bench_access_tokens.py --dialogs 1000 100000 1000000 --urls 1000000
+
+import argparse
+import base64
+import hashlib
+import io
+import logging
+from pathlib import Path
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi, BaseApp  # noqa: E402
+from server.urls import write_urls  # noqa: E402
+
+SALT = 'タスクの1番'.encode('utf-8')
+
+
+def hashing_urlsafe(s):
+    h = hashlib.sha256()
+    h.update(SALT)
+    h.update(s.encode('utf-8'))
+    return ('0' * 32 + base64.urlsafe_b64encode(h.digest()).rstrip(b'=').decode('ascii'))[-32:]
+
+
+class PrecomputedApp(BaseApp):
+    # The hashes of the URLs of the batch are computed, logged and written at startup, as BaseApp used to do.
+
+    def __init__(self, import_name, api):
+        BaseApp.__init__(self, import_name, api)
+        self.system_hash_set = set()
+        for i in range(self.cfg["number_of_dialog"]):
+            self.system_hash_set.add(hashing_urlsafe(str(i + self.cfg["experiment_id"] * 2)))
+        self.user_hash_set = set()
+        for i in range(self.cfg["number_of_dialog"]):
+            self.user_hash_set.add(hashing_urlsafe(str(i + self.cfg["experiment_id"] * 3 + 1)))
+        with open(self.cfg["urls_path"], 'w') as wf:
+            for system_hash in self.system_hash_set:
+                wf.write(f"{self.cfg['crowd_sourcing_url']}system_index_{system_hash}\n")
+                self.logger.info(f"{self.cfg['crowd_sourcing_url']}system_index_{system_hash}\n")
+            for user_hash in self.user_hash_set:
+                wf.write(f"{self.cfg['crowd_sourcing_url']}user_index_{user_hash}\n")
+                self.logger.info(f"{self.cfg['crowd_sourcing_url']}user_index_{user_hash}\n")
+
+
+def make_cfg(tmp_dir, n_dialogs):
+    return {
+        'sessions': f"{tmp_dir}/sessions",
+        'session_store': 'memory',
+        'cookiePath': '/',
+        'archives': f"{tmp_dir}/dialogs",
+        'metrics': "False",
+        'web_context': 'ChatCollectionServer',
+        'poll_interval': 120,
+        'delay_for_partner': 3000,
+        'chatroom_cleaning_interval': 3600,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'experiment_id': 0,
+        'number_of_dialog': n_dialogs,
+        'crowd_sourcing_url': 'http://localhost/',
+        'urls_path': f"{tmp_dir}/urls.txt",
+        'news_json': str(Path(__file__).resolve().parents[1] / 'used_news' / 'V1.json')
+    }
+
+
+def startup(app_class, n_dialogs):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        api = BaseApi(make_cfg(tmp_dir, n_dialogs), logging.getLogger('bench'))
+        api.chatroom_cleaner.stop()
+        start = time.perf_counter()
+        app = app_class('bench', api)
+        elapsed = time.perf_counter() - start
+        api.archive_writer.stop()
+    return elapsed, app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dialogs', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--urls', type=int, default=1000000, help="URLs per role generated")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=io.StringIO())
+
+    for n_dialogs in args.dialogs:
+        tokens, app = startup(BaseApp, n_dialogs)
+        precomputed, legacy_app = startup(PrecomputedApp, n_dialogs)
+        print(f"number_of_dialog={n_dialogs:8} | startup with tokens {tokens * 1000:8.1f} ms | "
+              f"with precomputed hashes {precomputed * 1000:8.1f} ms")
+
+    token = app.access_tokens.make("system", 12345)
+    check = min(timeit.repeat(lambda: app.access_tokens.check("system", token), number=100000, repeat=5)) / 100000
+    uid = next(iter(legacy_app.system_hash_set))
+    lookup = min(timeit.repeat(lambda: uid in legacy_app.system_hash_set, number=100000, repeat=5)) / 100000
+    print(f"token check {check * 1e6:.2f} us | set lookup {lookup * 1e6:.2f} us")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cfg = make_cfg(tmp_dir, 0)
+        with open(f"{tmp_dir}/urls.txt", 'w') as urls_file:
+            start = time.perf_counter()
+            write_urls(cfg, urls_file, 0, args.urls)
+            elapsed = time.perf_counter() - start
+    print(f"URL generation: {args.urls * 2 / elapsed:.0f} URLs/s ({args.urls * 2} URLs in {elapsed:.1f} s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the admin views as finished dialogs accumulate: the conversion of every chatroom
+# done by the admin page, a page of the JSON admin API and its counters, and the join/leave
+# latency while the admin API is requested in a loop by another thread.
+#
+#   python benchmarks/bench_admin.py --released 1000 10000 100000
+
+import argparse
+import logging
+from pathlib import Path
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi, BaseApp, convert_chatroom_to_dict  # noqa: E402
+
+
+def make_app(tmp_dir):
+    cfg = {
+        'sessions': f"{tmp_dir}/sessions",
+        'cookiePath': '/',
+        'archives': f"{tmp_dir}/dialogs",
+        'archive_formats': [],
+        'web_context': 'ChatCollectionServer',
+        'poll_interval': 120,
+        'delay_for_partner': 3000,
+        'chatroom_cleaning_interval': 3600,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'experiment_id': 0,
+        'number_of_dialog': 1,
+        'crowd_sourcing_url': 'http://localhost/',
+        'urls_path': f"{tmp_dir}/urls.txt",
+        'news_json': str(Path(__file__).resolve().parents[1] / 'used_news' / 'V1.json')
+    }
+    api = BaseApi(cfg, logging.getLogger('bench'))
+    api.chatroom_cleaner.stop()
+    return BaseApp('bench', api)
+
+
+def dialog(api, name, n_messages=12):
+    system = api.join(f"{name}s_tab", system_or_user="system")['chatroom'].id
+    api.join(f"{name}u_tab", system_or_user="user")
+    for i in range(n_messages):
+        api.post_message(f"{name}{'s' if i % 2 == 0 else 'u'}_tab", system, "message", "")
+    return system
+
+
+def finish(api, name, chatroom_id):
+    api.leave_chatroom(f"{name}s_tab", chatroom_id, "", "")
+    api.leave_chatroom(f"{name}u_tab", chatroom_id, "", "")
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def join_leave_latencies(api, n):
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        chatroom_id = api.join(f"probe{i}s_tab", system_or_user="system")['chatroom'].id
+        api.join(f"probe{i}u_tab", system_or_user="user")
+        finish(api, f"probe{i}", chatroom_id)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return statistics.median(latencies) * 1000, latencies[int(len(latencies) * 0.99) - 1] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--released', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--active', type=int, default=200)
+    args = parser.parse_args()
+
+    for n_released in args.released:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            app = make_app(tmp_dir)
+            api = app.api
+            for i in range(n_released):
+                finish(api, f"r{i}", dialog(api, f"r{i}"))
+            for i in range(args.active):
+                dialog(api, f"a{i}")
+            client = app.test_client()
+            base = f"/{app.cfg['web_context']}/admin"
+
+            def convert_all():
+                data = api.get_chatrooms()
+                [convert_chatroom_to_dict(chatroom) for chatroom in data['chatrooms'] + data['released_chatrooms']]
+
+            legacy = timed(convert_all, 3)
+            # The streamed responses are read to the end.
+            first_page = timed(lambda: client.get(f"{base}/chatrooms", query_string={'limit': 50}).get_data(), 20)
+            newest_page = timed(lambda: client.get(f"{base}/chatrooms", query_string={
+                'limit': 50, 'state': 'released', 'order': 'desc'}).get_data(), 20)
+            active_page = timed(lambda: client.get(f"{base}/chatrooms", query_string={
+                'limit': 50, 'state': 'active', 'order': 'desc'}).get_data(), 20)
+            counters = timed(lambda: client.get(f"{base}/counters").get_data(), 20)
+
+            idle = join_leave_latencies(api, 200)
+            stop = threading.Event()
+
+            def hammer():
+                while not stop.is_set():
+                    client.get(f"{base}/chatrooms", query_string={'limit': 500, 'order': 'desc'}).get_data()
+
+            thread = threading.Thread(target=hammer)
+            thread.start()
+            busy = join_leave_latencies(api, 200)
+            stop.set()
+            thread.join()
+            api.archive_writer.stop()
+
+            print(f"released={n_released:6} active={args.active} | convert all {legacy:8.1f} ms | "
+                  f"API page: first {first_page:5.2f} ms, newest released {newest_page:5.2f} ms, "
+                  f"active {active_page:5.2f} ms | counters {counters:5.2f} ms")
+            print(f"{'':23} join+leave p50/p99: idle {idle[0]:.3f}/{idle[1]:.3f} ms, "
+                  f"during admin requests {busy[0]:.3f}/{busy[1]:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the latency of the leave that releases a chatroom and the time needed to write
+# all the dialogs, with the background archive writer against the former inline archiving.
+#
+#   python benchmarks/bench_archive.py --dialogs 2000
+
+import argparse
+import logging
+from pathlib import Path
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi  # noqa: E402
+
+
+class InlineArchiveApi(BaseApi):
+    # The leave path that preceded the archive writer: the text file is written before returning.
+
+    def leave_chatroom(self, user_id, chatroom_id, news, cond):
+        with self.mutex:
+            data, released_chatroom = self._leave_chatroom(user_id, chatroom_id)
+        if released_chatroom is not None:
+            self._archive_dialog(released_chatroom, news, cond)
+        return data
+
+
+def run(api_class, formats, n_dialogs, tmp_dir):
+    cfg = {
+        'chatroom_cleaning_interval': 3600,
+        'poll_interval': 120,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'delay_for_partner': 3000,
+        'experiment_id': 1,
+        'archives': tmp_dir,
+        'archive_formats': formats,
+    }
+    api = api_class(cfg, logging.getLogger('bench'))
+    api.chatroom_cleaner.stop()
+    tweets = [[f"tweet {i}", str(1500000000000000000 + i)] for i in range(12)]
+    latencies = []
+    start = time.perf_counter()
+    for i in range(n_dialogs):
+        system_id = f"system{i}_tab"
+        user_id = f"user{i}_tab"
+        data = api.join(system_id, system_or_user="system")
+        chatroom_id = data['chatroom'].id
+        api.set_news(chatroom_id, ("title", f"https://example.com/news/{i}"), tweets)
+        api.join(user_id, system_or_user="user")
+        for j in range(12):
+            api.post_message(system_id if j % 2 == 0 else user_id, chatroom_id, f"message {j}", f"{j % 3},{j}")
+        api.leave_chatroom(user_id, chatroom_id, "", "")
+        leave_start = time.perf_counter()
+        api.leave_chatroom(system_id, chatroom_id, "", "")
+        latencies.append(time.perf_counter() - leave_start)
+    api.archive_writer.flush()
+    elapsed = time.perf_counter() - start
+    api.archive_writer.stop()
+    return latencies, elapsed
+
+
+def report(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    print(f"{name:16} leave p50={statistics.median(latencies) * 1000:8.3f} ms "
+          f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:8.3f} ms "
+          f"max={latencies[-1] * 1000:8.3f} ms | all dialogs written in {elapsed:6.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dialogs', type=int, default=2000)
+    args = parser.parse_args()
+
+    for name, api_class, formats in (("async jsonl", BaseApi, ["jsonl"]),
+                                     ("async jsonl+txt", BaseApi, ["jsonl", "txt"]),
+                                     ("inline txt", InlineArchiveApi, ["txt"])):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report(name, *run(api_class, formats, args.dialogs, tmp_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Load generator comparing the thread-per-poll Flask model with the asynchronous
+# BaseAsgiApp.  Both park one idle long poll per chatroom through the application's
+# own entry point, then post one message in every chatroom and measure how long the
+# pollers take to receive it, along with the threads and memory used while parked.
+#
+#   python benchmarks/bench_async_polling.py --rooms 1000
+
+import argparse
+import asyncio
+import json
+import logging
+from pathlib import Path
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.asgi import BaseAsgiApp  # noqa: E402
+from server.base import BaseApi, BaseApp, BaseChatroom  # noqa: E402
+
+
+def make_app(tmp_dir):
+    cfg = {
+        'sessions': f"{tmp_dir}/sessions",
+        'cookiePath': '/',
+        'archives': f"{tmp_dir}/dialogs",
+        'web_context': 'ChatCollectionServer',
+        'poll_interval': 120,
+        'delay_for_partner': 3000,
+        'chatroom_cleaning_interval': 3600,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'experiment_id': 0,
+        'number_of_dialog': 1,
+        'crowd_sourcing_url': 'http://localhost/',
+        'urls_path': f"{tmp_dir}/urls.txt",
+        'news_json': str(Path(__file__).resolve().parents[1] / 'used_news' / 'V1.json')
+    }
+    api = BaseApi(cfg, logging.getLogger('bench'))
+    return BaseApp('bench', api)
+
+
+def make_rooms(app, n_rooms):
+    # All the pollers share one session and are told apart by their tab id, as the
+    # filesystem session store only keeps a limited number of sessions.
+    with app.test_client().session_transaction() as session:
+        session['bench'] = True
+        sid = session.sid
+    rooms = []
+    for i in range(n_rooms):
+        chatroom = BaseChatroom(id_=f"room{i}", experiment_id=0)
+        chatroom.add_user(f"system{i}_tab")
+        chatroom.add_user(f"{sid}_tab{i}")
+        app.api.chatrooms[chatroom.id] = chatroom
+        app.api.chatroom_locks[chatroom.id] = chatroom.changed
+        rooms.append((chatroom, sid))
+    return rooms
+
+
+def rss_in_mb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def post_everywhere(app, rooms, sent_at):
+    for chatroom, sid in rooms:
+        sent_at[chatroom.id] = time.perf_counter()
+        app.api.post_message(chatroom.users[0], chatroom.id, "hello", "")
+
+
+def run_threads(app, rooms, settle):
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+    path = f"/{app.cfg['web_context']}/chatroom"
+    sent_at = {}
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def poller(chatroom, sid):
+        client = app.test_client()
+        client.set_cookie(cookie_name, sid)
+        response = client.get(path, query_string={
+            'clientTabId': chatroom.users[1].rsplit('_', 1)[1], 'id': chatroom.id, 'timestamp': chatroom.modified, 'cursor': 0})
+        received = time.perf_counter()
+        assert response.get_json()['latestEvents']
+        with latencies_lock:
+            latencies.append(received - sent_at[chatroom.id])
+
+    rss = rss_in_mb()
+    threads = [threading.Thread(target=poller, args=room) for room in rooms]
+    for thread in threads:
+        thread.start()
+    time.sleep(settle)
+    parked = (threading.active_count(), rss_in_mb() - rss)
+    post_everywhere(app, rooms, sent_at)
+    for thread in threads:
+        thread.join()
+    return latencies, parked
+
+
+async def run_asgi(app, rooms, settle):
+    asgi_app = BaseAsgiApp(app)
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+    path = f"/{app.cfg['web_context']}/chatroom"
+    sent_at = {}
+    latencies = []
+
+    async def poller(chatroom, sid):
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': path,
+            'query_string': f"clientTabId={chatroom.users[1].rsplit('_', 1)[1]}&id={chatroom.id}&timestamp={chatroom.modified}&cursor=0".encode(),
+            'headers': [(b'cookie', f"{cookie_name}={sid}".encode())]
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await asgi_app(scope, receive, send)
+        received = time.perf_counter()
+        assert json.loads(messages[-1]['body'])['latestEvents']
+        latencies.append(received - sent_at[chatroom.id])
+
+    rss = rss_in_mb()
+    tasks = [asyncio.create_task(poller(*room)) for room in rooms]
+    await asyncio.sleep(settle)
+    parked = (threading.active_count(), rss_in_mb() - rss)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, post_everywhere, app, rooms, sent_at)
+    await asyncio.gather(*tasks)
+    return latencies, parked
+
+
+def report(name, latencies, parked):
+    latencies = sorted(latencies)
+    threads, rss = parked
+    print(f"{name:8} polls={len(latencies):6} threads={threads:6} rss=+{rss:7.1f} MB "
+          f"p50={statistics.median(latencies) * 1000:8.1f} ms "
+          f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--settle', type=float, default=3.0, help="time given to the pollers to park (s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = make_app(tmp_dir)
+        rooms = make_rooms(app, args.rooms)
+        latencies, parked = asyncio.run(run_asgi(app, rooms, args.settle))
+        report("asgi", latencies, parked)
+
+        app = make_app(tmp_dir)
+        rooms = make_rooms(app, args.rooms)
+        latencies, parked = run_threads(app, rooms, args.settle)
+        report("threads", latencies, parked)
+
+
+if __name__ == '__main__':
+    main()
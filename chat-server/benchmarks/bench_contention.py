@@ -0,0 +1,154 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the join and post latencies while the chatroom cleaner runs and archives
+# dialogs, with the current locking and with the former global-mutex cleaner.
+#
+#   python benchmarks/bench_contention.py --rooms 5000 --duration 5
+
+import argparse
+from datetime import datetime
+import logging
+from pathlib import Path
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi  # noqa: E402
+
+
+class SlowArchiveApi(BaseApi):
+
+    archive_delay = 0.0
+
+    def _archive_dialog(self, chatroom, news, cond):
+        # Simulates a slow disk.
+        time.sleep(self.archive_delay)
+        BaseApi._archive_dialog(self, chatroom, news, cond)
+
+
+class GlobalMutexApi(SlowArchiveApi):
+    # The cleaner that preceded the fine-grained locking: it holds the global mutex
+    # and each chatroom lock in turn, and archives the dialogs with the mutex held.
+
+    def clean_inactive_users(self):
+        with self.mutex:
+            inactive_users = []
+            now = datetime.utcnow()
+            for chatroom_id in list(self.chatrooms):
+                with self.chatroom_locks[chatroom_id]:
+                    chatroom = self.chatrooms[chatroom_id]
+                    for user_id in chatroom.users:
+                        last_poll = datetime.utcfromtimestamp(chatroom.poll_requests[user_id].last_poll)
+                        delta = now - last_poll
+                        delta_in_secs = delta.seconds if delta.days >= 0 else 0
+                        if delta_in_secs > self.cfg['poll_interval'] * 3:
+                            inactive_users.append((user_id, chatroom_id))
+            for user_id, chatroom_id in inactive_users:
+                data, released_chatroom = self._leave_chatroom(user_id, chatroom_id)
+                if released_chatroom is not None:
+                    self._archive_dialog(released_chatroom, "in_active_user", "in_active_user")
+
+
+def run(api_class, n_rooms, duration, tmp_dir):
+    cfg = {
+        'chatroom_cleaning_interval': 3600,
+        'poll_interval': 120,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'delay_for_partner': 3000,
+        'experiment_id': 0,
+        'archives': tmp_dir,
+        'archive_formats': ["txt"],
+    }
+    api = api_class(cfg, logging.getLogger('bench'))
+    # The ticks are run by the benchmark itself.
+    api.chatroom_cleaner.stop()
+    rooms = []
+    for i in range(n_rooms):
+        data = api.join(f"system{i}_tab", system_or_user="system")
+        api.join(f"user{i}_tab", system_or_user="user")
+        rooms.append(data['chatroom'].id)
+    # A tenth of the users have stopped polling and will be kicked out by the cleaner.
+    stale = time.time() - 3600
+    for chatroom_id in rooms[::10]:
+        for user_id, history in api.chatrooms[chatroom_id].poll_requests.items():
+            history.last_poll = stale
+            # Deadlines only move forward: drop the current one first.
+            api.inactivity_tracker.forget(chatroom_id, user_id)
+            api.inactivity_tracker.touch(chatroom_id, user_id, now=time.monotonic() - 3600)
+
+    stop = threading.Event()
+    join_latencies = []
+    post_latencies = []
+
+    def cleaner():
+        while not stop.is_set():
+            api.clean_inactive_users()
+
+    def joiner():
+        i = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            api.join(f"newcomer{i}_tab", system_or_user="system" if i % 2 else "user")
+            join_latencies.append(time.perf_counter() - start)
+            i += 1
+            time.sleep(0.001)
+
+    def poster():
+        while not stop.is_set():
+            chatroom_id = random.choice(rooms)
+            chatroom = api.chatrooms.get(chatroom_id)
+            if chatroom is None or not chatroom.users:
+                continue
+            start = time.perf_counter()
+            api.post_message(chatroom.users[0], chatroom_id, "hello", "")
+            post_latencies.append(time.perf_counter() - start)
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=target) for target in (cleaner, joiner, poster)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    api.archive_writer.stop()
+    return join_latencies, post_latencies
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return (statistics.median(latencies) * 1000, latencies[int(len(latencies) * 0.99) - 1] * 1000,
+            latencies[-1] * 1000)
+
+
+def report(name, join_latencies, post_latencies):
+    print(f"{name:13} join n={len(join_latencies):6} p50={percentiles(join_latencies)[0]:8.2f} ms "
+          f"p99={percentiles(join_latencies)[1]:8.2f} ms max={percentiles(join_latencies)[2]:8.2f} ms | "
+          f"post n={len(post_latencies):6} p50={percentiles(post_latencies)[0]:8.2f} ms "
+          f"p99={percentiles(post_latencies)[1]:8.2f} ms max={percentiles(post_latencies)[2]:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=5000)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--archive-delay', type=float, default=0.005, help="simulated archive write time (s)")
+    args = parser.parse_args()
+
+    SlowArchiveApi.archive_delay = args.archive_delay
+    for name, api_class in (("fine-grained", SlowArchiveApi), ("global mutex", GlobalMutexApi)):
+        random.seed(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report(name, *run(api_class, args.rooms, args.duration, tmp_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the overhead of the event log on /post: threads post to their own chatroom through the
+# Flask application without the log, with the log written but not synced, and with the log synced
+# (fsync) at each commit.  Concurrent posts share the commits: the number of lines per write is
+# reported.  Then the time to recover --chatrooms live chatrooms at startup, and to compact the log
+# once their dialogs are archived.  The log is written in --dir (the fsync cost depends on the disk).
+#
+#   python benchmarks/bench_event_log.py --threads 1 8 --posts 2000 --chatrooms 2000 --dir /var/tmp
+
+import argparse
+import logging
+import os
+from pathlib import Path
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi, BaseApp  # noqa: E402
+
+
+def make_app(tmp_dir, event_log, fsync="True"):
+    cfg = {
+        'sessions': f"{tmp_dir}/sessions",
+        'session_store': 'memory',
+        'cookiePath': '/',
+        'archives': f"{tmp_dir}/dialogs",
+        'archive_formats': [],
+        'metrics': "False",
+        'event_log': f"{tmp_dir}/events.log" if event_log else None,
+        'event_log_fsync': fsync,
+        'web_context': 'ChatCollectionServer',
+        'poll_interval': 120,
+        'delay_for_partner': 3000,
+        'chatroom_cleaning_interval': 3600,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'experiment_id': 0,
+        'number_of_dialog': 1,
+        'crowd_sourcing_url': 'http://localhost/',
+        'urls_path': f"{tmp_dir}/urls.txt",
+        'news_json': str(Path(__file__).resolve().parents[1] / 'used_news' / 'V1.json')
+    }
+    api = BaseApi(cfg, logging.getLogger('bench'))
+    api.chatroom_cleaner.stop()
+    return BaseApp('bench', api)
+
+
+def post(app, tab, n_posts, latencies):
+    client = app.test_client()
+    response = client.post(f"/{app.cfg['web_context']}/join",
+                           data={'clientTabId': tab, 'systemOrUser': 'system', 'newsNum': 0})
+    assert response.status_code == 200
+    chatroom_id = next(chatroom.id for chatroom in list(app.api.chatrooms.values())
+                       if chatroom.users[0].endswith(f"_{tab}"))
+    for i in range(n_posts):
+        start = time.perf_counter()
+        response = client.post(f"/{app.cfg['web_context']}/post", data={
+            'clientTabId': tab, 'chatroom': chatroom_id, 'message': "message", 'tweets': "", 'cursor': i})
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200
+
+
+def posts(app, n_threads, n_posts):
+    latencies = []
+    threads = [threading.Thread(target=post, args=(app, f"tab{i}", n_posts, latencies)) for i in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+def recovery(tmp_dir, n_chatrooms, n_messages=12):
+    app = make_app(tmp_dir, True, "False")
+    api = app.api
+    for i in range(n_chatrooms):
+        system = f"d{i}s_tab"
+        user = f"d{i}u_tab"
+        chatroom_id = api.join(system, system_or_user="system")['chatroom'].id
+        api.join(user, system_or_user="user")
+        for k in range(n_messages):
+            api.post_message(system if k % 2 == 0 else user, chatroom_id, "message", "")
+    api.archive_writer.stop()
+    size = os.path.getsize(api.cfg['event_log'])
+
+    # A new server on the same log.
+    start = time.perf_counter()
+    api = BaseApi(app.cfg, logging.getLogger('bench'))
+    recovered = time.perf_counter() - start
+    api.chatroom_cleaner.stop()
+    assert len(api.chatrooms) == n_chatrooms
+    for chatroom in list(api.chatrooms.values()):
+        for user_id in list(chatroom.users):
+            api.leave_chatroom(user_id, chatroom.id, "", "")
+    api.archive_writer.flush()
+    start = time.perf_counter()
+    api.event_log.compact()
+    compacted = time.perf_counter() - start
+    api.archive_writer.stop()
+    return size, recovered, compacted, os.path.getsize(api.cfg['event_log'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--posts', type=int, default=2000, help="posts per thread")
+    parser.add_argument('--chatrooms', type=int, default=2000)
+    parser.add_argument('--dir', default=None, help="directory of the log")
+    args = parser.parse_args()
+
+    configurations = [("no event log", False, "False"), ("event log, no fsync", True, "False"),
+                      ("event log, fsync", True, "True")]
+    for n_threads in args.threads:
+        baseline = None
+        for name, event_log, fsync in configurations:
+            with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+                app = make_app(tmp_dir, event_log, fsync)
+                posts_per_second, p50, p99 = posts(app, n_threads, args.posts)
+                log = app.api.event_log
+                app.api.archive_writer.stop()
+            baseline = baseline or posts_per_second
+            grouping = f" | {log.appended / max(log.groups, 1):4.1f} lines per write" if log is not None else ""
+            print(f"threads={n_threads} {name:20} | {posts_per_second:6.0f} /post requests/s "
+                  f"(overhead {(1 - posts_per_second / baseline) * 100:5.1f} %) | "
+                  f"p50/p99 {p50 * 1000:.2f}/{p99 * 1000:.2f} ms{grouping}")
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        size, recovered, compacted, compacted_size = recovery(tmp_dir, args.chatrooms)
+    print(f"recovery of {args.chatrooms} live chatrooms ({size / 1e6:.1f} MB log): {recovered * 1000:.0f} ms | "
+          f"compaction once archived: {compacted * 1000:.1f} ms ({compacted_size} bytes left)")
+
+
+if __name__ == '__main__':
+    main()
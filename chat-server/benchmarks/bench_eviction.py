@@ -0,0 +1,102 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the cost of one cleaner tick, which evicts a few inactive users, as the
+# number of chatrooms grows: deadline heap against the former full scan.
+#
+#   python benchmarks/bench_eviction.py --rooms 1000 4000 16000
+
+import argparse
+from datetime import datetime
+import logging
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi  # noqa: E402
+
+
+class FullScanApi(BaseApi):
+    # The cleaner that preceded the inactivity tracker: every user of every chatroom is visited.
+
+    def clean_inactive_users(self):
+        inactive_users = []
+        now = datetime.utcnow()
+        for chatroom_id, chatroom in list(self.chatrooms.items()):
+            for user_id in chatroom.snapshot.users:
+                if chatroom.is_connected(user_id):
+                    continue
+                history = chatroom.poll_requests.get(user_id)
+                if history:
+                    last_poll = datetime.utcfromtimestamp(history.last_poll)
+                    self.logger.debug(f"now={now} type={type(now)} last_poll={last_poll} type={type(last_poll)}")
+                    delta = now - last_poll
+                    delta_in_secs = delta.seconds if delta.days >= 0 else 0
+                    self.logger.debug(
+                        f"Check user {user_id}... Last poll: {last_poll.isoformat()} Now: {now.isoformat()}"
+                        f" Delta(s): {delta_in_secs}"
+                    )
+                    if delta_in_secs > self.cfg['poll_interval'] * 3:
+                        inactive_users.append((user_id, chatroom_id))
+        for user_id, chatroom_id in inactive_users:
+            self.leave_chatroom(user_id, chatroom_id, "in_active_user", "in_active_user")
+
+
+def run(api_class, n_rooms, n_ticks, expired_per_tick, tmp_dir):
+    cfg = {
+        'chatroom_cleaning_interval': 3600,
+        'poll_interval': 120,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'delay_for_partner': 3000,
+        'experiment_id': 0,
+        'archives': tmp_dir,
+    }
+    api = api_class(cfg, logging.getLogger('bench'))
+    # The ticks are run by the benchmark itself.
+    api.chatroom_cleaner.stop()
+    rooms = []
+    for i in range(n_rooms):
+        data = api.join(f"system{i}_tab", system_or_user="system")
+        api.join(f"user{i}_tab", system_or_user="user")
+        rooms.append(data['chatroom'].id)
+
+    stale = time.time() - 3600
+    elapsed = 0.0
+    for tick in range(n_ticks):
+        for chatroom_id in rooms[tick * expired_per_tick:(tick + 1) * expired_per_tick]:
+            chatroom = api.chatrooms[chatroom_id]
+            for user_id in chatroom.users:
+                chatroom.poll_requests[user_id].last_poll = stale
+                # Deadlines only move forward: drop the current one first.
+                api.inactivity_tracker.forget(chatroom_id, user_id)
+                api.inactivity_tracker.touch(chatroom_id, user_id, now=time.monotonic() - 3600)
+        start = time.perf_counter()
+        api.clean_inactive_users()
+        elapsed += time.perf_counter() - start
+    assert len(api.chatrooms) == n_rooms - n_ticks * expired_per_tick
+    api.archive_writer.stop()
+    return elapsed / n_ticks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, nargs='+', default=[1000, 4000, 16000])
+    parser.add_argument('--ticks', type=int, default=20)
+    parser.add_argument('--expired', type=int, default=5, help="chatrooms whose users expire at each tick")
+    args = parser.parse_args()
+
+    for n_rooms in args.rooms:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            heap = run(BaseApi, n_rooms, args.ticks, args.expired, tmp_dir)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            scan = run(FullScanApi, n_rooms, args.ticks, args.expired, tmp_dir)
+        print(f"rooms={n_rooms:6} heap={heap * 1000:8.3f} ms/tick scan={scan * 1000:8.3f} ms/tick")
+
+
+if __name__ == '__main__':
+    main()
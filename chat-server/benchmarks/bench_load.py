@@ -0,0 +1,487 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Load test of the chat server: pairs of simulated clients replay the dialogs of a corpus file.
+# A system bot opens system_index_<uid> and joins with systemOrUser=system, a user bot opens
+# user_index_<uid> and joins with systemOrUser=user.  The server pairs them as it pairs the crowd
+# workers, so a system bot may end up with the user bot of another pair: the system bot brings the
+# dialog and the user bot replays the U utterances of the dialog of its chatroom.  The used_tweet of
+# an utterance is posted as the indices of the tweets in tweet_choices, as chat.js does.
+#
+# Like chat.js, each bot always has a pending long poll of /chatroom, and posts after a think time
+# (reading the last message of its partner, then typing its utterance) scaled by --time-scale.  The
+# bot that sent the last utterance leaves and its partner leaves when it sees the chatroom closed.
+#
+# Reported: pairing latency (from the join to the arrival of the partner), delivery latency of the
+# messages (from the post to the poll of the partner that returns it), request latencies, expiry
+# rate of the polls and errors.
+#
+# Without --url, a server is started on localhost in a child process, with --config and temporary
+# directories for the sessions, the dialogs, the event log and the URLs.  With --url, --urls is a
+# file of crowd sourcing URLs generated for that server (server/urls.py).  No external service is used.
+#
+#   python benchmarks/bench_load.py --pairs 50 --dialogs 200 --time-scale 0.05
+#   python benchmarks/bench_load.py --url http://127.0.0.1:8080/ChatCollectionServer \
+#       --urls /tmp/ChatCollectionServer/crowd_sourcing_urls.txt --pairs 200 --dialogs 1000
+
+import argparse
+from collections import Counter, defaultdict
+from http.client import HTTPConnection
+from http.cookies import SimpleCookie
+import itertools
+import json
+import logging
+import multiprocessing
+from pathlib import Path
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+CHAT_SERVER = Path(__file__).resolve().parents[1]
+ROOT = CHAT_SERVER.parent
+
+sys.path.insert(0, str(CHAT_SERVER))
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        "n": len(values),
+        "p50": values[len(values) // 2],
+        "p90": values[int(len(values) * 0.9)],
+        "p99": values[min(len(values) - 1, int(len(values) * 0.99))],
+        "max": values[-1]
+    }
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Latencies in seconds.
+        self.requests = defaultdict(list)
+        self.pairing = []
+        self.delivery = []
+        self.polls = 0
+        self.expired_polls = 0
+        self.errors = Counter()
+        self.outcomes = Counter()
+
+    def record_request(self, endpoint, latency):
+        with self.lock:
+            self.requests[endpoint].append(latency)
+
+    def record_error(self, endpoint, error):
+        with self.lock:
+            self.errors[f"{endpoint} {error}"] += 1
+
+    def record_poll(self, expired):
+        with self.lock:
+            self.polls += 1
+            self.expired_polls += expired
+
+    def to_dict(self, elapsed):
+        dialogs = sum(self.outcomes.values())
+        return {
+            "elapsed": elapsed,
+            "outcomes": dict(self.outcomes),
+            "completed_dialogs_per_second": self.outcomes["completed"] / elapsed if elapsed else 0,
+            "dialogs": dialogs,
+            "pairing_latency": percentiles(self.pairing),
+            "delivery_latency": percentiles(self.delivery),
+            "request_latency": {endpoint: percentiles(latencies) for endpoint, latencies in self.requests.items()},
+            "polls": self.polls,
+            "expired_polls": self.expired_polls,
+            "poll_expiry_rate": self.expired_polls / self.polls if self.polls else 0,
+            "errors": dict(self.errors)
+        }
+
+
+class Client(object):
+    # HTTP client of a browser tab: one connection per request (the development server of werkzeug
+    # closes them), with the session cookie of the tab.
+
+    def __init__(self, base_url, stats):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.path = url.path.rstrip('/')
+        self.stats = stats
+        self.cookies = {}
+
+    def request(self, endpoint, method='GET', params=None, form=None, timeout=30):
+        # Returns the body, or None if the request failed.
+        path = f"{self.path}/{endpoint}" + (f"?{urlencode(params)}" if params else "")
+        headers = {}
+        if self.cookies:
+            headers['Cookie'] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        name = endpoint.split('_index_')[0] + '_index' if '_index_' in endpoint else endpoint
+        start = time.monotonic()
+        connection = HTTPConnection(self.host, self.port, timeout=timeout)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read().decode('utf-8')
+        except Exception as e:
+            self.stats.record_error(name, type(e).__name__)
+            return None
+        finally:
+            connection.close()
+        self.stats.record_request(name, time.monotonic() - start)
+        for header in response.headers.get_all('Set-Cookie') or ():
+            cookie = SimpleCookie()
+            cookie.load(header)
+            self.cookies.update({key: morsel.value for key, morsel in cookie.items()})
+        if response.status != 200:
+            self.stats.record_error(name, response.status)
+            return None
+        return data
+
+
+class Bot(object):
+    # A tab of chat.js.  The actor (run) waits for its turns and posts; a second thread keeps a
+    # long poll pending and applies the deltas.
+
+    def __init__(self, test, role, rng, dialog=None):
+        self.test = test
+        self.role = role
+        self.speaker = "S" if role == "system" else "U"
+        self.rng = rng
+        self.dialog = dialog
+        self.client = Client(test.url, test.stats)
+        self.tab = str(next(test.tab_ids))
+        self.chatroom_id = None
+        # Notified when the chatroom changes.
+        self.changed = threading.Condition()
+        self.events = []
+        self.timestamp = ""
+        self.paired_at = None
+        self.partner_left = False
+        self.gone = False
+        self.leaving = False
+        self.posted = set()
+
+    def run(self):
+        args = self.test.args
+        page = self.client.request(f"{self.role}_index_{self.test.uids[self.role]}")
+        if page is None:
+            return "failed"
+        news_num = "-1"
+        if self.role == "system":
+            found = re.search(r"let hidden_news_num = (-?\d+)", page)
+            news_num = found.group(1) if found else "0"
+        join_start = time.monotonic()
+        page = self.client.request("join", 'POST', form={
+            'clientTabId': self.tab, 'systemOrUser': self.role, 'newsNum': news_num})
+        found = page and re.search(r"var chatroomId = '([^']+)'", page)
+        if not found:
+            return "failed"
+        self.chatroom_id = found.group(1)
+        poll_interval = int(re.search(r"var timeoutInMs = (\d+) \* 1000", page).group(1))
+        if self.dialog is not None:
+            self.test.scripts[self.chatroom_id] = self.dialog
+
+        poller = threading.Thread(target=self.poll, args=(poll_interval,), daemon=True)
+        poller.start()
+        try:
+            with self.changed:
+                self.changed.wait_for(lambda: self.paired_at is not None or self.gone, args.pair_timeout)
+                paired_at = self.paired_at
+            if paired_at is None:
+                self.leave(call=2)
+                return "unpaired"
+            with self.test.stats.lock:
+                self.test.stats.pairing.append(paired_at - join_start)
+            while True:
+                action, value = self.next_action()
+                if action == "leave":
+                    if value == "completed" and not self.partner_left:
+                        # Time to click on the stop button.
+                        time.sleep(self.think_time(0, 10))
+                    self.leave(call=1 if self.partner_left else 4)
+                    return value
+                self.post(value)
+        finally:
+            self.leaving = True
+            poller.join(poll_interval + 15)
+
+    def next_action(self):
+        # ("post", turn) on the turns of the bot, otherwise ("leave", outcome).
+        deadline = time.monotonic() + self.test.args.stall_timeout
+        with self.changed:
+            while True:
+                script = self.test.scripts.get(self.chatroom_id)
+                turns = None if script is None else script['dialog']
+                turn = len(self.events)
+                if self.gone or self.partner_left:
+                    return "leave", "completed" if turns is not None and turn >= len(turns) else "abandoned"
+                if turns is not None:
+                    if turn < len(turns) and turns[turn]['speaker'] == self.speaker and turn not in self.posted:
+                        return "post", turn
+                    if turn >= len(turns) and self.events[-1]['from'] == 'self':
+                        return "leave", "completed"
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return "leave", "stalled"
+                self.changed.wait(remaining)
+
+    def think_time(self, read, typed):
+        # Reading the partner's message then typing the utterance, in characters.
+        args = self.test.args
+        seconds = read / args.reading_speed + typed / args.typing_speed
+        return seconds * self.rng.lognormvariate(0, 0.3) * args.time_scale
+
+    def post(self, turn):
+        script = self.test.scripts[self.chatroom_id]
+        utterance = script['dialog'][turn]
+        with self.changed:
+            previous = self.events[-1]['body'] if self.events else ""
+            self.posted.add(turn)
+        time.sleep(self.think_time(len(previous), len(utterance['utterance'])))
+        choices = script['tweet_choices']
+        tweets = ",".join(str(choices.index(tweet)) for tweet in utterance.get('used_tweet') or () if tweet in choices)
+        self.test.sent[(self.chatroom_id, turn)] = time.monotonic()
+        body = self.client.request("post", 'POST', form={
+            'clientTabId': self.tab, 'chatroom': self.chatroom_id, 'message': utterance['utterance'],
+            'tweets': tweets, 'cursor': turn})
+        # If the post failed, the turn is lost and the dialog stalls.
+        data = self.decode("post", body)
+        if data:
+            self.apply(data)
+
+    def poll(self, poll_interval):
+        while not self.leaving:
+            with self.changed:
+                params = {'clientTabId': self.tab, 'id': self.chatroom_id, 'timestamp': self.timestamp,
+                          'cursor': len(self.events)}
+            body = self.client.request("chatroom", params=params, timeout=poll_interval + 10)
+            data = self.decode("chatroom", body)
+            if data is None:
+                # Polls again after an error, as chat.js does.
+                time.sleep(0.5)
+                continue
+            self.test.stats.record_poll(data.get('msg') == "poll expired")
+            if not data:
+                # The user is not in the chatroom anymore.
+                with self.changed:
+                    self.gone = True
+                    self.changed.notify_all()
+                return
+            if 'msg' not in data:
+                self.apply(data)
+
+    def decode(self, endpoint, body):
+        if body is None:
+            return None
+        try:
+            return json.loads(body)
+        except (TypeError, ValueError):
+            self.test.stats.record_error(endpoint, "invalid JSON")
+            return None
+
+    def apply(self, data):
+        now = time.monotonic()
+        with self.changed:
+            start = data['cursor'] - len(data['latestEvents'])
+            for i, event in enumerate(data['latestEvents'], start):
+                if i != len(self.events):
+                    continue
+                self.events.append(event)
+                sent = self.test.sent.get((self.chatroom_id, i))
+                if event['from'] == 'other' and sent is not None:
+                    with self.test.stats.lock:
+                        self.test.stats.delivery.append(now - sent)
+            self.timestamp = max(self.timestamp, data['modified'])
+            if len(data['users']) > 1 and self.paired_at is None:
+                self.paired_at = now
+            if self.paired_at is not None and data['closed'] and len(data['users']) < 2:
+                self.partner_left = True
+            self.changed.notify_all()
+
+    def leave(self, call):
+        self.leaving = True
+        self.client.request("leave", params={'clientTabId': self.tab, 'chatroom': self.chatroom_id, 'call': call})
+
+
+class LoadTest(object):
+
+    def __init__(self, args, url, uids, dialogs):
+        self.args = args
+        self.url = url
+        self.uids = uids
+        self.dialogs = dialogs
+        self.stats = Stats()
+        self.tab_ids = itertools.count(int(time.time() * 1000))
+        # Dialog replayed in each chatroom, by chatroom id.
+        self.scripts = {}
+        # Time of the post of each message, by (chatroom id, index of the message).
+        self.sent = {}
+        self.lock = threading.Lock()
+        self.next_dialog = iter(dialogs)
+
+    def run_pair(self, slot):
+        rng = random.Random(self.args.seed * 1000003 + slot)
+        time.sleep(slot * self.args.ramp_up / self.args.pairs)
+        while True:
+            with self.lock:
+                dialog = next(self.next_dialog, None)
+            if dialog is None:
+                return
+            system = Bot(self, "system", rng, dialog)
+            user = Bot(self, "user", random.Random(rng.random()))
+            outcomes = {}
+
+            def run(bot, delay):
+                time.sleep(delay)
+                outcomes[bot.role] = bot.run()
+
+            # The user arrives a little after the system.
+            thread = threading.Thread(target=run, args=(user, rng.uniform(0, self.args.arrival_delay)))
+            thread.start()
+            run(system, 0)
+            thread.join()
+            with self.stats.lock:
+                self.stats.outcomes[outcomes["system"]] += 1
+
+    def run(self):
+        start = time.monotonic()
+        threads = [threading.Thread(target=self.run_pair, args=(slot,)) for slot in range(self.args.pairs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - start
+
+
+def serve(cfg, ready):
+    # Child process: the chat server on an ephemeral port of localhost.
+    import os
+    from werkzeug.serving import make_server
+    from server.base import BaseApi, BaseApp
+
+    os.chdir(CHAT_SERVER)
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    api = BaseApi(cfg, logging.getLogger('chat-server'))
+    app = BaseApp('bench', api)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    ready.put(server.server_port)
+    server.serve_forever()
+
+
+def read_uids(urls_path):
+    # uids of system_index_<uid> and user_index_<uid> in the crowd sourcing URLs.
+    uids = {}
+    with open(urls_path) as urls_file:
+        for line in urls_file:
+            found = re.search(r"(system|user)_index_(\S+)", line)
+            if found:
+                uids.setdefault(found.group(1), found.group(2))
+    return uids
+
+
+def load_dialogs(path, n_dialogs, seed):
+    with open(path, encoding='utf-8') as corpus_file:
+        dialogs = [json.loads(line) for line in corpus_file if line.strip()]
+    random.Random(seed).shuffle(dialogs)
+    return list(itertools.islice(itertools.cycle(dialogs), n_dialogs))
+
+
+def print_report(report):
+    outcomes = ", ".join(f"{count} {outcome}" for outcome, count in sorted(report["outcomes"].items()))
+    print(f"dialogs: {report['dialogs']} ({outcomes}) in {report['elapsed']:.1f} s, "
+          f"{report['completed_dialogs_per_second']:.2f} completed dialogs/s")
+
+    def line(name, latencies):
+        if not latencies:
+            return f"{name:22} n=0"
+        return (f"{name:22} n={latencies['n']:6} p50={latencies['p50'] * 1000:9.1f} ms "
+                f"p90={latencies['p90'] * 1000:9.1f} ms p99={latencies['p99'] * 1000:9.1f} ms "
+                f"max={latencies['max'] * 1000:9.1f} ms")
+
+    print(line("pairing latency", report["pairing_latency"]))
+    print(line("delivery latency", report["delivery_latency"]))
+    for endpoint, latencies in sorted(report["request_latency"].items()):
+        if endpoint != "chatroom":
+            print(line(f"/{endpoint}", latencies))
+    print(f"polls: {report['polls']}, expired: {report['expired_polls']} ({report['poll_expiry_rate'] * 100:.1f} %)")
+    errors = ", ".join(f"{error}: {count}" for error, count in sorted(report["errors"].items()))
+    print(f"errors: {errors or 'none'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays dialogs of a corpus against the chat server.")
+    parser.add_argument('--corpus', default=str(ROOT / 'all.jsonl'))
+    parser.add_argument('--pairs', type=int, default=20, help="number of simultaneous pairs of bots")
+    parser.add_argument('--dialogs', type=int, default=100, help="number of dialogs to replay")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="factor of the think times (1: real time)")
+    parser.add_argument('--typing-speed', type=float, default=4.0, help="characters per second")
+    parser.add_argument('--reading-speed', type=float, default=20.0, help="characters per second")
+    parser.add_argument('--arrival-delay', type=float, default=2.0,
+                        help="the user bot of a pair arrives up to this many seconds after the system bot")
+    parser.add_argument('--ramp-up', type=float, default=5.0, help="seconds before all the pairs have started")
+    parser.add_argument('--pair-timeout', type=float, default=60.0, help="seconds waited for a partner")
+    parser.add_argument('--stall-timeout', type=float, default=300.0, help="seconds waited for the next message")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--url', help="URL of a running server (with its web context)")
+    parser.add_argument('--urls', help="crowd sourcing URLs written by the server at --url")
+    parser.add_argument('--config', default=str(CHAT_SERVER / 'config.json'), help="config of the local server")
+    parser.add_argument('--poll-interval', type=int, help="poll_interval of the local server")
+    parser.add_argument('--report', help="report file (JSON)")
+    args = parser.parse_args()
+
+    dialogs = load_dialogs(args.corpus, args.dialogs, args.seed)
+    process = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.url:
+            if not args.urls:
+                parser.error("--urls is required with --url")
+            url, urls_path = args.url, args.urls
+        else:
+            with open(args.config) as config_file:
+                cfg = json.load(config_file)
+            cfg.update({
+                'sessions': f"{tmp_dir}/sessions",
+                'archives': f"{tmp_dir}/dialogs",
+                'event_log': f"{tmp_dir}/events.log",
+                'urls_path': f"{tmp_dir}/crowd_sourcing_urls.txt",
+                'news_json': str(CHAT_SERVER / 'used_news' / 'V1.json')
+            })
+            if args.poll_interval:
+                cfg['poll_interval'] = args.poll_interval
+            from server.urls import write_urls
+            with open(cfg['urls_path'], 'w') as urls_file:
+                write_urls(cfg, urls_file, 0, 1)
+            context = multiprocessing.get_context('spawn')
+            ready = context.Queue()
+            process = context.Process(target=serve, args=(cfg, ready), daemon=True)
+            process.start()
+            url = f"http://127.0.0.1:{ready.get(timeout=60)}/{cfg['web_context']}"
+            urls_path = cfg['urls_path']
+        try:
+            test = LoadTest(args, url, read_uids(urls_path), dialogs)
+            report = test.stats.to_dict(test.run())
+        finally:
+            if process is not None:
+                process.terminate()
+                process.join()
+
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
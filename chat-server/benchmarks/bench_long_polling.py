@@ -0,0 +1,162 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Compares the event-driven long polling of BaseApi.get_chatroom with the former
+# 1-second sleep loop: message delivery latency and number of poller wake-ups.
+#
+#   python benchmarks/bench_long_polling.py --rooms 300 --messages 5
+
+import argparse
+from datetime import datetime
+import logging
+from pathlib import Path
+import random
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi, BaseChatroom  # noqa: E402
+
+
+CFG = {
+    'chatroom_cleaning_interval': 3600,
+    'poll_interval': 120,
+    'msg_count_low': 6,
+    'msg_count_high': 15,
+    'delay_for_partner': 3000,
+    'experiment_id': 0,
+}
+
+
+class CountingCondition(threading.Condition):
+
+    wakeups = 0
+    counter_lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        try:
+            return threading.Condition.wait(self, timeout)
+        finally:
+            with CountingCondition.counter_lock:
+                CountingCondition.wakeups += 1
+
+
+class CountingChatroom(BaseChatroom):
+
+    def __init__(self, *args, **kwargs):
+        BaseChatroom.__init__(self, *args, **kwargs)
+        self.changed = CountingCondition()
+
+
+class SleepLoopApi(BaseApi):
+    # The get_chatroom implementation that preceded the per-chatroom condition.
+
+    wakeups = 0
+    counter_lock = threading.Lock()
+
+    def get_chatroom(self, chatroom_id, user_id, client_timestamp):
+        request_time = datetime.utcnow()
+        while True:
+            with SleepLoopApi.counter_lock:
+                SleepLoopApi.wakeups += 1
+            if chatroom_id in self.chatroom_locks:
+                chatroom_lock = self.chatroom_locks[chatroom_id]
+                chatroom_lock.acquire()
+                try:
+                    if chatroom_id not in self.chatrooms:
+                        return None
+                    chatroom = self.chatrooms[chatroom_id]
+                    if user_id not in chatroom.users:
+                        return None
+                    chatroom.has_polled(user_id)
+                    if not client_timestamp or chatroom.has_changed(client_timestamp):
+                        return self._get_chatroom_data(chatroom_id)
+                finally:
+                    chatroom_lock.release()
+            waiting_period = (datetime.utcnow() - request_time).total_seconds()
+            if waiting_period >= self.cfg['poll_interval']:
+                return "expired"
+            time.sleep(1.0)
+
+
+def run(api_class, chatroom_class, n_rooms, n_messages, max_think_time):
+    logger = logging.getLogger('bench')
+    api = api_class(CFG, logger, chatroom_class=chatroom_class)
+
+    rooms = []
+    for i in range(n_rooms):
+        chatroom = chatroom_class(id_=f"room{i}", experiment_id=0)
+        chatroom.add_user(f"s{i}_tab")
+        chatroom.add_user(f"u{i}_tab")
+        api.chatrooms[chatroom.id] = chatroom
+        api.chatroom_locks[chatroom.id] = chatroom.changed
+        rooms.append(chatroom)
+
+    sent_at = {chatroom.id: [] for chatroom in rooms}
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def poller(chatroom):
+        user_id = chatroom.users[1]
+        seen = 0
+        timestamp = chatroom.modified
+        while seen < n_messages:
+            data = api.get_chatroom(chatroom.id, user_id, timestamp)
+            received = time.perf_counter()
+            if data is None or data == "expired":
+                continue
+            timestamp = data['chatroom'].modified
+            events = data['chatroom'].events
+            with latencies_lock:
+                for i in range(seen, len(events)):
+                    latencies.append(received - sent_at[chatroom.id][i])
+            seen = len(events)
+
+    def sender(chatroom):
+        user_id = chatroom.users[0]
+        for i in range(n_messages):
+            time.sleep(random.uniform(0, max_think_time))
+            sent_at[chatroom.id].append(time.perf_counter())
+            api.post_message(user_id, chatroom.id, f"message {i}", "")
+
+    threads = [threading.Thread(target=poller, args=(chatroom,)) for chatroom in rooms]
+    threads += [threading.Thread(target=sender, args=(chatroom,)) for chatroom in rooms]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def report(name, latencies, wakeups, elapsed):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"{name:12} messages={len(latencies):6} p50={p50:8.1f} ms p99={p99:8.1f} ms "
+          f"max={latencies[-1] * 1000:8.1f} ms wakeups={wakeups:7} elapsed={elapsed:6.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=5)
+    parser.add_argument('--think-time', type=float, default=2.0, help="maximum delay between two messages (s)")
+    args = parser.parse_args()
+
+    random.seed(0)
+    latencies, elapsed = run(BaseApi, CountingChatroom, args.rooms, args.messages, args.think_time)
+    report("condition", latencies, CountingCondition.wakeups, elapsed)
+
+    random.seed(0)
+    latencies, elapsed = run(SleepLoopApi, BaseChatroom, args.rooms, args.messages, args.think_time)
+    report("sleep loop", latencies, SleepLoopApi.wakeups, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures how long BaseApi.join holds the global mutex and the join throughput
+# with thousands of open chatrooms, against the former scan-and-sort implementation.
+#
+#   python benchmarks/bench_matchmaking.py --rooms 5000 --joins 2000
+
+import argparse
+import logging
+from pathlib import Path
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi, flatten, get_session_id  # noqa: E402
+
+
+CFG = {
+    'chatroom_cleaning_interval': 3600,
+    'poll_interval': 120,
+    'msg_count_low': 6,
+    'msg_count_high': 15,
+    'delay_for_partner': 3000,
+    'experiment_id': 0,
+    'prevent_multiple_tabs': 'True',
+}
+
+
+class TimedLock(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hold_times = []
+        self.acquired_at = None
+
+    def acquire(self):
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+
+    def release(self):
+        self.hold_times.append(time.perf_counter() - self.acquired_at)
+        self.lock.release()
+
+
+class ScanJoinApi(BaseApi):
+    # The join implementation that preceded the matchmaking queues.
+
+    def join(self, user_id, attribs=dict(), system_or_user=None):
+        self.mutex.acquire()
+        try:
+            user = self.user_class(user_id, attribs)
+            self.users[user_id] = user
+
+            all_users = flatten([chatroom.users for chatroom in self.chatrooms.values()])
+            all_sessions = set([get_session_id(user_id) for user_id in all_users])
+            if get_session_id(user_id) in all_sessions:
+                return f"Error: MultipleTabAccessForbidden for user: {user_id}."
+
+            available_chatrooms = [self.chatrooms[id_] for id_ in self.chatrooms if
+                                   len(self.chatrooms[id_].users) == 1 and
+                                   not self.chatrooms[id_].closed and
+                                   user_id not in self.chatrooms[id_].users and
+                                   user.has_matching_attribs(self.chatrooms[id_].users[0])]
+            in_chatroom = False
+            for chatroom in sorted(available_chatrooms, key=lambda x: x.created, reverse=False):
+                if bool(chatroom.initiator) != (system_or_user == "system"):
+                    with self.chatroom_locks[chatroom.id]:
+                        if system_or_user == "system":
+                            chatroom.initiator = user_id
+                        chatroom.add_user(user_id)
+                        in_chatroom = True
+                    break
+            if not in_chatroom:
+                initiator = user_id if system_or_user == "system" else None
+                chatroom = self.chatroom_class(id_=str(uuid.uuid4()), experiment_id=0, initiator=initiator)
+                if initiator is None:
+                    chatroom.add_user(user_id)
+                self.chatrooms[chatroom.id] = chatroom
+                self.chatroom_locks[chatroom.id] = chatroom.changed
+            return self._get_chatroom_data(chatroom.id)
+        finally:
+            self.mutex.release()
+
+
+def run(api_class, n_rooms, n_joins):
+    api = api_class(CFG, logging.getLogger('bench'))
+    # Dialogs in progress.
+    for i in range(n_rooms // 2):
+        api.join(f"system{i}_tab", system_or_user="system")
+        api.join(f"user{i}_tab", system_or_user="user")
+    # Chatrooms waiting for a partner.
+    for i in range(n_rooms // 2, n_rooms):
+        api.join(f"system{i}_tab", system_or_user="system")
+
+    api.mutex = TimedLock()
+    start = time.perf_counter()
+    for i in range(n_joins):
+        # Alternate between users, who fill the waiting chatrooms, and new systems.
+        if i % 2 == 0:
+            api.join(f"newuser{i}_tab", system_or_user="user")
+        else:
+            api.join(f"newsystem{i}_tab", system_or_user="system")
+    elapsed = time.perf_counter() - start
+    return api.mutex.hold_times, elapsed
+
+
+def report(name, hold_times, elapsed):
+    hold_times = sorted(hold_times)
+    print(f"{name:8} joins={len(hold_times):6} throughput={len(hold_times) / elapsed:9.0f} joins/s "
+          f"hold p50={statistics.median(hold_times) * 1e6:9.1f} us "
+          f"p99={hold_times[int(len(hold_times) * 0.99) - 1] * 1e6:9.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=5000)
+    parser.add_argument('--joins', type=int, default=2000)
+    args = parser.parse_args()
+
+    report("indexed", *run(BaseApi, args.rooms, args.joins))
+    report("scan", *run(ScanJoinApi, args.rooms, args.joins))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the overhead of the metrics: the cost of one observation and of a timed lock (every
+# acquisition timed, or a sample of them), then complete dialogs (2 joins, 12 posts, 2 leaves) through
+# BaseApi and posts through the Flask application with the metrics disabled and enabled.  The runs
+# alternate and the best one is kept.
+#
+#   python benchmarks/bench_metrics.py --dialogs 2000 --posts 5000 --runs 5 --lock-sample-rates 1 0.05
+
+import argparse
+import logging
+from pathlib import Path
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import LOCK_BUCKETS, BaseApi, BaseApp, Histogram, TimedLock  # noqa: E402
+
+
+def make_app(tmp_dir, metrics, lock_sample_rate=1.0):
+    cfg = {
+        'sessions': f"{tmp_dir}/sessions",
+        'session_store': 'memory',
+        'cookiePath': '/',
+        'archives': f"{tmp_dir}/dialogs",
+        'archive_formats': [],
+        'metrics': metrics,
+        'metrics_lock_sample_rate': lock_sample_rate,
+        'web_context': 'ChatCollectionServer',
+        'poll_interval': 120,
+        'delay_for_partner': 3000,
+        'chatroom_cleaning_interval': 3600,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'experiment_id': 0,
+        'number_of_dialog': 1,
+        'crowd_sourcing_url': 'http://localhost/',
+        'urls_path': f"{tmp_dir}/urls.txt",
+        'news_json': str(Path(__file__).resolve().parents[1] / 'used_news' / 'V1.json')
+    }
+    api = BaseApi(cfg, logging.getLogger('bench'))
+    api.chatroom_cleaner.stop()
+    return BaseApp('bench', api)
+
+
+def nanoseconds(statement, number=200000):
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number * 1e9
+
+
+def dialogs(api, n_dialogs, n_messages=12):
+    start = time.perf_counter()
+    for i in range(n_dialogs):
+        system = f"d{i}s_tab"
+        user = f"d{i}u_tab"
+        chatroom_id = api.join(system, system_or_user="system")['chatroom'].id
+        api.join(user, system_or_user="user")
+        for k in range(n_messages):
+            api.post_message(system if k % 2 == 0 else user, chatroom_id, "message", "")
+        api.leave_chatroom(system, chatroom_id, "", "")
+        api.leave_chatroom(user, chatroom_id, "", "")
+    return n_dialogs / (time.perf_counter() - start)
+
+
+def posts(app, n_posts):
+    client = app.test_client()
+    response = client.post(f"/{app.cfg['web_context']}/join",
+                           data={'clientTabId': 'tab', 'systemOrUser': 'system', 'newsNum': 0})
+    assert response.status_code == 200
+    chatroom_id = next(iter(app.api.chatrooms))
+    start = time.perf_counter()
+    for _ in range(n_posts):
+        response = client.post(f"/{app.cfg['web_context']}/post", data={
+            'clientTabId': 'tab', 'chatroom': chatroom_id, 'message': "message", 'tweets': "",
+            'cursor': len(app.api.chatrooms[chatroom_id].events)})
+        assert response.status_code == 200
+    return n_posts / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dialogs', type=int, default=2000)
+    parser.add_argument('--posts', type=int, default=5000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--lock-sample-rates', type=float, nargs='+', default=[1.0, 0.05])
+    args = parser.parse_args()
+
+    histogram = Histogram(LOCK_BUCKETS)
+    print(f"Histogram.observe: {nanoseconds(lambda: histogram.observe(0.00002)):.0f} ns")
+
+    def enter(lock):
+        with lock:
+            pass
+
+    locks = [("plain", threading.Lock(), threading.Condition())]
+    for rate in args.lock_sample_rates:
+        locks.append((f"timed ({rate:g})",
+                      TimedLock(threading.Lock(), Histogram(LOCK_BUCKETS), Histogram(LOCK_BUCKETS), rate),
+                      threading.Condition(TimedLock(threading.RLock(), Histogram(LOCK_BUCKETS),
+                                                    Histogram(LOCK_BUCKETS), rate))))
+    for name, lock, condition in locks:
+        print(f"{name:14} | lock with-block {nanoseconds(lambda: enter(lock)):5.0f} ns | "
+              f"chatroom condition with-block {nanoseconds(lambda: enter(condition)):5.0f} ns")
+
+    configurations = [("disabled", "False", 1.0)] + [(f"enabled, lock sample rate {rate:g}", "True", rate)
+                                                     for rate in args.lock_sample_rates]
+    best = {}
+    for _ in range(args.runs):
+        for name, metrics, rate in configurations:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                app = make_app(tmp_dir, metrics, rate)
+                result = (dialogs(app.api, args.dialogs), posts(app, args.posts))
+                app.api.archive_writer.stop()
+            previous = best.get(name, (0, 0))
+            best[name] = (max(previous[0], result[0]), max(previous[1], result[1]))
+
+    disabled = best["disabled"]
+    for name, _, _ in configurations:
+        dialogs_per_second, posts_per_second = best[name]
+        print(f"{name:32} | {dialogs_per_second:6.0f} dialogs/s via BaseApi "
+              f"(overhead {(1 - dialogs_per_second / disabled[0]) * 100:5.1f} %) | "
+              f"{posts_per_second:6.0f} /post requests/s "
+              f"(overhead {(1 - posts_per_second / disabled[1]) * 100:5.1f} %)")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = make_app(tmp_dir, "True")
+        dialogs(app.api, 100)
+        client = app.test_client()
+        render = min(timeit.repeat(lambda: client.get(f"/{app.cfg['web_context']}/metrics").get_data(),
+                                   number=100, repeat=5)) / 100
+        app.api.archive_writer.stop()
+    print(f"/metrics scrape: {render * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the latency of the system_index and join requests with the news catalog loaded
+# once, against re-reading and parsing news_json on every request as before.
+#
+#   python benchmarks/bench_news_catalog.py --requests 2000
+
+import argparse
+import json
+import logging
+from pathlib import Path
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi, BaseApp, NewsCatalog  # noqa: E402
+
+
+class RereadNewsCatalog(NewsCatalog):
+    # The whole file is parsed on every request, as system_index and join used to do.
+
+    def get_items(self):
+        with open(self.path) as rf:
+            entries = json.load(rf)
+        return [self._make_item(entry) for entry in entries]
+
+
+def make_app(tmp_dir, news_json, catalog_class):
+    cfg = {
+        'sessions': f"{tmp_dir}/sessions",
+        'cookiePath': '/',
+        'archives': f"{tmp_dir}/dialogs",
+        'web_context': 'ChatCollectionServer',
+        'poll_interval': 120,
+        'delay_for_partner': 3000,
+        'chatroom_cleaning_interval': 3600,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'experiment_id': 0,
+        'number_of_dialog': 1,
+        'news_num': -1,
+        'cond_num': 0,
+        'crowd_sourcing_url': 'http://localhost/',
+        'urls_path': f"{tmp_dir}/urls.txt",
+        'news_json': news_json
+    }
+    api = BaseApi(cfg, logging.getLogger('bench'))
+    api.chatroom_cleaner.stop()
+    app = BaseApp('bench', api)
+    app.root_path = str(Path(__file__).resolve().parents[1])
+    app.news_catalog = catalog_class(news_json)
+    return app
+
+
+def run(catalog_class, news_json, n_requests):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = make_app(tmp_dir, news_json, catalog_class)
+        client = app.test_client()
+        uid = app.access_tokens.make("system", 0)
+        n_news = len(app.news_catalog.get_items())
+        index_latencies = []
+        join_latencies = []
+        for i in range(n_requests):
+            start = time.perf_counter()
+            response = client.get(f"/ChatCollectionServer/system_index_{uid}")
+            index_latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200
+
+            start = time.perf_counter()
+            response = client.post("/ChatCollectionServer/join", data={
+                'clientTabId': f"tab{i}", 'systemOrUser': "system", 'newsNum': str(i % n_news)})
+            join_latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200
+        app.api.archive_writer.stop()
+    return index_latencies, join_latencies
+
+
+def report(name, index_latencies, join_latencies):
+    line = f"{name:8}"
+    for route, latencies in (("system_index", index_latencies), ("join", join_latencies)):
+        latencies = sorted(latencies)
+        line += (f" | {route} p50={statistics.median(latencies) * 1000:7.3f} ms "
+                 f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:7.3f} ms")
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--news-json', default=str(Path(__file__).resolve().parents[1] / 'used_news' / 'V1.json'))
+    args = parser.parse_args()
+
+    report("cached", *run(NewsCatalog, args.news_json, args.requests))
+    report("reread", *run(RereadNewsCatalog, args.news_json, args.requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the memory held per chatroom after a long dialog, with the poll history kept as
+# bounded counters in slotted chatrooms against the former list of every poll timestamp,
+# and the memory held by the released chatrooms over a long experiment.
+#
+#   python benchmarks/bench_room_memory.py --rooms 1000 --polls 500 --dialogs 20000
+
+import argparse
+from datetime import datetime
+import gc
+import logging
+from pathlib import Path
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi, BaseChatroom  # noqa: E402
+
+
+class LegacyChatroom(BaseChatroom):
+    # Chatroom with an instance dict that records every poll as an ISO timestamp, as before.
+
+    def __init__(self, *args, **kwargs):
+        self.poll_log = {}
+        BaseChatroom.__init__(self, *args, **kwargs)
+
+    def add_user(self, user):
+        self.poll_log[user] = [datetime.utcnow().isoformat()]
+        BaseChatroom.add_user(self, user)
+
+    def has_polled(self, user, timestamp=None):
+        polls = self.poll_log.get(user)
+        if polls is not None:
+            polls.append(datetime.utcnow().isoformat())
+        BaseChatroom.has_polled(self, user, timestamp)
+
+
+def measure_rooms(chatroom_class, n_rooms, n_polls):
+    gc.collect()
+    tracemalloc.start()
+    rooms = []
+    for i in range(n_rooms):
+        chatroom = chatroom_class(id_=f"room{i}", experiment_id=0, initiator=f"system{i}_tab")
+        chatroom.add_user(f"user{i}_tab")
+        for user in chatroom.users:
+            for _ in range(n_polls):
+                chatroom.has_polled(user)
+        rooms.append(chatroom)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / n_rooms
+
+
+def measure_released(limit, policy, n_dialogs, tmp_dir):
+    cfg = {
+        'chatroom_cleaning_interval': 3600,
+        'poll_interval': 120,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'delay_for_partner': 3000,
+        'experiment_id': 0,
+        'archives': tmp_dir,
+        'released_chatrooms_limit': limit,
+        'released_chatrooms_eviction': policy,
+    }
+    api = BaseApi(cfg, logging.getLogger('bench'))
+    api.chatroom_cleaner.stop()
+    gc.collect()
+    tracemalloc.start()
+    for i in range(n_dialogs):
+        system_id = f"system{i}_tab"
+        data = api.join(system_id, system_or_user="system")
+        chatroom_id = data['chatroom'].id
+        if i % 4 == 0:
+            # Nobody showed up.
+            api.leave_chatroom(system_id, chatroom_id, "", "")
+            continue
+        user_id = f"user{i}_tab"
+        api.join(user_id, system_or_user="user")
+        for j in range(10):
+            api.post_message(user_id if j % 2 else system_id, chatroom_id, f"message {j}", "")
+        api.leave_chatroom(system_id, chatroom_id, "", "")
+        api.leave_chatroom(user_id, chatroom_id, "", "")
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    api.archive_writer.stop()
+    empty = sum(1 for chatroom in api.released_chatrooms.values() if not chatroom.events)
+    return len(api.released_chatrooms), empty, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--polls', type=int, default=500)
+    parser.add_argument('--dialogs', type=int, default=20000)
+    parser.add_argument('--limit', type=int, default=1000)
+    args = parser.parse_args()
+
+    for name, chatroom_class in [("slotted", BaseChatroom), ("legacy", LegacyChatroom)]:
+        size = measure_rooms(chatroom_class, args.rooms, args.polls)
+        print(f"{name:12} rooms={args.rooms:6} polls/user={args.polls:5} memory/room={size / 1024:9.1f} KiB")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, limit, policy in [("unbounded", None, "oldest"),
+                                    ("oldest", args.limit, "oldest"),
+                                    ("empty_first", args.limit, "empty_first")]:
+            kept, empty, size = measure_released(limit, policy, args.dialogs, tmp_dir)
+            print(f"{name:12} dialogs={args.dialogs:6} released kept={kept:6} (empty={empty:5}) "
+                  f"memory={size / 1024 / 1024:8.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the CPU time per poll of /chatroom and the size of the responses for dialogs of --events
+# messages (tweets of the news as bodies), full snapshots (no cursor) and deltas (the last message):
+# the JSON encoded once with the events cached by user, against the former path (the chatroom.json
+# template of the framework with the events embedded as JSON, the whole then encoded as a JSON string
+# by jsonify; the template is a stand-in with the same fields).  The CPU time of the serialization
+# alone, without the request handling of Flask, is also reported.
+#
+#   python benchmarks/bench_serialization.py --events 12 30 100 --polls 2000
+
+import argparse
+import json
+import logging
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+import jinja2
+from flask import jsonify, render_template
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi, BaseApp, events_for_user, parse_cursor  # noqa: E402
+
+CHATROOM_JSON = ('{"id": "{{chatroom_id}}", "experimentId": "{{experiment_id}}", "users": {{users}}, '
+                 '"created": "{{created}}", "modified": "{{modified}}", "initiator": "{{initiator}}", '
+                 '"closed": {{closed}}, "latestEvents": {{events}}}')
+
+
+class TemplateApp(BaseApp):
+    # The responses of /chatroom as they used to be built.
+
+    def __init__(self, import_name, api):
+        BaseApp.__init__(self, import_name, api)
+        self.jinja_loader = jinja2.ChoiceLoader([jinja2.DictLoader({'chatroom.json': CHATROOM_JSON}),
+                                                 self.jinja_loader])
+
+    def get_chatroom(self, session, request):
+        params = request.args.to_dict()
+        cursor = parse_cursor(params.get('cursor'))
+        user_id = f"{session.sid}_{params.get('clientTabId')}"
+        data = self.api.get_chatroom(params.get('id'), user_id, None)
+        return jsonify(self._get_chatroom_response(user_id, data, cursor))
+
+    def _get_chatroom_response(self, user_id, data, cursor=None):
+        if cursor is not None and cursor <= len(data['chatroom'].events):
+            chatroom = data['chatroom']
+            latest_events = chatroom.events[cursor:]
+            return json.dumps({
+                'id': chatroom.id,
+                'experimentId': chatroom.experiment_id,
+                'users': chatroom.users,
+                'created': chatroom.created,
+                'modified': chatroom.modified,
+                'initiator': "self" if chatroom.initiator == user_id else "other",
+                'closed': chatroom.closed,
+                'latestEvents': [events_for_user(evt, user_id) for evt in latest_events],
+                'cursor': cursor + len(latest_events),
+                'full': cursor == 0
+            }, ensure_ascii=False)
+        formatted_events = [events_for_user(evt, user_id) for evt in data['chatroom'].events]
+        return render_template(
+            template_name_or_list='chatroom.json',
+            chatroom_id=data['chatroom'].id,
+            experiment_id=data['chatroom'].experiment_id,
+            users=json.dumps(data['chatroom'].users),
+            created=data['chatroom'].created,
+            modified=data['chatroom'].modified,
+            initiator="self" if data['chatroom'].initiator == user_id else "other",
+            closed="true" if data['chatroom'].closed else "false",
+            events=json.dumps(formatted_events, ensure_ascii=False),
+            msg_count_low=data['msg_count_low'],
+            msg_count_high=data['msg_count_high'],
+            poll_interval=data['poll_interval'],
+            delay_for_partner=data['delay_for_partner']
+        )
+
+
+def make_app(tmp_dir, app_class):
+    cfg = {
+        'sessions': f"{tmp_dir}/sessions",
+        'session_store': 'memory',
+        'cookiePath': '/',
+        'archives': f"{tmp_dir}/dialogs",
+        'archive_formats': [],
+        'metrics': "False",
+        'web_context': 'ChatCollectionServer',
+        'poll_interval': 120,
+        'delay_for_partner': 3000,
+        'chatroom_cleaning_interval': 3600,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'experiment_id': 0,
+        'number_of_dialog': 1,
+        'crowd_sourcing_url': 'http://localhost/',
+        'urls_path': f"{tmp_dir}/urls.txt",
+        'news_json': str(Path(__file__).resolve().parents[1] / 'used_news' / 'V1.json')
+    }
+    api = BaseApi(cfg, logging.getLogger('bench'))
+    api.chatroom_cleaner.stop()
+    return app_class('bench', api)
+
+
+def measure(app_class, n_events, n_polls):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = make_app(tmp_dir, app_class)
+        base = f"/{app.cfg['web_context']}"
+        clients = [app.test_client(), app.test_client()]
+        for client, role in zip(clients, ("system", "user")):
+            response = client.post(f"{base}/join", data={'clientTabId': 'tab', 'systemOrUser': role, 'newsNum': 0})
+            assert response.status_code == 200
+        chatroom = next(iter(app.api.chatrooms.values()))
+        tweets = [text for text, _ in app.news_catalog.get_items()[0].tweets]
+        for i in range(n_events):
+            app.api.post_message(chatroom.users[i % 2], chatroom.id, tweets[i % len(tweets)], "")
+        results = {}
+        for name, cursor in (("full", None), ("delta", n_events - 1)):
+            params = {'clientTabId': 'tab', 'id': chatroom.id, 'timestamp': ''}
+            if cursor is not None:
+                params['cursor'] = cursor
+            start = time.process_time()
+            for _ in range(n_polls):
+                response = clients[0].get(f"{base}/chatroom", query_string=params)
+            cpu = (time.process_time() - start) / n_polls
+            data = response.get_json()
+            if isinstance(data, str):
+                data = json.loads(data)
+            assert len(data['latestEvents']) == n_events - (cursor or 0)
+
+            # The serialization alone.
+            user_id = chatroom.users[0]
+            data = app.api.get_chatroom(chatroom.id, user_id, None)
+            with app.app_context():
+                start = time.process_time()
+                for _ in range(n_polls):
+                    if app_class is TemplateApp:
+                        app.json.dumps(app._get_chatroom_response(user_id, data, cursor))
+                    else:
+                        app._get_chatroom_response(user_id, data, cursor).encode('utf-8')
+                serialization = (time.process_time() - start) / n_polls
+            results[name] = (cpu, serialization, len(response.data))
+        app.api.archive_writer.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, nargs='+', default=[12, 30, 100])
+    parser.add_argument('--polls', type=int, default=2000)
+    args = parser.parse_args()
+
+    for n_events in args.events:
+        for name, app_class in (("template + jsonify", TemplateApp), ("direct", BaseApp)):
+            results = measure(app_class, n_events, args.polls)
+            print(f"events={n_events:4} {name:18} | " + " | ".join(
+                f"{kind} {cpu * 1e6:4.0f} us CPU/poll (serialization {serialization * 1e6:5.1f} us), {size:6} bytes"
+                for kind, (cpu, serialization, size) in results.items()))
+
+
+if __name__ == '__main__':
+    main()
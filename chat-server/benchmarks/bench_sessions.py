@@ -0,0 +1,104 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the poll requests per second served by the Flask application with each session
+# store: flask_session's filesystem store, the in-memory store and the SQLite store.  Each tab
+# has its own session and polls a chatroom that has not changed since its last poll, so the
+# requests only differ by the cost of the session.
+#
+#   python benchmarks/bench_sessions.py --tabs 500 --polls 20000 --threads 1 8
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi, BaseApp, BaseChatroom  # noqa: E402
+
+
+def make_app(tmp_dir, session_store):
+    cfg = {
+        'sessions': f"{tmp_dir}/sessions",
+        'session_store': session_store,
+        'cookiePath': '/',
+        'archives': f"{tmp_dir}/dialogs",
+        'web_context': 'ChatCollectionServer',
+        'poll_interval': 120,
+        'delay_for_partner': 3000,
+        'chatroom_cleaning_interval': 3600,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'experiment_id': 0,
+        'number_of_dialog': 1,
+        'crowd_sourcing_url': 'http://localhost/',
+        'urls_path': f"{tmp_dir}/urls.txt",
+        'news_json': str(Path(__file__).resolve().parents[1] / 'used_news' / 'V1.json')
+    }
+    api = BaseApi(cfg, logging.getLogger('bench'))
+    api.chatroom_cleaner.stop()
+    return BaseApp('bench', api)
+
+
+def make_tabs(app, n_tabs):
+    # One client (cookie jar) per tab, with its own session.
+    chatroom = BaseChatroom(id_="room", experiment_id=0)
+    app.api.chatrooms[chatroom.id] = chatroom
+    app.api.chatroom_locks[chatroom.id] = chatroom.changed
+    tabs = []
+    for i in range(n_tabs):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['tab'] = i
+            sid = session.sid
+        chatroom.add_user(f"{sid}_tab{i}")
+        tabs.append((client, f"tab{i}"))
+    return chatroom, tabs
+
+
+def poll(app, chatroom, client, tab):
+    response = client.get(f"/{app.cfg['web_context']}/chatroom", query_string={
+        'clientTabId': tab, 'id': chatroom.id, 'timestamp': '', 'cursor': len(chatroom.events)})
+    assert response.status_code == 200
+
+
+def run(app, chatroom, tabs, n_polls, n_threads):
+    def worker(k):
+        for i in range(k, n_polls, n_threads):
+            client, tab = tabs[i % len(tabs)]
+            poll(app, chatroom, client, tab)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(worker, range(n_threads)))
+    return n_polls / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tabs', type=int, default=500)
+    parser.add_argument('--polls', type=int, default=20000)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--stores', nargs='+', default=['filesystem', 'memory', 'sqlite'])
+    args = parser.parse_args()
+
+    for session_store in args.stores:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            app = make_app(tmp_dir, session_store)
+            chatroom, tabs = make_tabs(app, args.tabs)
+            writes = getattr(app.session_store, 'writes', None)
+            for n_threads in args.threads:
+                polls_per_second = run(app, chatroom, tabs, args.polls, n_threads)
+                written = "" if writes is None else f" | session writes during the polls: {app.session_store.writes - writes}"
+                print(f"{session_store:10} threads={n_threads:2} | {polls_per_second:8.0f} polls/s{written}")
+                writes = getattr(app.session_store, 'writes', None)
+            app.api.archive_writer.stop()
+
+
+if __name__ == '__main__':
+    main()
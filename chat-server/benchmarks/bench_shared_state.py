@@ -0,0 +1,199 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Measures the throughput of one experiment served by several worker processes sharing the SQLite
+# state store, against a single worker with the in-memory state.  Each worker runs its own BaseApp
+# and bots in threads: a bot joins as a system or a user through /join, long-polls /chatroom with a
+# cursor, posts its turns through /post until the dialog has --messages messages, then leaves
+# through /leave.
+# Bots are paired by the shared matchmaking queues whatever their worker, and the messages of the
+# partner reach them through the change feed of the store.
+#
+# Reported: complete dialogs and requests per second, the share of the dialogs whose two bots are
+# in different workers, and the delivery latency (from a post to the poll of the partner, which
+# reads the time of the post in the message).  Scaling with the number of workers needs as many
+# CPU cores.
+#
+#   python benchmarks/bench_shared_state.py --workers 1 2 4 --bots 8 --duration 10
+
+import argparse
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server.base import BaseApi, BaseApp  # noqa: E402
+
+
+def make_app(tmp_dir, state_store, worker):
+    cfg = {
+        'sessions': f"{tmp_dir}/sessions",
+        'session_store': 'memory',
+        'state_store': state_store,
+        'cookiePath': '/',
+        'archives': f"{tmp_dir}/dialogs",
+        'archive_fsync': "False",
+        'metrics': "False",
+        'web_context': 'ChatCollectionServer',
+        'poll_interval': 10,
+        'delay_for_partner': 3000,
+        'chatroom_cleaning_interval': 3600,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'experiment_id': 0,
+        'number_of_dialog': 1,
+        'crowd_sourcing_url': 'http://localhost/',
+        'urls_path': f"{tmp_dir}/urls{worker}.txt",
+        'news_json': str(Path(__file__).resolve().parents[1] / 'used_news' / 'V1.json')
+    }
+    api = BaseApi(cfg, logging.getLogger('bench'))
+    api.chatroom_cleaner.stop()
+    return BaseApp('bench', api)
+
+
+class Bot(object):
+
+    def __init__(self, app, name, role, n_messages, stats, stop):
+        self.app = app
+        self.client = app.test_client()
+        self.base = f"/{app.cfg['web_context']}"
+        self.name = name
+        self.role = role
+        self.n_messages = n_messages
+        self.stats = stats
+        self.stop = stop
+        self.dialogs = 0
+
+    def request(self, method, endpoint, **kwargs):
+        response = getattr(self.client, method)(f"{self.base}/{endpoint}", **kwargs)
+        assert response.status_code == 200, (endpoint, response.status_code)
+        self.stats['requests'] += 1
+        return response
+
+    def run_dialog(self):
+        tab = f"{self.name}n{self.dialogs}"
+        self.dialogs += 1
+        page = self.request('post', 'join', data={'clientTabId': tab, 'systemOrUser': self.role, 'newsNum': 0})
+        chatroom_id = re.search(r"var chatroomId = '([^']+)'", page.get_data(as_text=True)).group(1)
+        # The system sends the even messages and the user the odd ones.
+        parity = 0 if self.role == "system" else 1
+        cursor, timestamp, users, n_events = 0, '', [], 0
+        # User ids are <session id>_<tab>; the tab names start with the name of the worker.
+        partner = None
+        while n_events < self.n_messages:
+            if len(users) == 2 and n_events % 2 == parity:
+                response = self.request('post', 'post', data={
+                    'clientTabId': tab, 'chatroom': chatroom_id, 'message': repr(time.time()), 'tweets': "",
+                    'cursor': cursor})
+            else:
+                response = self.request('get', 'chatroom', query_string={
+                    'clientTabId': tab, 'id': chatroom_id, 'timestamp': timestamp, 'cursor': cursor})
+            data = response.get_json()
+            if not data:
+                return
+            if 'msg' in data:
+                # Expired poll: the partner may have stopped.
+                if self.stop.is_set():
+                    break
+                continue
+            now = time.time()
+            for evt in data['latestEvents']:
+                if evt['from'] == 'other':
+                    self.stats['delivery'].append(now - float(evt['body']))
+            cursor, timestamp, users, n_events = data['cursor'], data['modified'], data['users'], data['cursor']
+            for user in users:
+                if user.rsplit("_", 1)[1] != tab and partner is None:
+                    partner = user.rsplit("_", 1)[1]
+        if self.role == "system" and n_events == self.n_messages:
+            self.stats['dialogs'] += 1
+            if partner.split("b", 1)[0] != tab.split("b", 1)[0]:
+                self.stats['cross_worker'] += 1
+        self.request('get', 'leave', query_string={'clientTabId': tab, 'chatroom': chatroom_id})
+
+
+def worker(state_store, tmp_dir, index, n_bots, n_messages, duration, barrier, results):
+    # Child process: one worker of the experiment with its bots.
+    logging.basicConfig(level=logging.WARNING)
+    app = make_app(tmp_dir, state_store, index)
+    stats = {'requests': 0, 'dialogs': 0, 'cross_worker': 0, 'delivery': []}
+    stop = threading.Event()
+
+    def run(bot):
+        while not stop.is_set():
+            bot.run_dialog()
+
+    bots = [Bot(app, f"w{index}b{i}", "system" if i % 2 == 0 else "user", n_messages, stats, stop)
+            for i in range(n_bots)]
+    barrier.wait()
+    threads = [threading.Thread(target=run, args=(bot,)) for bot in bots]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    counted = dict(requests=stats['requests'], dialogs=stats['dialogs'], cross_worker=stats['cross_worker'],
+                   elapsed=time.perf_counter() - start)
+    stop.set()
+    # The dialogs in progress end when the bots of the other workers stop polling.
+    for thread in threads:
+        thread.join(timeout=app.cfg['poll_interval'] * 2)
+    counted['delivery'] = stats['delivery']
+    results.put(counted)
+    app.api.archive_writer.stop()
+    if app.api.state_store is not None:
+        app.api.state_watcher.stop()
+
+
+def measure(state_store, n_workers, args):
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        barrier = context.Barrier(n_workers)
+        results = context.Queue()
+        processes = [context.Process(target=worker, args=(state_store, tmp_dir, i, args.bots, args.messages,
+                                                          args.duration, barrier, results))
+                     for i in range(n_workers)]
+        for process in processes:
+            process.start()
+        counts = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    elapsed = max(count['elapsed'] for count in counts)
+    dialogs = sum(count['dialogs'] for count in counts)
+    delivery = sorted(latency for count in counts for latency in count['delivery'])
+    return {
+        'dialogs_per_second': dialogs / elapsed,
+        'requests_per_second': sum(count['requests'] for count in counts) / elapsed,
+        'cross_worker': sum(count['cross_worker'] for count in counts) / max(dialogs, 1),
+        'delivery_p50': statistics.median(delivery) if delivery else 0,
+        'delivery_p99': delivery[int(len(delivery) * 0.99) - 1] if delivery else 0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--bots', type=int, default=8, help="bots per worker")
+    parser.add_argument('--messages', type=int, default=10, help="messages per dialog")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds measured per configuration")
+    args = parser.parse_args()
+
+    print(f"CPU cores: {os.cpu_count()}")
+    configurations = [("memory", 1)] + [("sqlite", n_workers) for n_workers in args.workers]
+    for state_store, n_workers in configurations:
+        result = measure(state_store, n_workers, args)
+        print(f"{state_store:6} workers={n_workers} | {result['dialogs_per_second']:7.1f} dialogs/s | "
+              f"{result['requests_per_second']:7.0f} requests/s | "
+              f"cross-worker dialogs {result['cross_worker'] * 100:5.1f} % | "
+              f"delivery p50/p99 {result['delivery_p50'] * 1000:.1f}/{result['delivery_p99'] * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
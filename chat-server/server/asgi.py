@@ -0,0 +1,300 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Asynchronous serving mode for BaseApp.
+#
+# The long-polling /chatroom route and the /events push stream are served natively: a waiting
+# poll is a coroutine parked on a per-chatroom future instead of an OS thread, so one process
+# can hold thousands of idle connections.  The other routes (/join, /post, /leave, /admin, ...) are short requests and are
+# delegated to the Flask application on a small thread pool so that they keep the exact same
+# behavior.
+#
+# Usage, with any ASGI server:
+#   app = BaseApp(__name__, api)
+#   asgi_app = BaseAsgiApp(app)
+#   $ uvicorn my_server:asgi_app
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.cookies import SimpleCookie
+import io
+import sys
+import time
+from urllib.parse import parse_qs
+
+from .base import parse_cursor
+
+
+class BaseAsgiApp:
+
+    def __init__(self, flask_app, max_workers=32):
+        self.flask_app = flask_app
+        self.api = flask_app.api
+        self.cfg = flask_app.cfg
+        self.logger = flask_app.logger
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='asgi-wsgi')
+        self.chatroom_path = f"/{self.cfg['web_context']}/chatroom"
+        self.events_path = f"/{self.cfg['web_context']}/events"
+        self.cookie_name = flask_app.config.get('SESSION_COOKIE_NAME', 'session')
+
+        # Futures resolved on the next change of a chatroom, organized by chatroom ids, as
+        # [future, listener registered in the chatroom, number of pollers waiting for it].
+        self.room_futures = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] != 'http':
+            return
+        elif scope['path'] == self.chatroom_path and scope['method'] == 'GET':
+            await self._get_chatroom(scope, send)
+        elif scope['path'] == self.events_path and scope['method'] == 'GET':
+            await self._stream_events(scope, receive, send)
+        else:
+            await self._call_wsgi(scope, receive, send)
+
+    async def get_chatroom(self, chatroom_id, user_id, client_timestamp):
+        # Same semantics as BaseApi.get_chatroom but waits without holding a thread.
+        start = time.perf_counter()
+        data = await self.wait_for_chatroom(chatroom_id, user_id, client_timestamp, self.cfg['poll_interval'])
+        self.api.record_poll(data, time.perf_counter() - start)
+        return data
+
+    async def wait_for_chatroom(self, chatroom_id, user_id, client_timestamp, timeout, record_poll=True):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            entry = self.room_futures.get(chatroom_id)
+            if entry is not None and entry[0].done():
+                entry = None
+            if entry is None:
+                future = loop.create_future()
+                listener = partial(self._on_change, loop, chatroom_id, future)
+            data = self.api.check_chatroom(chatroom_id, user_id, client_timestamp,
+                                           listener=listener if entry is None else None, record_poll=record_poll)
+            record_poll = False
+            if data != "unchanged":
+                return data
+            if entry is None:
+                entry = [future, listener, 0]
+                self.room_futures[chatroom_id] = entry
+
+            entry[2] += 1
+            try:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return "expired"
+                # Shielded since the future is shared with the other pollers of the chatroom.
+                await asyncio.wait_for(asyncio.shield(entry[0]), remaining)
+            except asyncio.TimeoutError:
+                self.logger.debug(f"Waiting period has expired for user {user_id}")
+                return "expired"
+            finally:
+                self._remove_waiter(chatroom_id, entry)
+
+    def _remove_waiter(self, chatroom_id, entry):
+        # The future is dropped, with its listener, once its last poller has expired or disconnected.
+        entry[2] -= 1
+        if entry[2] == 0 and not entry[0].done() and self.room_futures.get(chatroom_id) is entry:
+            del self.room_futures[chatroom_id]
+            self.api.remove_change_listener(chatroom_id, entry[1])
+
+    def _on_change(self, loop, chatroom_id, future):
+        # Called from whichever thread modified the chatroom.
+        try:
+            loop.call_soon_threadsafe(self._resolve, chatroom_id, future)
+        except RuntimeError:
+            # The event loop has been closed.
+            pass
+
+    def _resolve(self, chatroom_id, future):
+        if not future.done():
+            future.set_result(None)
+        entry = self.room_futures.get(chatroom_id)
+        if entry is not None and entry[0] is future:
+            del self.room_futures[chatroom_id]
+
+    async def _get_chatroom(self, scope, send):
+        start = time.perf_counter()
+        params = self._get_params(scope)
+        if 'clientTabId' not in params or 'id' not in params or 'timestamp' not in params:
+            await self._send(send, 400, b'', 'text/html; charset=utf-8')
+            return
+        client_tab_id = params.get('clientTabId')
+        chatroom_id = params.get('id')
+        client_timestamp = params.get('timestamp')
+        cursor = parse_cursor(params.get('cursor'))
+        session_id = self._get_session_id(scope)
+        if session_id is None:
+            await self._send(send, 401, b'', 'text/html; charset=utf-8')
+            return
+        user_id = f'{session_id}_{client_tab_id}'
+        data = await self.get_chatroom(chatroom_id, user_id, client_timestamp if client_timestamp != '' else None)
+        response = "{}"
+        if data is not None:
+            if data == "expired":
+                response = '{"msg": "poll expired"}'
+            else:
+                response = self.flask_app._get_chatroom_response(user_id, data, cursor)
+        await self._send(send, 200, response.encode('utf-8'), 'application/json')
+        self.flask_app.request_latencies['get_chatroom'].observe(time.perf_counter() - start)
+
+    async def _stream_events(self, scope, receive, send):
+        # Native version of BaseApp.stream_events.
+        params = self._get_params(scope)
+        if 'clientTabId' not in params or 'id' not in params:
+            await self._send(send, 400, b'', 'text/html; charset=utf-8')
+            return
+        client_tab_id = params.get('clientTabId')
+        chatroom_id = params.get('id')
+        cursor = parse_cursor(params.get('cursor')) or 0
+        session_id = self._get_session_id(scope)
+        if session_id is None:
+            await self._send(send, 401, b'', 'text/html; charset=utf-8')
+            return
+        user_id = f'{session_id}_{client_tab_id}'
+        if not self.api.connect_push(chatroom_id, user_id):
+            await self._send(send, 404, b'', 'text/html; charset=utf-8')
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                        (b'cache-control', b'no-cache'),
+                        (b'x-accel-buffering', b'no')]
+        })
+        disconnected = asyncio.ensure_future(self._wait_for_disconnect(receive))
+        timestamp = None
+        try:
+            while True:
+                waiting = asyncio.ensure_future(self.wait_for_chatroom(
+                    chatroom_id, user_id, timestamp, self.cfg.get('push_heartbeat_interval', 15), record_poll=False))
+                await asyncio.wait({waiting, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    waiting.cancel()
+                    return
+                data = waiting.result()
+                if data is None:
+                    await send({'type': 'http.response.body', 'body': b"event: end\ndata: {}\n\n"})
+                    return
+                if data == "expired":
+                    chunk = ": keep-alive\n\n"
+                else:
+                    if cursor > len(data['chatroom'].events):
+                        cursor = 0
+                    timestamp = data['chatroom'].modified
+                    delta = self.flask_app._get_chatroom_response(user_id, data, cursor)
+                    cursor = len(data['chatroom'].events)
+                    chunk = f"data: {delta}\n\n"
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        finally:
+            disconnected.cancel()
+            self.api.disconnect_push(chatroom_id, user_id)
+
+    async def _wait_for_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    def _get_params(self, scope):
+        return {key: values[0] for key, values in
+                parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True).items()}
+
+    def _get_session_id(self, scope):
+        # The session id is the value of the session cookie, as issued by flask_session (None without it:
+        # the request is rejected, since the user cannot be in any chatroom).
+        cookie = SimpleCookie()
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookie.load(value.decode('latin-1'))
+        return cookie[self.cookie_name].value if self.cookie_name in cookie else None
+
+    async def _send(self, send, status, body, content_type):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', content_type.encode('latin-1')),
+                        (b'content-length', str(len(body)).encode('latin-1'))]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _call_wsgi(self, scope, receive, send):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        environ = self._build_environ(scope, body)
+        loop = asyncio.get_running_loop()
+        status, headers, chunks = await loop.run_in_executor(self.executor, self._run_wsgi, environ)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        })
+        await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+    def _run_wsgi(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+
+        result = self.flask_app.wsgi_app(environ, start_response)
+        try:
+            chunks = list(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], chunks
+
+    def _build_environ(self, scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ[name] = value
+            elif name == 'CONTENT_LENGTH':
+                # The body has already been read entirely.
+                continue
+            elif f'HTTP_{name}' in environ:
+                environ[f'HTTP_{name}'] += f"{'; ' if name == 'COOKIE' else ','}{value}"
+            else:
+                environ[f'HTTP_{name}'] = value
+        return environ
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -6,23 +6,40 @@
 #  Licensed under the MIT license.
 #  https://opensource.org/licenses/mit-license.php
 
-from datetime import date, datetime
-import dateutil.parser
-from flask import Flask, jsonify, render_template, request, send_from_directory, session
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from functools import partial
+from flask import (Flask, Response, g, render_template, request, send_from_directory, session,
+                   stream_with_context)
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
 from flask_session import Session
 from jinja2.exceptions import TemplateNotFound
+from jinja2.utils import htmlsafe_json_dumps
+from werkzeug.datastructures import CallbackDict
 import jinja2
+import html
 import json
 import os
 from pathlib import Path
 import pytz
+import queue
+import random
+import secrets
+import signal
+import sqlite3
 import sys
 import threading
 import time
 import traceback
 import uuid
+import atexit
 import base64
+import bisect
 import hashlib
+import heapq
+import hmac
 
 
 tz = pytz.timezone('Asia/Tokyo')
@@ -34,7 +51,12 @@ evt_type = {
 }
 
 COND = [""]
-SALT = 'タスクの1番'.encode('utf-8')
+ADMIN_PAGE_LIMIT = 500
+# Upper bounds (seconds) of the histogram buckets of the metrics.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+LOCK_BUCKETS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+# Endpoints whose latency is recorded, by Flask endpoint name.
+METRIC_ENDPOINTS = {'join': "/join", 'get_chatroom': "/chatroom", 'post_message': "/post", 'leave_chatroom': "/leave"}
 
 def flatten(l):
     return [item for sublist in l for item in sublist]
@@ -55,24 +77,77 @@ def events_for_user(evt, user_id):
         event_for_user['body'] = evt['body']
     return event_for_user
 
+def encode_events_for_user(snapshot, user_id, start=0):
+    # JSON of events_for_user for the events of the snapshot from start.  The encodings are cached in the
+    # chatroom by user: the events never change once added, so only the new ones are encoded.
+    encoded = snapshot.encoded_events.get(user_id, ())
+    if len(encoded) < len(snapshot.events):
+        encoded += tuple(json.dumps(events_for_user(evt, user_id), ensure_ascii=False)
+                         for evt in snapshot.events[len(encoded):])
+        snapshot.encoded_events[user_id] = encoded
+    return encoded[start:len(snapshot.events)]
+
+def parse_cursor(value):
+    # The cursor is the number of events the client has already received.
+    if value is None or value == '':
+        return None
+    try:
+        cursor = int(value)
+    except ValueError:
+        return None
+    return cursor if cursor >= 0 else None
+
 def utc_to_local(utc_timestamp):
     return datetime.fromisoformat(f"{utc_timestamp}+00:00").astimezone(tz).isoformat() if utc_timestamp else ""
 
 def convert_chatroom_to_dict(chatroom):
+    # Reads the published snapshot of the chatroom so that no lock is needed.
+    snapshot = chatroom.snapshot
     return {
-        "id": chatroom.id,
-        "experimentId": chatroom.experiment_id,
-        "users": chatroom.users,
-        "leaved_users": chatroom.leaved_users,
-        "created": chatroom.created,
-        "modified": chatroom.modified,
-        "initiator": chatroom.initiator,
-        "closed": chatroom.closed,
-        "events": len(chatroom.events),
-        "poll_requests": chatroom.poll_requests
+        "id": snapshot.id,
+        "experimentId": snapshot.experiment_id,
+        "users": list(snapshot.users),
+        "leaved_users": snapshot.leaved_users,
+        "created": snapshot.created,
+        "modified": snapshot.modified,
+        "initiator": snapshot.initiator,
+        "closed": snapshot.closed,
+        "events": len(snapshot.events),
+        "poll_requests": {user: history.to_dict() for user, history in list(chatroom.poll_requests.items())}
     }
 
 
+def convert_chatroom_to_record(chatroom):
+    # Dialog in the format of the published corpus (V1.jsonl, all.jsonl, ...).
+    # The initiator plays the system role; used_tweet holds the indexes of the checked tweets.
+    tweet_ids = [tweet_id for _, tweet_id in chatroom.tweets] if chatroom.tweets else []
+    dialog = []
+    for evt in chatroom.events:
+        if evt.get('type') != 'msg':
+            continue
+        if evt['from'] == chatroom.initiator:
+            used_tweet = [tweet_ids[int(i)] for i in str(evt.get('used_tweet') or '').split(',')
+                          if i.strip().isdigit() and int(i) < len(tweet_ids)]
+            dialog.append({"speaker": "S", "used_tweet": used_tweet, "utterance": evt['body']})
+        else:
+            dialog.append({"speaker": "U", "utterance": evt['body']})
+    return {
+        "news_url": chatroom.news[1] if chatroom.news else None,
+        "tweet_choices": tweet_ids,
+        "dialog_id": chatroom.id,
+        "dialog": dialog
+    }
+
+
+# Immutable state of a chatroom, published after each change.
+# Readers (polls, admin) use it without taking the chatroom lock.
+# encoded_events is the cache of encode_events_for_user, shared by the snapshots of the chatroom.
+ChatroomSnapshot = namedtuple('ChatroomSnapshot', [
+    'id', 'experiment_id', 'users', 'leaved_users', 'created', 'modified', 'initiator', 'closed', 'events', 'version',
+    'encoded_events'
+])
+
+
 class BaseUser(object):
 
     def __init__(self, id_, attribs=dict()):
@@ -93,8 +168,247 @@ class BaseUser(object):
         return True
 
 
+class PollHistory(object):
+    # Last poll (POSIX timestamp) and number of polls of a user: all that is needed
+    # by remove_user and the admin page, in constant space.
+    __slots__ = ('last_poll', 'poll_num')
+
+    def __init__(self, timestamp):
+        self.last_poll = timestamp
+        self.poll_num = 1
+
+    def add(self, timestamp):
+        # Not atomic: a concurrent poll may be missing from poll_num, which is only informative.
+        self.last_poll = timestamp
+        self.poll_num += 1
+
+    def to_dict(self):
+        return {
+            'last_poll': datetime.utcfromtimestamp(self.last_poll).isoformat(),
+            'poll_num': self.poll_num
+        }
+
+
+class ReleasedChatrooms(OrderedDict):
+    # Released chatrooms kept in memory for the admin page, in release order.
+    # Their dialogs are archived, so at most limit chatrooms are kept (all of them if limit is None).
+    # Eviction policies:
+    #   "oldest": the oldest released chatroom is evicted first.
+    #   "empty_first": chatrooms without any event (e.g. nobody showed up) are evicted first, then the oldest.
+
+    def __init__(self, limit=None, policy="oldest", on_evict=None):
+        OrderedDict.__init__(self)
+        if policy not in ("oldest", "empty_first"):
+            raise ValueError(f"Unknown eviction policy for released chatrooms: {policy}")
+        self.limit = limit
+        self.policy = policy
+        self.on_evict = on_evict
+        self.empty_ids = OrderedDict()
+
+    def __setitem__(self, chatroom_id, chatroom):
+        OrderedDict.__setitem__(self, chatroom_id, chatroom)
+        if not chatroom.events:
+            self.empty_ids[chatroom_id] = True
+        if self.limit is not None:
+            while len(self) > self.limit:
+                self.evict()
+
+    def __delitem__(self, chatroom_id):
+        OrderedDict.__delitem__(self, chatroom_id)
+        self.empty_ids.pop(chatroom_id, None)
+
+    def evict(self):
+        if self.policy == "empty_first" and self.empty_ids:
+            chatroom_id = next(iter(self.empty_ids))
+        else:
+            chatroom_id = next(iter(self))
+        del self[chatroom_id]
+        if self.on_evict is not None:
+            self.on_evict(chatroom_id)
+
+
+# Summary of a chatroom for the admin API, as of its last change.
+AdminEntry = namedtuple('AdminEntry', [
+    'seq', 'id', 'experiment_id', 'state', 'users', 'leaved_users', 'initiator', 'created', 'modified', 'released',
+    'events', 'messages', 'version'
+])
+
+
+def convert_admin_entry_to_dict(entry):
+    return {
+        "seq": entry.seq,
+        "id": entry.id,
+        "experimentId": entry.experiment_id,
+        "state": entry.state,
+        "users": list(entry.users),
+        "leaved_users": entry.leaved_users,
+        "initiator": entry.initiator,
+        "created": entry.created,
+        "modified": entry.modified,
+        "released": entry.released,
+        "events": entry.events,
+        "messages": entry.messages
+    }
+
+
+class AdminIndex(object):
+    # Summaries of the chatrooms for the admin API, in creation order, and counters updated with
+    # each change instead of being recomputed.
+    # Entries are kept in immutable pages of PAGE_SIZE entries: a change replaces one page, so a
+    # snapshot is a copy of the list of pages and the counters, taken under a short lock.  Reads
+    # then walk the snapshot without blocking join, post or leave.  Pages whose chatrooms have
+    # all been evicted are dropped (None).
+    # States: "waiting" (for a partner), "active" (paired), "released" (kept in released_chatrooms).
+
+    PAGE_SIZE = 256
+    STATES = ("waiting", "active", "released")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = []
+        # Number of entries of each page.
+        self.sizes = []
+        self.seqs = {}
+        self.next_seq = 0
+        self.counters = {
+            "chatrooms": {state: 0 for state in self.STATES},
+            "created": 0,
+            "released": 0,
+            "evicted": 0,
+            "messages": 0,
+            "experiments": {}
+        }
+
+    def update(self, chatroom, released=False):
+        # Records the current state of the chatroom (from its snapshot).
+        snapshot = chatroom.snapshot
+        state = "released" if released else "active" if snapshot.closed else "waiting"
+        with self.lock:
+            seq = self.seqs.get(snapshot.id)
+            old = None
+            if seq is None:
+                seq = self.next_seq
+                self.next_seq += 1
+                self.seqs[snapshot.id] = seq
+                if seq % self.PAGE_SIZE == 0:
+                    self.pages.append((None,) * self.PAGE_SIZE)
+                    self.sizes.append(0)
+                self.sizes[seq // self.PAGE_SIZE] += 1
+            else:
+                old = self.pages[seq // self.PAGE_SIZE][seq % self.PAGE_SIZE]
+                # Updates may come in a different order than the snapshots they read.
+                if old.state == "released" or (old.version > snapshot.version and not released):
+                    return
+            entry = AdminEntry(
+                seq=seq,
+                id=snapshot.id,
+                experiment_id=snapshot.experiment_id,
+                state=state,
+                users=snapshot.users,
+                leaved_users=snapshot.leaved_users,
+                initiator=snapshot.initiator,
+                created=snapshot.created,
+                modified=snapshot.modified,
+                released=datetime.utcnow().isoformat() if released else None,
+                events=len(snapshot.events),
+                messages=sum(1 for evt in snapshot.events if evt.get('type') == 'msg'),
+                version=snapshot.version
+            )
+            self._set(seq, entry)
+            self._count(old, entry)
+
+    def remove(self, chatroom_id):
+        # Forgets a chatroom evicted from released_chatrooms; the cumulative counters are kept.
+        with self.lock:
+            seq = self.seqs.pop(chatroom_id, None)
+            if seq is None:
+                return
+            index, slot = divmod(seq, self.PAGE_SIZE)
+            old = self.pages[index][slot]
+            self.sizes[index] -= 1
+            if self.sizes[index] == 0 and index < len(self.pages) - 1:
+                self.pages[index] = None
+            else:
+                self._set(seq, None)
+            self.counters["chatrooms"][old.state] -= 1
+            self.counters["evicted"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters, chatrooms=dict(self.counters["chatrooms"]),
+                            experiments={experiment_id: dict(counts)
+                                         for experiment_id, counts in self.counters["experiments"].items()})
+            return AdminSnapshot(tuple(self.pages), counters, self.next_seq, self.PAGE_SIZE)
+
+    def _set(self, seq, entry):
+        index, slot = divmod(seq, self.PAGE_SIZE)
+        page = list(self.pages[index])
+        page[slot] = entry
+        self.pages[index] = tuple(page)
+
+    def _count(self, old, new):
+        counters = self.counters
+        experiment = counters["experiments"].setdefault(str(new.experiment_id),
+                                                        {"created": 0, "released": 0, "messages": 0})
+        if old is None:
+            counters["created"] += 1
+            experiment["created"] += 1
+        else:
+            counters["chatrooms"][old.state] -= 1
+        counters["chatrooms"][new.state] += 1
+        if new.state == "released":
+            counters["released"] += 1
+            experiment["released"] += 1
+        messages = new.messages - (old.messages if old is not None else 0)
+        counters["messages"] += messages
+        experiment["messages"] += messages
+
+
+class AdminSnapshot(object):
+    # Immutable view of the AdminIndex.  Cursors are the seq of the last entry of the previous page.
+
+    def __init__(self, pages, counters, next_seq, page_size):
+        self.pages = pages
+        self.counters = counters
+        self.next_seq = next_seq
+        self.page_size = page_size
+
+    def query(self, cursor=None, limit=50, states=None, experiment_id=None, since=None, until=None, order="asc"):
+        # Entries matching the filters (since and until apply to the creation time, in ISO format),
+        # and the cursor of the next page (None after the last one).
+        size = self.page_size
+        if order == "asc":
+            seq, step = (0 if cursor is None else cursor + 1), 1
+        else:
+            seq, step = (self.next_seq if cursor is None else min(cursor, self.next_seq)) - 1, -1
+        entries = []
+        while 0 <= seq < self.next_seq:
+            page = self.pages[seq // size]
+            if page is None:
+                seq = (seq // size + 1) * size if step == 1 else (seq // size) * size - 1
+                continue
+            entry = page[seq % size]
+            seq += step
+            if entry is None:
+                continue
+            if states is not None and entry.state not in states:
+                continue
+            if experiment_id is not None and str(entry.experiment_id) != experiment_id:
+                continue
+            if (since is not None and entry.created < since) or (until is not None and entry.created >= until):
+                continue
+            entries.append(entry)
+            if len(entries) == limit:
+                return entries, entry.seq
+        return entries, None
+
+
 class BaseChatroom(object):
 
+    __slots__ = ('id', 'created', 'modified', 'events', 'users', 'leaved_users', 'experiment_id', 'initiator',
+                 'closed', 'poll_requests', 'push_connections', 'changed', 'version', 'change_listeners',
+                 'snapshot', 'attribs', 'news', 'tweets', 'stored_version', 'encoded_events')
+
     def __init__(self, id_=None, experiment_id=None, initiator=None, attribs=dict()):
         self.id = id_
         self.created = datetime.utcnow().isoformat()
@@ -106,6 +420,16 @@ class BaseChatroom(object):
         self.initiator = initiator
         self.closed = False
         self.poll_requests = {}
+        # Number of open push connections (server-sent events) by user.
+        self.push_connections = {}
+        # Pollers wait on this condition; it also serves as the chatroom lock.
+        self.changed = threading.Condition()
+        self.version = 0
+        # One-shot callbacks for pollers that cannot block on the condition (asyncio).
+        self.change_listeners = []
+        # JSON of the events by user, for the responses.
+        self.encoded_events = {}
+        self.snapshot = self.take_snapshot()
         if initiator is not None:
             self.add_user(initiator)
         self.attribs = attribs
@@ -113,6 +437,8 @@ class BaseChatroom(object):
         # 追記
         self.news = None
         self.tweets = None
+        # Shared state: version of the chatroom in the store as of the last load or save.
+        self.stored_version = 0
 
     def __hash__(self):
         return hash(self.id)
@@ -126,7 +452,8 @@ class BaseChatroom(object):
         self.modified = timestamp.isoformat()
         # print(f"add_event modified={self.modified}")
         if 'from' in event:
-            self.poll_requests[event['from']].append(self.modified)
+            self.has_polled(event['from'])
+        self.notify_changed()
 
     def add_user(self, user):
         timestamp = datetime.utcnow()
@@ -134,7 +461,8 @@ class BaseChatroom(object):
         self.users.append(user)
         if len(self.users) == 2:
             self.closed = True
-        self.poll_requests[user] = [self.modified]
+        self.poll_requests[user] = PollHistory(time.time())
+        self.notify_changed()
 
     def remove_user(self, user):
         if user in self.users:
@@ -144,35 +472,184 @@ class BaseChatroom(object):
                 str_user = 'U2' if 'U1' in self.leaved_users else 'U1'
             self.leaved_users[str_user] = {
                 'user_id': user,
-                'last_poll': self.poll_requests[user][-1],
-                'poll_num': len(self.poll_requests[user])
+                **self.poll_requests[user].to_dict()
             }
 
             self.users.remove(user)
             self.modified = datetime.utcnow().isoformat()
             if user in self.poll_requests:
                 del self.poll_requests[user]
+            self.push_connections.pop(user, None)
+            self.notify_changed()
+
+    def load(self, stored):
+        # Shared state: copies the state read from the store (a StoredChatroom) and publishes it if
+        # it has changed.  Must be called with self.changed held.
+        if stored.polls is not None:
+            poll_requests = {}
+            for user, (last_poll, poll_num) in stored.polls.items():
+                poll_requests[user] = PollHistory(last_poll)
+                poll_requests[user].poll_num = poll_num
+            self.poll_requests = poll_requests
+        if stored.version == self.stored_version:
+            return
+        self.experiment_id = stored.experiment_id
+        self.created = stored.created
+        self.modified = stored.modified
+        self.initiator = stored.initiator
+        self.closed = stored.closed
+        self.users = list(stored.users)
+        if stored.polls is None:
+            self.poll_requests = {user: self.poll_requests.get(user) or PollHistory(time.time()) for user in self.users}
+        self.leaved_users = stored.leaved_users
+        self.attribs = stored.attribs
+        self.news = tuple(stored.news) if stored.news is not None else None
+        self.tweets = stored.tweets
+        # stored.events only holds the events that were not known yet.
+        self.events.extend(stored.events)
+        self.stored_version = stored.version
+        self.notify_changed()
+
+    def notify_changed(self):
+        # Publish the new state and wake up every poller waiting on this chatroom.
+        with self.changed:
+            self.version += 1
+            self.snapshot = self.take_snapshot()
+            self.changed.notify_all()
+            listeners, self.change_listeners = self.change_listeners, []
+            for listener in listeners:
+                listener()
+
+    def take_snapshot(self):
+        return ChatroomSnapshot(
+            id=self.id,
+            experiment_id=self.experiment_id,
+            users=tuple(self.users),
+            leaved_users=dict(self.leaved_users),
+            created=self.created,
+            modified=self.modified,
+            initiator=self.initiator,
+            closed=self.closed,
+            events=tuple(self.events),
+            version=self.version,
+            encoded_events=self.encoded_events
+        )
+
+    def add_change_listener(self, listener):
+        # The listener is called once, with self.changed held, on the next change.
+        with self.changed:
+            self.change_listeners.append(listener)
+
+    def remove_change_listener(self, listener):
+        with self.changed:
+            if listener in self.change_listeners:
+                self.change_listeners.remove(listener)
+
+    def wait_for_change(self, version, timeout):
+        # Must be called with self.changed held.
+        # Returns False if the timeout elapsed without any change.
+        return self.changed.wait_for(lambda: self.version != version, timeout=timeout)
 
     def has_changed(self, timestamp):
         return self.modified > timestamp
 
-    def has_polled(self, user, timestamp):
-        self.poll_requests[user].append(timestamp)
+    def has_polled(self, user, timestamp=None):
+        # May be called without the chatroom lock.
+        history = self.poll_requests.get(user)
+        if history is not None:
+            history.add(time.time() if timestamp is None else timestamp)
+
+    def connect(self, user):
+        self.push_connections[user] = self.push_connections.get(user, 0) + 1
+
+    def disconnect(self, user):
+        # The inactivity delay starts when the last push connection of the user is closed.
+        self.push_connections[user] -= 1
+        if self.push_connections[user] == 0:
+            del self.push_connections[user]
+            self.has_polled(user)
+
+    def is_connected(self, user):
+        return user in self.push_connections
+
+
+class InactivityTracker(object):
+    # Deadline-ordered index of the users' inactivity deadlines (monotonic time).
+    # Recording an activity only updates the deadline of the user: each user has a single entry
+    # in the heap, which is rescheduled lazily when it comes out before the latest deadline.
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # Notified when the earliest deadline moves earlier, e.g. when the heap was empty.
+        self.rescheduled = threading.Condition(self.lock)
+        self.heap = []
+        self.deadlines = {}
+
+    def touch(self, chatroom_id, user_id, now=None):
+        deadline = (time.monotonic() if now is None else now) + self.timeout
+        key = (chatroom_id, user_id)
+        with self.lock:
+            if key not in self.deadlines:
+                heapq.heappush(self.heap, (deadline, key))
+                if self.heap[0][1] == key:
+                    self.rescheduled.notify_all()
+            self.deadlines[key] = deadline
+
+    def forget(self, chatroom_id, user_id):
+        with self.lock:
+            self.deadlines.pop((chatroom_id, user_id), None)
+
+    def pop_expired(self, now=None):
+        # Returns the (chatroom_id, user_id) pairs whose deadline has passed.
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, key = heapq.heappop(self.heap)
+                current = self.deadlines.get(key)
+                if current is None:
+                    continue
+                if current > now:
+                    heapq.heappush(self.heap, (current, key))
+                    continue
+                del self.deadlines[key]
+                expired.append(key)
+        return expired
+
+    def wait(self, max_delay):
+        # Blocks until the earliest deadline, or at most max_delay seconds.
+        with self.rescheduled:
+            delay = max_delay
+            if self.heap:
+                delay = min(delay, max(0.0, self.heap[0][0] - time.monotonic()))
+            self.rescheduled.wait(delay)
+
+    def wake_up(self):
+        with self.rescheduled:
+            self.rescheduled.notify_all()
 
 
 class ChatroomCleaner(threading.Thread):
 
     def __init__(self, server, logger, check_interval=30):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, daemon=True)
         self.server = server
         self.logger = logger
         self.check_interval = check_interval
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+        self.server.inactivity_tracker.wake_up()
 
     def run(self):
-        while True:
+        while not self.stopped:
             try:
-                time.sleep(self.check_interval)
-                self.server.clean_inactive_users()
+                # Wake up when the next user expires so that the eviction is on time.
+                self.server.inactivity_tracker.wait(self.check_interval)
+                if not self.stopped:
+                    self.server.clean_inactive_users()
             except:
                 (typ, val, tb) = sys.exc_info()
                 error_msg = "An exception occurred in the ChatroomCleaner:\n"
@@ -181,6 +658,325 @@ class ChatroomCleaner(threading.Thread):
                 self.logger.debug(error_msg)
 
 
+def exit_on_sigterm():
+    # Without a handler, SIGTERM kills the process without running the atexit hooks.  The servers that set
+    # their own handler (gunicorn, uvicorn) exit normally.
+    if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+
+class ArchiveWriter(threading.Thread):
+    # Archives the released chatrooms in the background so that leaving a chatroom never waits for the disk.
+    # Dialogs are written by batches of at most batch_size, flush_interval seconds after the first one.
+
+    def __init__(self, server, logger, flush_interval=1.0, batch_size=64):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.logger = logger
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = queue.Queue()
+
+    def submit(self, chatroom, news, cond):
+        self.pending.put((chatroom, news, cond))
+
+    def flush(self):
+        # Blocks until all the submitted dialogs have been written.
+        self.pending.join()
+
+    def stop(self):
+        # The dialogs submitted so far are still written.  Also called at exit, when it may be stopped already.
+        if self.is_alive():
+            self.pending.put(None)
+            self.join()
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            batch = []
+            item = self.pending.get()
+            deadline = time.monotonic() + self.flush_interval
+            while item is not None:
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            stopped = item is None
+            try:
+                if batch:
+                    start = time.perf_counter()
+                    self.server._archive_dialogs(batch)
+                    self.server.archive_latency.observe(time.perf_counter() - start)
+                    self.server.archived_dialogs.inc(len(batch))
+                    if self.server.event_log is not None:
+                        self.server.event_log.archived([chatroom.id for chatroom, _, _ in batch])
+            except:
+                (typ, val, tb) = sys.exc_info()
+                error_msg = "An exception occurred in the ArchiveWriter:\n"
+                for line in traceback.format_exception(typ, val, tb):
+                    error_msg += line + "\n"
+                self.logger.error(error_msg)
+            finally:
+                for _ in range(len(batch) + (1 if stopped else 0)):
+                    self.pending.task_done()
+
+
+class StateWatcher(threading.Thread):
+    # Shared state: applies the changes made by the other workers to the local copies of the chatrooms,
+    # which wakes up their pollers.  Every interval seconds, the feed of changes is read and the buffered
+    # polls are written; the changes and released chatrooms older than retention seconds are purged.
+
+    def __init__(self, server, logger, seq, interval=0.02, retention=300):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.logger = logger
+        # Last change applied.
+        self.seq = seq
+        self.interval = interval
+        self.retention = retention
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        store = self.server.state_store
+        next_purge = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            try:
+                # The last change applied is read again: if it has been purged, some changes were missed.
+                changes = store.changes(self.seq)
+                if self.seq and (not changes or changes[0][0] != self.seq):
+                    self.logger.warning("Changes of the shared state were purged before being applied")
+                    chatroom_ids = set(store.live_chatrooms()) | set(self.server.chatrooms)
+                    self.seq = store.last_change()
+                else:
+                    chatroom_ids = dict.fromkeys(chatroom_id for seq, chatroom_id in changes if seq > self.seq)
+                    if changes:
+                        self.seq = changes[-1][0]
+                if chatroom_ids:
+                    self.server._sync_chatrooms(chatroom_ids)
+                store.flush()
+                if time.monotonic() >= next_purge:
+                    store.purge(time.time() - self.retention)
+                    next_purge = time.monotonic() + self.retention / 10
+            except:
+                (typ, val, tb) = sys.exc_info()
+                error_msg = "An exception occurred in the StateWatcher:\n"
+                for line in traceback.format_exception(typ, val, tb):
+                    error_msg += line + "\n"
+                self.logger.error(error_msg)
+
+
+class Histogram(object):
+    # Counts of the observed values by bucket, as in the Prometheus histograms: the last bucket
+    # holds the values above the last bound (+Inf).
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def collect(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class NullMetric(object):
+    # Stands for the histograms and counters when the metrics are disabled.
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+
+NULL_METRIC = NullMetric()
+
+
+class TimedLock(object):
+    # Wraps a Lock or an RLock and records how long it is waited for and held, from the outermost
+    # acquisition to the matching release.  Timing every acquisition would cost more than the
+    # critical sections themselves, so only a random sample_rate of the outermost acquisitions are
+    # timed.  It can back a threading.Condition: the time spent in Condition.wait is neither waited
+    # nor held, since the lock is released meanwhile.
+
+    def __init__(self, lock, wait_histogram, hold_histogram, sample_rate=1.0):
+        self.lock = lock
+        self.wait_histogram = wait_histogram
+        self.hold_histogram = hold_histogram
+        self.sample_rate = sample_rate
+        # Only modified by the owner.  acquired is 0 when the current acquisition is not timed.
+        self.depth = 0
+        self.acquired = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        # Drawn before acquiring: whether the acquisition is the outermost one is only known after.
+        if random.random() >= self.sample_rate:
+            if not self.lock.acquire(blocking, timeout):
+                return False
+            self.depth += 1
+            if self.depth == 1:
+                self.acquired = 0.0
+            return True
+        start = time.perf_counter()
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.depth += 1
+        if self.depth == 1:
+            self.acquired = time.perf_counter()
+            self.wait_histogram.observe(self.acquired - start)
+        return True
+
+    __enter__ = acquire
+
+    def release(self):
+        self.depth -= 1
+        if self.depth or not self.acquired:
+            self.lock.release()
+            return
+        held = time.perf_counter() - self.acquired
+        self.lock.release()
+        self.hold_histogram.observe(held)
+
+    def __exit__(self, *args):
+        self.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    # Used by threading.Condition when the wrapped lock is an RLock.
+    def _is_owned(self):
+        return self.lock._is_owned()
+
+    def _release_save(self):
+        depth, self.depth = self.depth, 0
+        held = time.perf_counter() - self.acquired
+        state = self.lock._release_save()
+        if self.acquired:
+            self.hold_histogram.observe(held)
+        return depth, state
+
+    def _acquire_restore(self, saved):
+        depth, state = saved
+        start = time.perf_counter()
+        self.lock._acquire_restore(state)
+        self.depth = depth
+        if random.random() < self.sample_rate:
+            self.acquired = time.perf_counter()
+            self.wait_histogram.observe(self.acquired - start)
+        else:
+            self.acquired = 0.0
+
+
+class Metrics(object):
+    # Registry of the metrics of the server, rendered in the Prometheus text format by /metrics.
+    # Histograms and counters are created once and then recorded by the hot paths; gauges are
+    # functions read when the metrics are rendered.  When disabled, recording is a no-op and locks
+    # are not wrapped.
+
+    def __init__(self, enabled=True, lock_sample_rate=1.0):
+        self.enabled = enabled
+        self.lock_sample_rate = lock_sample_rate
+        self.lock = threading.Lock()
+        # Wait and hold histograms by lock name.
+        self.lock_histograms = {}
+        # Metric families by name: (type, help, {labels: metric}).
+        self.families = OrderedDict()
+
+    def histogram(self, name, help_, bounds=LATENCY_BUCKETS, **labels):
+        return self._register(name, 'histogram', help_, labels, lambda: Histogram(bounds))
+
+    def counter(self, name, help_, **labels):
+        return self._register(name, 'counter', help_, labels, Counter)
+
+    def gauge(self, name, help_, function, **labels):
+        self._register(name, 'gauge', help_, labels, lambda: function)
+
+    def timed_lock(self, name, lock, sample_rate=None):
+        # Wraps lock so that its wait and hold times are recorded, labelled by name.  sample_rate is
+        # the rate of timed acquisitions, lock_sample_rate by default.
+        if not self.enabled:
+            return lock
+        histograms = self.lock_histograms.get(name)
+        if histograms is None:
+            histograms = self.lock_histograms[name] = (
+                self.histogram('chat_lock_wait_seconds', "Time spent waiting for a lock (sampled).",
+                               LOCK_BUCKETS, lock=name),
+                self.histogram('chat_lock_hold_seconds', "Time during which a lock is held (sampled).",
+                               LOCK_BUCKETS, lock=name))
+        return TimedLock(lock, *histograms, self.lock_sample_rate if sample_rate is None else sample_rate)
+
+    def sample(self):
+        # Whether an object (e.g. a chatroom) is part of the sample of timed locks.
+        return self.enabled and random.random() < self.lock_sample_rate
+
+    def render(self):
+        with self.lock:
+            families = [(name, kind, help_, list(metrics.items()))
+                        for name, (kind, help_, metrics) in self.families.items()]
+        lines = []
+        for name, kind, help_, metrics in families:
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics:
+                if kind == 'histogram':
+                    counts, total = metric.collect()
+                    cumulative = 0
+                    for bound, count in zip(metric.bounds + ('+Inf',), counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {total!r}")
+                    lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+                else:
+                    value = metric.value if kind == 'counter' else metric()
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _register(self, name, kind, help_, labels, make):
+        if not self.enabled:
+            return NULL_METRIC
+        labels = tuple(labels.items())
+        with self.lock:
+            _, _, metrics = self.families.setdefault(name, (kind, help_, OrderedDict()))
+            if labels not in metrics:
+                metrics[labels] = make()
+            return metrics[labels]
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    # Label values are escaped as in the Prometheus text format.
+    return "{" + ",".join(
+        f'{key}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for key, value in labels) + "}"
+
+
 class BaseApi:
 
     def __init__(self, cfg, logger, user_class=BaseUser, chatroom_class=BaseChatroom):
@@ -188,20 +984,91 @@ class BaseApi:
         self.logger = logger
         self.user_class = user_class
         self.chatroom_class = chatroom_class
-
-        self.mutex = threading.Lock()
+        self.metrics = Metrics(enabled=self.cfg.get('metrics', "True") == "True",
+                               lock_sample_rate=self.cfg.get('metrics_lock_sample_rate', 0.05))
+
+        self.mutex = self.metrics.timed_lock("mutex", threading.Lock())
+        self.poll_wait = self.metrics.histogram('chat_long_poll_wait_seconds',
+                                                "Time until a poll of /chatroom returns, including its wait.")
+        self.poll_outcomes = {outcome: self.metrics.counter('chat_long_polls_total',
+                                                            "Polls of /chatroom by outcome (changed, expired, gone).",
+                                                            outcome=outcome)
+                              for outcome in ("changed", "expired", "gone")}
+        self.archive_latency = self.metrics.histogram('chat_archive_write_seconds',
+                                                      "Time to write a batch of released dialogs.")
+        self.archived_dialogs = self.metrics.counter('chat_archived_dialogs_total', "Dialogs archived.")
+        self.cleaning_latency = self.metrics.histogram('chat_inactive_user_cleaning_seconds',
+                                                       "Time of a pass of the inactive user cleaner.")
+        self.event_log_commit = self.metrics.histogram('chat_event_log_commit_seconds',
+                                                       "Wait of a request for the commit of its changes.")
 
         self.users = {}
 
         # Dictionaries organized by chatroom ids.
         self.chatrooms = {}
         self.chatroom_locks = {}
-        self.released_chatrooms = {}
+        # Summaries and counters of the chatrooms for the admin API.
+        self.admin_index = AdminIndex()
+        self.released_chatrooms = ReleasedChatrooms(limit=self.cfg.get('released_chatrooms_limit'),
+                                                    policy=self.cfg.get('released_chatrooms_eviction', "oldest"),
+                                                    on_evict=self.admin_index.remove)
+
+        # Matchmaking indexes, maintained under self.mutex.
+        # Chatrooms waiting for a partner in creation order, organized by the role they are waiting for.
+        self.waiting_chatrooms = {"system": OrderedDict(), "user": OrderedDict()}
+        # Chatroom ids organized by session ids.
+        self.session_chatrooms = {}
+
+        # To play safe, I use a larger value than poll_interval
+        self.inactivity_tracker = InactivityTracker(self.cfg['poll_interval'] * 3)
+
+        # Shared state (None: the state above is the state of the experiment).  With a store, the
+        # dictionaries above hold local copies of the chatrooms of all the workers, changed in
+        # transactions of the store and updated with the changes of the other workers by the state watcher.
+        self.state_store = make_state_store(self.cfg)
+        if self.state_store is not None:
+            seq = self.state_store.last_change()
+            self._sync_chatrooms(self.state_store.live_chatrooms())
+            self.state_watcher = StateWatcher(self, self.logger, seq,
+                                              interval=self.cfg.get('state_watch_interval', 0.02),
+                                              retention=self.cfg.get('state_retention', 300))
+            self.state_watcher.start()
+
+        # Write-ahead log of the changes of the chatrooms (None: they are lost when the server stops).
+        # The ticket of the last change logged by a request is kept by thread until it is committed.
+        self.event_log = make_event_log(self.cfg)
+        self.log_ticket = threading.local()
 
         self.chatroom_cleaner = ChatroomCleaner(self, self.logger,
                                                 check_interval=self.cfg['chatroom_cleaning_interval'])
         self.chatroom_cleaner.start()
 
+        self.archive_writer = ArchiveWriter(self, self.logger,
+                                            flush_interval=self.cfg.get('archive_flush_interval', 1.0),
+                                            batch_size=self.cfg.get('archive_batch_size', 64))
+        self.archive_writer.start()
+        # The dialogs still queued are written when the process exits (Ctrl-C, SIGTERM).
+        atexit.register(self.archive_writer.stop)
+        exit_on_sigterm()
+
+        if self.event_log is not None:
+            self._recover()
+
+        # Read when the metrics are rendered, without any lock.
+        self.metrics.gauge('chat_chatrooms', "Chatrooms in memory by state.",
+                           lambda: len(self.chatrooms), state="live")
+        self.metrics.gauge('chat_chatrooms', "Chatrooms in memory by state.",
+                           lambda: len(self.released_chatrooms), state="released")
+        self.metrics.gauge('chat_users', "Users in a chatroom.", lambda: len(self.users))
+        for role, waiting in self.waiting_chatrooms.items():
+            self.metrics.gauge('chat_waiting_chatrooms', "Chatrooms waiting for a partner, by role waited for.",
+                               partial(len, waiting) if self.state_store is None
+                               else partial(self.state_store.count_waiting, role), role=role)
+        self.metrics.gauge('chat_archive_queue_depth', "Released dialogs waiting to be archived.",
+                           self.archive_writer.pending.qsize)
+        self.metrics.gauge('chat_inactivity_deadlines', "Users whose inactivity is tracked.",
+                           partial(len, self.inactivity_tracker.deadlines))
+
     def version(self):
         return "1.0"
 
@@ -211,127 +1078,251 @@ class BaseApi:
             "released_chatrooms": list(self.released_chatrooms.values())
         }
 
-    def join(self, user_id, attribs=dict()):
+    def join(self, user_id, attribs=dict(), system_or_user=None):
         self.logger.debug(f"join user={user_id} attribs={attribs}")
+        if system_or_user is None:
+            system_or_user = request.form['systemOrUser']
         self.mutex.acquire()
 
         try:
             user = self.user_class(user_id, attribs)
             self.users[user_id] = user
 
-            if 'prevent_multiple_tabs' in self.cfg and self.cfg['prevent_multiple_tabs'] == 'True':
-                all_users = flatten([chatroom.users for chatroom in self.chatrooms.values()])
-                all_sessions = set([get_session_id(user_id) for user_id in all_users])
-                if get_session_id(user_id) in all_sessions:
-                    return f"Error: MultipleTabAccessForbidden for user: {user_id}."
-
-            # Try to find an available partner.
-            # If none is found, assign the user to a new chatroom.
-            available_chatrooms = [self.chatrooms[id_] for id_ in self.chatrooms if
-                                    len(self.chatrooms[id_].users) == 1 and
-                                    not self.chatrooms[id_].closed and
-                                    user_id not in self.chatrooms[id_].users and
-                                    user.has_matching_attribs(self.chatrooms[id_].users[0])]
-
-            system_or_user = request.form['systemOrUser']
-            in_chatroom = False
-            if system_or_user == "system":
-                if len(available_chatrooms) > 0:
-                    for chatroom in sorted(available_chatrooms, key=lambda x: x.created, reverse=False):
-                        if not chatroom.initiator:
-                            if chatroom.id in self.chatroom_locks:
-                                self.chatroom_locks[chatroom.id].acquire()
-                                try:
-                                    chatroom.initiator = user_id
-                                    chatroom.add_user(user_id)
-                                    self.logger.info(f"{user_id} joined as system")
-                                    in_chatroom = True
-                                finally:
-                                    self.chatroom_locks[chatroom.id].release()
-                        if in_chatroom:
-                            break
-                if not in_chatroom:
-                    experiment_id = self.cfg['experiment_id']
-                    chatroom = self.chatroom_class(id_=str(uuid.uuid4()), experiment_id=experiment_id,
-                                                   initiator=user_id)
-                    self.chatrooms[chatroom.id] = chatroom
-                    self.chatroom_locks[chatroom.id] = threading.Lock()
-
-            else:
-                if len(available_chatrooms) > 0:
-                    for chatroom in sorted(available_chatrooms, key=lambda x: x.created, reverse=False):
-                        if chatroom.initiator:
-                            if chatroom.id in self.chatroom_locks:
-                                self.chatroom_locks[chatroom.id].acquire()
-                                try:
-                                    chatroom.add_user(user_id)
-                                    in_chatroom = True
-                                finally:
-                                    self.chatroom_locks[chatroom.id].release()
-                        if in_chatroom:
-                            break
-
-                if not in_chatroom:
+            session_id = get_session_id(user_id)
+            with self._transaction():
+                if 'prevent_multiple_tabs' in self.cfg and self.cfg['prevent_multiple_tabs'] == 'True':
+                    in_chatroom = (session_id in self.session_chatrooms if self.state_store is None
+                                   else self.state_store.has_session(session_id))
+                    if in_chatroom:
+                        return f"Error: MultipleTabAccessForbidden for user: {user_id}."
+
+                # Try to find an available partner.
+                # If none is found, assign the user to a new chatroom.
+                role = "system" if system_or_user == "system" else "user"
+                waiting_for = None
+                chatroom = self._pop_waiting_chatroom(user, role)
+                if chatroom is not None:
+                    self.chatroom_locks[chatroom.id].acquire()
+                    try:
+                        if role == "system":
+                            chatroom.initiator = user_id
+                        chatroom.add_user(user_id)
+                        if role == "system":
+                            self.logger.info(f"{user_id} joined as system")
+                    finally:
+                        self.chatroom_locks[chatroom.id].release()
+                else:
                     experiment_id = self.cfg['experiment_id']
-                    chatroom = self.chatroom_class(id_=str(uuid.uuid4()), experiment_id=experiment_id)
-                    chatroom.add_user(user_id)
-                    self.chatrooms[chatroom.id] = chatroom
-                    self.chatroom_locks[chatroom.id] = threading.Lock()
+                    if role == "system":
+                        chatroom = self.chatroom_class(id_=str(uuid.uuid4()), experiment_id=experiment_id,
+                                                       initiator=user_id)
+                    else:
+                        chatroom = self.chatroom_class(id_=str(uuid.uuid4()), experiment_id=experiment_id)
+                        chatroom.add_user(user_id)
+                    self._add_chatroom(chatroom)
+                    # A chatroom created by a system waits for a user and vice versa.
+                    waiting_for = "user" if role == "system" else "system"
+                    if self.state_store is None:
+                        self.waiting_chatrooms[waiting_for][chatroom.id] = chatroom
+                if self.state_store is not None:
+                    chatroom.stored_version = self.state_store.save(chatroom, waiting_for)
+                else:
+                    self.session_chatrooms.setdefault(session_id, set()).add(chatroom.id)
+                if waiting_for is not None:
+                    self._log({'op': "create", 'id': chatroom.id, 'experiment_id': chatroom.experiment_id,
+                               'created': chatroom.created, 'initiator': chatroom.initiator, 'user': user_id,
+                               'attribs': attribs, 'waiting_for': waiting_for, 'modified': chatroom.modified})
+                else:
+                    self._log({'op': "join", 'id': chatroom.id, 'user': user_id, 'attribs': attribs,
+                               'initiator': role == "system", 'modified': chatroom.modified})
+                self.admin_index.update(chatroom)
+                self._touch(chatroom.id, user_id)
 
             self.logger.debug(f"User {user_id} is assigned to chatroom {chatroom.id}.")
 
             data = self._get_chatroom_data(chatroom.id)
             return data
-        except:
-            self.logger.info('data is None!')
-            return None
+        except Exception:
+            # Logged with the user, then raised: the request fails instead of going on without a chatroom.
+            self.logger.exception(f"join failed for user {user_id}")
+            raise
         finally:
             self.mutex.release()
+            self._commit_log()
+
+    def _pop_waiting_chatroom(self, user, role):
+        # Must be called with self.mutex held (and in a transaction of the state store).
+        # Returns the oldest chatroom waiting for the given role whose user matches, or None.
+        if self.state_store is not None:
+            # The queues are in the store; a chatroom leaves its queue when it is closed.
+            for chatroom_id in self.state_store.waiting_chatrooms(role):
+                chatroom = self._sync_chatroom(chatroom_id)
+                if (chatroom is not None and len(chatroom.users) == 1 and user.id not in chatroom.users
+                        and user.has_matching_attribs(chatroom.users[0])):
+                    return chatroom
+            return None
+        waiting = self.waiting_chatrooms[role]
+        found = None
+        stale = []
+        for chatroom_id, chatroom in waiting.items():
+            if chatroom_id not in self.chatrooms or len(chatroom.users) != 1 or chatroom.closed:
+                stale.append(chatroom_id)
+            elif user.id not in chatroom.users and user.has_matching_attribs(chatroom.users[0]):
+                found = chatroom
+                break
+        for chatroom_id in stale:
+            del waiting[chatroom_id]
+        if found is not None:
+            del waiting[found.id]
+        return found
 
     def set_news(self, chatroom_id, news, tweets):
-        self.chatrooms[chatroom_id].news = news
-        self.chatrooms[chatroom_id].tweets = tweets
+        if self.state_store is None:
+            self.chatrooms[chatroom_id].news = news
+            self.chatrooms[chatroom_id].tweets = tweets
+            self._log({'op': "news", 'id': chatroom_id, 'news': news, 'tweets': tweets})
+            self._commit_log()
+            return
+        with self.mutex, self.state_store.transaction():
+            chatroom = self._sync_chatroom(chatroom_id)
+            if chatroom is not None:
+                chatroom.news = news
+                chatroom.tweets = tweets
+                chatroom.stored_version = self.state_store.save(chatroom, news=True)
 
     def get_chatroom(self, chatroom_id, user_id, client_timestamp):
         self.logger.debug(f"get_chatroom chatroom={chatroom_id} user={user_id} client_timestamp={client_timestamp}")
+        # Make sure that the function terminates after a certain delay.
+        # Otherwise, the poll requests will accumulate and make the web server crash.
+        start = time.perf_counter()
+        data = self.wait_for_chatroom(chatroom_id, user_id, client_timestamp, self.cfg['poll_interval'])
+        self.record_poll(data, time.perf_counter() - start)
+        return data
+
+    def record_poll(self, data, duration):
+        self.poll_wait.observe(duration)
+        self.poll_outcomes["gone" if data is None else "expired" if data == "expired" else "changed"].inc()
+
+    def wait_for_chatroom(self, chatroom_id, user_id, client_timestamp, timeout, record_poll=True):
         request_time = datetime.utcnow()
+        deadline = time.monotonic() + timeout
 
-        while True:
-            if chatroom_id in self.chatroom_locks:
-                chatroom_lock = self.chatroom_locks[chatroom_id]
+        chatroom = self._get_local_chatroom(chatroom_id, user_id)
+        if chatroom is None:
+            self.logger.debug("chatroom_id not in self.chatroom")
+            return None
+        snapshot = chatroom.snapshot
+        if user_id not in snapshot.users:
+            self.logger.debug("user_id not in chatroom.users")
+            return None
+        if record_poll:
+            self._record_poll(chatroom, user_id)
 
-                chatroom_lock.acquire()
-                try:
-                    if chatroom_id not in self.chatrooms:
-                        self.logger.debug("chatroom_id not in self.chatroom")
-                        return None
-                    chatroom = self.chatrooms[chatroom_id]
-                    if user_id not in chatroom.users:
-                        self.logger.debug("user_id not in chatroom.users")
-                        return None
-                    chatroom.has_polled(user_id, request_time.isoformat())
-                    chatroom_has_changed = not client_timestamp or chatroom.has_changed(client_timestamp)
-                    self.logger.debug(f"user {user_id} checks if the chatroom has changed={chatroom_has_changed} "
-                                      f"modified={chatroom.modified} vs client_timestamp={client_timestamp}")
-                    if chatroom_has_changed:
-                        data = self._get_chatroom_data(chatroom_id)
-                        self.logger.debug("chatroom_has_changed")
-                        return data
-
-                finally:
-                    chatroom_lock.release()
-
-            # Make sure that the function terminates after a certain delay.
-            # Otherwise, the poll requests will accumulate and make the web server crash.
-            waiting_period = (datetime.utcnow() - request_time).total_seconds()
-            if waiting_period >= (self.cfg['poll_interval']):
-                self.logger.debug(f"Waiting period has expired: {waiting_period}")
-                return "expired"
-
-            time.sleep(1.0)
+        # Versioned read: the chatroom lock is only needed to wait for a change.
+        if not client_timestamp or snapshot.modified > client_timestamp:
+            self.logger.debug(f"user {user_id}: chatroom has changed modified={snapshot.modified} "
+                              f"vs client_timestamp={client_timestamp}")
+            return self._get_chatroom_data(chatroom_id, snapshot)
+
+        chatroom_lock = self.chatroom_locks.get(chatroom_id)
+        if chatroom_lock is None:
+            return None
+        chatroom_lock.acquire()
+        try:
+            while True:
+                snapshot = chatroom.snapshot
+                if chatroom_id not in self.chatrooms or user_id not in snapshot.users:
+                    self.logger.debug(f"user {user_id} is no longer in chatroom {chatroom_id}")
+                    return None
+                if snapshot.modified > client_timestamp:
+                    self.logger.debug("chatroom_has_changed")
+                    return self._get_chatroom_data(chatroom_id, snapshot)
+
+                # Sleep until add_event, add_user or remove_user signals the chatroom, or until the deadline.
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not chatroom.wait_for_change(snapshot.version, remaining):
+                    waiting_period = (datetime.utcnow() - request_time).total_seconds()
+                    self.logger.debug(f"Waiting period has expired: {waiting_period}")
+                    return "expired"
+        finally:
+            chatroom_lock.release()
+
+    def connect_push(self, chatroom_id, user_id):
+        # While a push connection is open, the user is considered active without polling.
+        if self._get_local_chatroom(chatroom_id, user_id) is None or chatroom_id not in self.chatroom_locks:
+            return False
+        chatroom_lock = self.chatroom_locks[chatroom_id]
+        chatroom_lock.acquire()
+        try:
+            if chatroom_id not in self.chatrooms or user_id not in self.chatrooms[chatroom_id].users:
+                return False
+            self.chatrooms[chatroom_id].connect(user_id)
+            self.logger.debug(f"push connection opened user={user_id} chatroom={chatroom_id}")
+            return True
+        finally:
+            chatroom_lock.release()
+
+    def disconnect_push(self, chatroom_id, user_id):
+        if chatroom_id not in self.chatroom_locks:
+            return
+        chatroom_lock = self.chatroom_locks[chatroom_id]
+        chatroom_lock.acquire()
+        try:
+            if chatroom_id in self.chatrooms and user_id in self.chatrooms[chatroom_id].users:
+                self.chatrooms[chatroom_id].disconnect(user_id)
+                self._touch(chatroom_id, user_id)
+                self.logger.debug(f"push connection closed user={user_id} chatroom={chatroom_id}")
+        finally:
+            chatroom_lock.release()
+
+    def check_chatroom(self, chatroom_id, user_id, client_timestamp, listener=None, record_poll=True):
+        # Non-blocking counterpart of get_chatroom for asynchronous servers.
+        # Returns the chatroom data if it has changed, None if the user is not in the chatroom anymore
+        # and "unchanged" otherwise, in which case the listener is registered for the next change.
+        chatroom = self._get_local_chatroom(chatroom_id, user_id)
+        if chatroom is None:
+            return None
+        snapshot = chatroom.snapshot
+        if user_id not in snapshot.users:
+            return None
+        if record_poll:
+            self._record_poll(chatroom, user_id)
+        if not client_timestamp or snapshot.modified > client_timestamp:
+            return self._get_chatroom_data(chatroom_id, snapshot)
+        if listener is None:
+            return "unchanged"
+
+        # The chatroom lock makes sure that no change happens between the check and the registration.
+        chatroom.changed.acquire()
+        try:
+            snapshot = chatroom.snapshot
+            if chatroom_id not in self.chatrooms or user_id not in snapshot.users:
+                return None
+            if snapshot.modified > client_timestamp:
+                return self._get_chatroom_data(chatroom_id, snapshot)
+            chatroom.add_change_listener(listener)
+            return "unchanged"
+        finally:
+            chatroom.changed.release()
+
+    def remove_change_listener(self, chatroom_id, listener):
+        # Listener of check_chatroom that nobody waits for anymore.
+        chatroom = self.chatrooms.get(chatroom_id)
+        if chatroom is not None:
+            chatroom.remove_change_listener(listener)
 
     def post_message(self, user_id, chatroom_id, message, used_tweet):
         self.logger.debug(f"post_message user_id={user_id} chatroom_id={chatroom_id} message={message}")
+        if self.state_store is not None:
+            # The local copy of the chatroom is brought up to date before the message is added.
+            with self.mutex, self.state_store.transaction():
+                self._sync_chatroom(chatroom_id)
+                return self._post_message(user_id, chatroom_id, message, used_tweet)
+        data = self._post_message(user_id, chatroom_id, message, used_tweet)
+        self._commit_log()
+        return data
+
+    def _post_message(self, user_id, chatroom_id, message, used_tweet):
         if chatroom_id not in self.chatroom_locks:
             return
 
@@ -351,66 +1342,64 @@ class BaseApi:
                 'used_tweet': used_tweet
             }
             chatroom.add_event(evt)
+            if self.state_store is not None:
+                chatroom.stored_version = self.state_store.save(chatroom)
+            self._log({'op': "post", 'id': chatroom_id, 'event': evt, 'modified': chatroom.modified})
+            self._touch(chatroom_id, user_id)
+            self.admin_index.update(chatroom)
 
-            data = self._get_chatroom_data(chatroom_id)
+            data = self._get_chatroom_data(chatroom_id, chatroom.snapshot)
             return data
         finally:
             chatroom_lock.release()
 
     def leave_chatroom(self, user_id, chatroom_id, news, cond):
         self.logger.debug(f"leave_chatroom user_id={user_id} chatroom_id={chatroom_id}")
+        # The global mutex only protects the in-memory indexes: the dialog is archived in the background
+        # once it is released.
         self.mutex.acquire()
         try:
-            data = self._leave_chatroom(user_id, chatroom_id, news, cond)
-            return data
+            with self._transaction():
+                data, released_chatroom = self._leave_chatroom(user_id, chatroom_id)
         finally:
             self.mutex.release()
+        self._commit_log()
+        if released_chatroom is not None:
+            self.archive_writer.submit(released_chatroom, news, cond)
+        return data
 
     def clean_inactive_users(self):
-        self.logger.debug("clean_inactive_users")
         start = time.time()
-        self.mutex.acquire()
         try:
-            inactive_users = []
-            now = datetime.utcnow()
-            for chatroom_id in self.chatrooms:
-                if chatroom_id in self.chatroom_locks:
-                    chatroom_lock = self.chatroom_locks[chatroom_id]
-                    chatroom_lock.acquire()
-                    try:
-                        chatroom = self.chatrooms[chatroom_id]
-                        for user_id in chatroom.users:
-                            if user_id in chatroom.poll_requests.keys():
-                                last_poll = datetime.fromisoformat(chatroom.poll_requests[user_id][-1])
-                                self.logger.debug(f"now={now} type={type(now)} last_poll={last_poll} type={type(last_poll)}")
-                                delta = now - last_poll
-
-                                # Fix to prevent this normalization issue that occurs when the now and last_poll values are very close to each other:
-                                # https://stackoverflow.com/questions/28677673/why-does-datetime-datetime-now-datetime-datetime-now-equal-to-datetime-tim
-                                delta_in_secs = delta.seconds if delta.days >= 0 else 0
-
-                                self.logger.debug(
-                                    f"Check user {user_id}... Last poll: {last_poll.isoformat()} Now: {now.isoformat()}"
-                                    " Delta(s): {delta_in_secs}"
-                                )
-                                # To play safe, I use a larger value than poll_interval
-                                if delta_in_secs > self.cfg['poll_interval'] * 3:
-                                    self.logger.debug(f"{user_id} has been inactive for too long. Let's kick him out of room {chatroom_id}")
-                                    inactive_users.append((user_id, chatroom_id))
-                    finally:
-                        chatroom_lock.release()
-            for inactive_user in inactive_users:
-                user_id, chatroom_id = inactive_user
-                self._leave_chatroom(user_id, chatroom_id, "in_active_user", "in_active_user")
+            # Only the users whose inactivity deadline has passed are visited. They are kicked out
+            # through leave_chatroom, which checks again that they are still in their chatroom.
+            if self.state_store is None:
+                expired = self.inactivity_tracker.pop_expired()
+            else:
+                # Each worker keeps active the users of its own push connections.
+                for chatroom in list(self.chatrooms.values()):
+                    for user_id in list(chatroom.push_connections):
+                        self._touch(chatroom.id, user_id)
+                expired = self.state_store.expired(time.time())
+            for chatroom_id, user_id in expired:
+                chatroom = self._get_local_chatroom(chatroom_id, user_id)
+                if chatroom is None or user_id not in chatroom.snapshot.users:
+                    continue
+                if chatroom.is_connected(user_id):
+                    self._touch(chatroom_id, user_id)
+                    continue
+                self.logger.debug(f"{user_id} has been inactive for too long. Let's kick him out of room {chatroom_id}")
+                self.leave_chatroom(user_id, chatroom_id, "in_active_user", "in_active_user")
         finally:
-            self.mutex.release()
+            self.cleaning_latency.observe(time.time() - start)
             self.logger.debug(f"clean_inactive_users performed in {time.time() - start}")
 
-    def _get_chatroom_data(self, chatroom_id):
-        chatroom = self.chatrooms[chatroom_id]
+    def _get_chatroom_data(self, chatroom_id, snapshot=None):
+        if snapshot is None:
+            snapshot = self.chatrooms[chatroom_id].snapshot
 
         data = {
-            'chatroom': chatroom,
+            'chatroom': snapshot,
             'msg_count_low': self.cfg['msg_count_low'],
             'msg_count_high': self.cfg['msg_count_high'],
             'poll_interval': self.cfg['poll_interval'],
@@ -418,49 +1407,882 @@ class BaseApi:
         }
         return data
 
-    def _leave_chatroom(self, user_id, chatroom_id, news, cond):  # ここにcond_idを入れよう 2人で対話するのにuser_idなぜ一つ？
+    def _leave_chatroom(self, user_id, chatroom_id):  # ここにcond_idを入れよう 2人で対話するのにuser_idなぜ一つ？
+        # Must be called with self.mutex held (and in a transaction of the state store).
+        # Returns the chatroom data and the chatroom if it has been released.
+        if self.state_store is not None:
+            # The poll history of the user is recorded when it leaves.
+            self._sync_chatroom(chatroom_id, polls=True)
         if chatroom_id not in self.chatrooms:
-            return
+            return None, None
         chatroom = self.chatrooms[chatroom_id]
-        if user_id not in chatroom.users:
-            return
-
-        chatroom.remove_user(user_id)
-        if len(chatroom.users) == 0:
-            self._archive_dialog(chatroom_id, news, cond)
-            self.released_chatrooms[chatroom_id] = self.chatrooms[chatroom_id]
-            self.chatrooms.pop(chatroom_id)
-            self.chatroom_locks.pop(chatroom_id)
+        chatroom_lock = self.chatroom_locks[chatroom_id]
+        chatroom_lock.acquire()
+        try:
+            if user_id not in chatroom.users:
+                return None, None
+            chatroom.remove_user(user_id)
+            snapshot = chatroom.snapshot
+            self._log({'op': "leave", 'id': chatroom_id, 'user': user_id, 'leaved_users': chatroom.leaved_users,
+                       'modified': chatroom.modified})
+        finally:
+            chatroom_lock.release()
+        if self.state_store is not None:
+            chatroom.stored_version = self.state_store.save(chatroom)
+
+        self._unindex_user(user_id, chatroom_id)
+        self.inactivity_tracker.forget(chatroom_id, user_id)
+        self.users.pop(user_id, None)
+        if len(snapshot.users) == 0:
+            self._release_chatroom(chatroom)
+            return None, chatroom
+
+        self.admin_index.update(chatroom)
+        data = self._get_chatroom_data(chatroom_id, snapshot)
+        return data, None
+
+    def _release_chatroom(self, chatroom):
+        # Must be called with self.mutex held.
+        for waiting in self.waiting_chatrooms.values():
+            waiting.pop(chatroom.id, None)
+        self.released_chatrooms[chatroom.id] = chatroom
+        # The responses of the released chatroom are not cached any more.
+        chatroom.encoded_events.clear()
+        self.chatrooms.pop(chatroom.id)
+        self.chatroom_locks.pop(chatroom.id)
+        self.admin_index.update(chatroom, released=True)
+
+    def _add_chatroom(self, chatroom):
+        # Must be called with self.mutex held.
+        # The locks of a sample of the chatrooms are timed, at each acquisition: wrapping
+        # every chatroom lock would slow down all of them.  This is done before sharing it.
+        if self.metrics.sample():
+            chatroom.changed = threading.Condition(self.metrics.timed_lock("chatroom", threading.RLock(), 1.0))
+        self.chatrooms[chatroom.id] = chatroom
+        self.chatroom_locks[chatroom.id] = chatroom.changed
+
+    def _transaction(self):
+        # The changes made in the block are written in one transaction of the state store, if any.
+        return self.state_store.transaction() if self.state_store is not None else nullcontext()
+
+    def _touch(self, chatroom_id, user_id):
+        # Records an activity of the user, which postpones its inactivity deadline.
+        if self.state_store is None:
+            self.inactivity_tracker.touch(chatroom_id, user_id)
+        else:
+            self.state_store.touch(chatroom_id, user_id, time.time() + self.inactivity_tracker.timeout)
+
+    def _record_poll(self, chatroom, user_id):
+        chatroom.has_polled(user_id)
+        if self.state_store is None:
+            self.inactivity_tracker.touch(chatroom.id, user_id)
+        else:
+            now = time.time()
+            self.state_store.record_poll(chatroom.id, user_id, now, now + self.inactivity_tracker.timeout)
+
+    def _log(self, record):
+        # Appends the change to the event log, if any; the request commits it with _commit_log.
+        if self.event_log is not None:
+            self.log_ticket.value = self.event_log.append(record)
+
+    def _commit_log(self):
+        # Must be called without any lock held: waits until the changes logged by this thread are written.
+        ticket = getattr(self.log_ticket, 'value', None)
+        if ticket is not None:
+            self.log_ticket.value = None
+            start = time.perf_counter()
+            self.event_log.commit(ticket)
+            self.event_log_commit.observe(time.perf_counter() - start)
+
+    def _recover(self):
+        # Rebuilds the chatrooms of the event log: the live ones are served again (their users get a new
+        # inactivity delay to come back) and the released ones whose dialogs were not archived are archived.
+        chatrooms = OrderedDict()
+        waiting_for = {}
+        attribs = {}
+        for record in self.event_log.replay():
+            op = record['op']
+            if op == "create":
+                chatroom = self.chatroom_class(id_=record['id'], experiment_id=record['experiment_id'],
+                                               initiator=record['initiator'])
+                if record['initiator'] is None:
+                    chatroom.add_user(record['user'])
+                chatroom.created = record['created']
+                chatrooms[chatroom.id] = chatroom
+                waiting_for[chatroom.id] = record['waiting_for']
+            elif record['id'] not in chatrooms:
+                continue
+            chatroom = chatrooms[record['id']]
+            if op == "join":
+                if record['initiator']:
+                    chatroom.initiator = record['user']
+                chatroom.add_user(record['user'])
+            elif op == "news":
+                chatroom.news = record['news']
+                chatroom.tweets = record['tweets']
+            elif op == "post":
+                chatroom.events.append(record['event'])
+            elif op == "leave":
+                chatroom.remove_user(record['user'])
+                chatroom.leaved_users = record['leaved_users']
+            if op in ("create", "join"):
+                attribs[record['user']] = record['attribs']
+            if 'modified' in record:
+                chatroom.modified = record['modified']
+
+        with self.mutex:
+            for chatroom in chatrooms.values():
+                chatroom.notify_changed()
+                if not chatroom.users:
+                    self.released_chatrooms[chatroom.id] = chatroom
+                    self.admin_index.update(chatroom, released=True)
+                    self.archive_writer.submit(chatroom, chatroom.news, "")
+                    continue
+                self._add_chatroom(chatroom)
+                if not chatroom.closed:
+                    self.waiting_chatrooms[waiting_for[chatroom.id]][chatroom.id] = chatroom
+                for user_id in chatroom.users:
+                    self.users[user_id] = self.user_class(user_id, attribs[user_id])
+                    self.session_chatrooms.setdefault(get_session_id(user_id), set()).add(chatroom.id)
+                    self._touch(chatroom.id, user_id)
+                self.admin_index.update(chatroom)
+        if chatrooms:
+            self.logger.info(f"{len(self.chatrooms)} live chatrooms recovered from {self.event_log.path}")
+
+    def _get_local_chatroom(self, chatroom_id, user_id):
+        # With a state store, the local copy of the chatroom is brought up to date when it does not know
+        # the user yet: the user may have joined through another worker since the last change was applied.
+        chatroom = self.chatrooms.get(chatroom_id)
+        if self.state_store is not None and (chatroom is None or user_id not in chatroom.snapshot.users):
+            with self.mutex:
+                chatroom = self._sync_chatroom(chatroom_id)
+        return chatroom
+
+    def _sync_chatrooms(self, chatroom_ids):
+        with self.mutex:
+            for chatroom_id in chatroom_ids:
+                self._sync_chatroom(chatroom_id)
+
+    def _sync_chatroom(self, chatroom_id, polls=False):
+        # Must be called with self.mutex held, with a state store.
+        # Brings the local copy of the chatroom up to date with the store (and the poll histories of
+        # its users if polls is True), wakes up its pollers if it has changed and returns it (None if
+        # the chatroom does not exist or has been released).
+        if chatroom_id in self.released_chatrooms:
+            return None
+        chatroom = self.chatrooms.get(chatroom_id)
+        if chatroom is None:
+            stored = self.state_store.load(chatroom_id, polls=True)
+        else:
+            stored = self.state_store.load(chatroom_id, chatroom.stored_version, len(chatroom.events), polls)
+        if stored is None or (chatroom is None and stored.released is not None):
+            if chatroom is not None:
+                # Purged from the store after its release.
+                self._release_chatroom(chatroom)
+            return None
+        if chatroom is None:
+            chatroom = self.chatroom_class(id_=chatroom_id, experiment_id=stored.experiment_id)
+            self._add_chatroom(chatroom)
+        version = chatroom.stored_version
+        with chatroom.changed:
+            chatroom.load(stored)
+        if stored.released is not None:
+            self._release_chatroom(chatroom)
+            return None
+        if chatroom.stored_version != version:
+            self.admin_index.update(chatroom)
+        return chatroom
+
+    def _unindex_user(self, user_id, chatroom_id):
+        session_id = get_session_id(user_id)
+        if session_id in self.session_chatrooms:
+            chatroom_ids = self.session_chatrooms[session_id]
+            # Another tab of the same session may still be in the chatroom.
+            if not any(get_session_id(other) == session_id for other in self.chatrooms[chatroom_id].users):
+                chatroom_ids.discard(chatroom_id)
+            if not chatroom_ids:
+                del self.session_chatrooms[session_id]
+
+    def _archive_dialogs(self, batch):
+        # Called by the archive writer with a list of (chatroom, news, cond).
+        # Dialogs are appended to one jsonl shard per creation day (UTC), synced once per batch.
+        formats = self.cfg.get('archive_formats', ["txt"])
+        if "txt" in formats:
+            for chatroom, news, cond in batch:
+                self._archive_dialog(chatroom, news, cond)
+        if "jsonl" not in formats:
             return
 
-        data = self._get_chatroom_data(chatroom_id)
-        return data
-
-    def _archive_dialog(self, chatroom_id, news, cond):
+        shards = {}
+        for chatroom, news, cond in batch:
+            shard = f"{datetime.fromisoformat(chatroom.created):%Y%m%d}.jsonl"
+            shards.setdefault(shard, []).append(json.dumps(convert_chatroom_to_record(chatroom), ensure_ascii=False))
+        Path(self.cfg['archives']).mkdir(parents=True, exist_ok=True)
+        for shard, lines in shards.items():
+            with open(f"{self.cfg['archives']}/{shard}", mode="a", encoding="utf-8") as output_file:
+                output_file.write("\n".join(lines) + "\n")
+                output_file.flush()
+                if self.cfg.get('archive_fsync', "True") == "True":
+                    os.fsync(output_file.fileno())
+            self.logger.debug(f"{len(lines)} dialogs have been archived in {self.cfg['archives']}/{shard}")
+
+    def _archive_dialog(self, chatroom, news, cond):
+        # Per-chatroom text file, written when archive_formats contains "txt".
+        chatroom_id = chatroom.id
         self.logger.debug(f"Archiving dialog from chatroom {chatroom_id}...")
 
-        creation_date = dateutil.parser.parse(self.chatrooms[chatroom_id].created)
-
-        tz = pytz.timezone('Asia/Tokyo')
+        creation_date = datetime.fromisoformat(chatroom.created)
 
         dialog_dir = f"{self.cfg['archives']}/{creation_date.year}/{creation_date.month:02}/{creation_date.day:02}"
         Path(dialog_dir).mkdir(parents=True, exist_ok=True)
         dialog_filename = f"{chatroom_id}.txt"
         with open(f"{dialog_dir}/{dialog_filename}", mode="w") as output_file:
-            if self.chatrooms[chatroom_id].experiment_id:
-                output_file.write(f"Experiment: {self.chatrooms[chatroom_id].experiment_id}\n")
-                news = self.chatrooms[chatroom_id].news
-                tweets = self.chatrooms[chatroom_id].tweets
+            if chatroom.experiment_id:
+                output_file.write(f"Experiment: {chatroom.experiment_id}\n")
+                news = chatroom.news
+                tweets = chatroom.tweets
                 output_file.write(f"news: {news}\ncond = {cond}\ntweets =\n")
                 for i, tweet in enumerate(tweets):
                     output_file.write(f"{i:02} {tweet}\n")
-            for i, evt in enumerate(self.chatrooms[chatroom_id].events):
-                str_from = f"U{1 if evt['from'] == self.chatrooms[chatroom_id].initiator else 2}"
+            for i, evt in enumerate(chatroom.events):
+                str_from = f"U{1 if evt['from'] == chatroom.initiator else 2}"
                 timestamp = datetime.fromisoformat(f"{evt['timestamp']}+00:00").astimezone(tz).isoformat()
                 output_file.write(f"{i:02} {timestamp}|{str_from} [{evt['used_tweet']}] :\t {evt['body']}\n")
         self.logger.debug(f"Dialog has been archived in {dialog_dir}/{dialog_filename}")
 
 
+# A news of the catalog with its tweets, and their JSON forms ready to be inserted in the templates.
+NewsItem = namedtuple('NewsItem', ['news', 'tweets', 'news_json', 'tweets_json'])
+
+
+class NewsCatalog(object):
+    # News and tweets of cfg["news_json"], loaded once and reloaded when the file is modified.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.items = ()
+        self.reload_if_modified()
+
+    def reload_if_modified(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            with open(self.path) as rf:
+                entries = json.load(rf)
+            self.items = tuple(self._make_item(entry) for entry in entries)
+            self.mtime = mtime
+
+    def get_items(self):
+        self.reload_if_modified()
+        return self.items
+
+    def _make_item(self, entry):
+        news = (entry["title"], entry["url"])
+        # The tweets have been collected with their HTML entities (&gt;, &lt;, ...).
+        tweets = [[html.unescape(text), tid] for text, tid in entry["tweets"]]
+        return NewsItem(news, tweets, htmlsafe_json_dumps(news), htmlsafe_json_dumps(tweets))
+
+
+class AccessTokens(object):
+    # Tokens of the crowd sourcing URLs (system_index_<token>, user_index_<token>): the index of the URL
+    # in the batch and an HMAC of the role, the experiment and the index with the server secret.  They
+    # are checked without any table, so that any number of URLs can be issued (see server/urls.py).
+
+    def __init__(self, secret, experiment_id):
+        self.secret = secret
+        self.experiment_id = experiment_id
+
+    def make(self, role, index):
+        return f"{index}.{self._mac(role, index)}"
+
+    def check(self, role, token):
+        index, _, mac = token.partition(".")
+        if not index.isdigit() or len(index) > 18:
+            return False
+        return hmac.compare_digest(mac, self._mac(role, int(index)))
+
+    def _mac(self, role, index):
+        digest = hmac.new(self.secret, f"{role}:{self.experiment_id}:{index}".encode('utf-8'), hashlib.sha256).digest()
+        # 128 bits.
+        return base64.urlsafe_b64encode(digest[:16]).rstrip(b'=').decode('ascii')
+
+
+def load_url_secret(cfg):
+    # cfg["url_secret"], or the secret of the file cfg["url_secret_path"] (by default url_secret in the
+    # sessions directory), created at the first start.  The server and the URL generator must share it.
+    if cfg.get('url_secret'):
+        return cfg['url_secret'].encode('utf-8')
+    path = cfg.get('url_secret_path', os.path.join(cfg['sessions'], 'url_secret'))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Created by another worker, maybe just now.
+        for _ in range(100):
+            with open(path) as secret_file:
+                secret = secret_file.read().strip()
+            if secret:
+                return secret.encode('utf-8')
+            time.sleep(0.01)
+        raise ValueError(f"Empty URL secret: {path}")
+    with os.fdopen(fd, 'w') as secret_file:
+        secret = secrets.token_urlsafe(32)
+        secret_file.write(secret + "\n")
+    return secret.encode('utf-8')
+
+
+class StoreSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, expires=0.0, new=False):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.new = new
+        self.modified = False
+
+
+class MemorySessionStore(object):
+    # Sessions of a single worker, in memory: beyond limit, the least recently used ones are evicted.
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        # sid -> (data, expiration time)
+        self.sessions = OrderedDict()
+        self.writes = 0
+
+    def get(self, sid):
+        with self.lock:
+            stored = self.sessions.get(sid)
+            if stored is None:
+                return None
+            if stored[1] < time.time():
+                del self.sessions[sid]
+                return None
+            self.sessions.move_to_end(sid)
+            return dict(stored[0]), stored[1]
+
+    def set(self, sid, data, expires):
+        with self.lock:
+            self.sessions[sid] = (dict(data), expires)
+            self.sessions.move_to_end(sid)
+            while len(self.sessions) > self.limit:
+                self.sessions.popitem(last=False)
+            self.writes += 1
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+
+class SqliteSessionStore(object):
+    # Sessions shared by the workers of a host, in a SQLite database in WAL mode (readers do not
+    # block the writer).  Each thread has its own connection; expired sessions are deleted every
+    # purge_interval writes.
+
+    def __init__(self, path, purge_interval=1000):
+        self.path = path
+        self.purge_interval = purge_interval
+        self.serializer = TaggedJSONSerializer()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.writes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS sessions "
+                           "(sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+
+    def get(self, sid):
+        row = self._connection().execute("SELECT data, expires FROM sessions WHERE sid = ?", (sid,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return self.serializer.loads(row[0]), row[1]
+
+    def set(self, sid, data, expires):
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)",
+                           (sid, self.serializer.dumps(dict(data)), expires))
+        with self.lock:
+            self.writes += 1
+            purge = self.writes % self.purge_interval == 0
+        if purge:
+            connection.execute("DELETE FROM sessions WHERE expires < ?", (time.time(),))
+
+    def delete(self, sid):
+        self._connection().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Autocommit: each statement is its own transaction.
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+
+def make_session_store(cfg):
+    # cfg["session_store"]: "filesystem" (flask_session, the default), "memory" or "sqlite".
+    kind = cfg.get('session_store', 'filesystem')
+    if kind == 'filesystem':
+        return None
+    if kind == 'memory':
+        return MemorySessionStore(cfg.get('session_memory_limit', 100000))
+    if kind == 'sqlite':
+        return SqliteSessionStore(cfg.get('session_sqlite_path', os.path.join(cfg['sessions'], 'sessions.sqlite3')))
+    raise ValueError(f"Unknown session store: {kind}")
+
+
+# State of a chatroom read from the shared state store.  events only holds the events after the ones
+# already known by the reader, and the other fields are None if the reader knows the current version.
+# polls maps the users to (last_poll, poll_num) when it has been read.
+StoredChatroom = namedtuple('StoredChatroom', [
+    'id', 'experiment_id', 'created', 'modified', 'initiator', 'closed', 'users', 'leaved_users', 'attribs', 'news',
+    'tweets', 'version', 'released', 'events', 'polls'
+])
+
+
+class SqliteStateStore(object):
+    # State of the chatrooms shared by the workers of a host, in a SQLite database in WAL mode: the
+    # chatrooms with their events and users, the matchmaking queues (chatrooms waiting for a partner
+    # in creation order), the inactivity deadlines of the users and a feed of the changes from which
+    # each worker updates its local copies of the chatrooms.
+    # Changes are written in transactions (BEGIN IMMEDIATE) so that a worker reads and updates a
+    # chatroom without interference from the others.  The threads of a worker take turns on
+    # self.lock rather than on the lock of the database, which makes them sleep.  The polls and the
+    # activities of the users are buffered and written with the next transaction or flush.
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chatrooms (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL UNIQUE, experiment_id, created TEXT,
+            modified TEXT, initiator TEXT, closed INTEGER NOT NULL, users TEXT NOT NULL, leaved_users TEXT NOT NULL,
+            attribs TEXT, news TEXT, tweets TEXT, waiting_for TEXT, version INTEGER NOT NULL,
+            n_events INTEGER NOT NULL, released REAL);
+        CREATE INDEX IF NOT EXISTS chatrooms_waiting ON chatrooms (waiting_for, seq)
+            WHERE closed = 0 AND released IS NULL;
+        CREATE INDEX IF NOT EXISTS chatrooms_released ON chatrooms (released) WHERE released IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS events (
+            chatroom_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL,
+            PRIMARY KEY (chatroom_id, seq)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS members (
+            chatroom_id TEXT NOT NULL, user_id TEXT NOT NULL, session_id TEXT NOT NULL, last_poll REAL NOT NULL,
+            poll_num INTEGER NOT NULL, deadline REAL, PRIMARY KEY (chatroom_id, user_id)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS members_session ON members (session_id);
+        CREATE INDEX IF NOT EXISTS members_deadline ON members (deadline);
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, chatroom_id TEXT NOT NULL, time REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        # (chatroom_id, user_id) -> [last poll or None, number of polls, inactivity deadline]
+        self.pending_polls = {}
+        self.pending_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.lock:
+            self._connection().executescript(self.SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        # The writes of the block are atomic and the reads see the state of the other workers as of its start.
+        with self.lock:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._write_polls(connection)
+                yield
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def load(self, chatroom_id, known_version=0, known_events=0, polls=False):
+        # Returns a StoredChatroom with the events after the first known_events ones, or None.
+        with self._reading() as connection:
+            row = connection.execute(
+                "SELECT experiment_id, created, modified, initiator, closed, users, leaved_users, attribs, news, "
+                "tweets, version, n_events, released FROM chatrooms WHERE id = ?", (chatroom_id,)).fetchone()
+            if row is None:
+                return None
+            events = []
+            if row[11] > known_events:
+                events = [json.loads(event) for event, in connection.execute(
+                    "SELECT event FROM events WHERE chatroom_id = ? AND seq >= ? ORDER BY seq",
+                    (chatroom_id, known_events))]
+            if polls:
+                polls = {user_id: (last_poll, poll_num) for user_id, last_poll, poll_num in connection.execute(
+                    "SELECT user_id, last_poll, poll_num FROM members WHERE chatroom_id = ?", (chatroom_id,))}
+        if row[10] == known_version:
+            return StoredChatroom(chatroom_id, *((None,) * 10), version=row[10], released=row[12], events=events,
+                                  polls=polls or None)
+        return StoredChatroom(
+            id=chatroom_id,
+            experiment_id=row[0],
+            created=row[1],
+            modified=row[2],
+            initiator=row[3],
+            closed=bool(row[4]),
+            users=json.loads(row[5]),
+            leaved_users=json.loads(row[6]),
+            attribs=json.loads(row[7]),
+            news=json.loads(row[8]),
+            tweets=json.loads(row[9]),
+            version=row[10],
+            released=row[12],
+            events=events,
+            polls=polls or None
+        )
+
+    def save(self, chatroom, waiting_for=None, news=False):
+        # Must be called in a transaction.  Writes the state of the chatroom and its new events, records
+        # the change and returns the new version.  waiting_for is the role the chatroom waits for, when it
+        # is created; the news and the tweets are only written with the new chatrooms or if news is True.
+        connection = self._connection()
+        snapshot = chatroom.snapshot
+        row = connection.execute("SELECT version, n_events, users FROM chatrooms WHERE id = ?",
+                                 (snapshot.id,)).fetchone()
+        version, n_events, stored_users = row if row is not None else (0, 0, "[]")
+        users = json.dumps(snapshot.users)
+        values = (snapshot.modified, snapshot.initiator, int(snapshot.closed), users, json.dumps(snapshot.leaved_users),
+                  version + 1, len(snapshot.events), None if snapshot.users else time.time(), snapshot.id)
+        if row is None:
+            connection.execute(
+                "INSERT INTO chatrooms (modified, initiator, closed, users, leaved_users, version, n_events, "
+                "released, id, experiment_id, created, attribs, waiting_for) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                values + (snapshot.experiment_id, snapshot.created, json.dumps(chatroom.attribs), waiting_for))
+        else:
+            connection.execute(
+                "UPDATE chatrooms SET modified = ?, initiator = ?, closed = ?, users = ?, leaved_users = ?, "
+                "version = ?, n_events = ?, released = ? WHERE id = ?", values)
+        if row is None or news:
+            connection.execute("UPDATE chatrooms SET news = ?, tweets = ? WHERE id = ?",
+                               (json.dumps(chatroom.news), json.dumps(chatroom.tweets, ensure_ascii=False),
+                                snapshot.id))
+        if len(snapshot.events) > n_events:
+            connection.executemany("INSERT INTO events (chatroom_id, seq, event) VALUES (?, ?, ?)",
+                                   [(snapshot.id, seq, json.dumps(evt, ensure_ascii=False))
+                                    for seq, evt in enumerate(snapshot.events[n_events:], n_events)])
+        if users != stored_users:
+            stored_users = json.loads(stored_users)
+            connection.executemany(
+                "INSERT INTO members (chatroom_id, user_id, session_id, last_poll, poll_num) VALUES (?, ?, ?, ?, ?)",
+                [(snapshot.id, user, get_session_id(user), chatroom.poll_requests[user].last_poll,
+                  chatroom.poll_requests[user].poll_num) for user in snapshot.users if user not in stored_users])
+            connection.executemany("DELETE FROM members WHERE chatroom_id = ? AND user_id = ?",
+                                   [(snapshot.id, user) for user in stored_users if user not in snapshot.users])
+        connection.execute("INSERT INTO changes (chatroom_id, time) VALUES (?, ?)", (snapshot.id, time.time()))
+        return version + 1
+
+    def waiting_chatrooms(self, role):
+        # Ids of the chatrooms waiting for the given role, oldest first.
+        return [chatroom_id for chatroom_id, in self._connection().execute(
+            "SELECT id FROM chatrooms WHERE waiting_for = ? AND closed = 0 AND released IS NULL ORDER BY seq",
+            (role,))]
+
+    def count_waiting(self, role):
+        return self._connection().execute(
+            "SELECT count(*) FROM chatrooms WHERE waiting_for = ? AND closed = 0 AND released IS NULL",
+            (role,)).fetchone()[0]
+
+    def live_chatrooms(self):
+        return [chatroom_id for chatroom_id, in self._connection().execute(
+            "SELECT id FROM chatrooms WHERE released IS NULL ORDER BY seq")]
+
+    def has_session(self, session_id):
+        # Whether a user of the session is in a chatroom.
+        return self._connection().execute("SELECT 1 FROM members WHERE session_id = ? LIMIT 1",
+                                          (session_id,)).fetchone() is not None
+
+    def touch(self, chatroom_id, user_id, deadline):
+        self.record_poll(chatroom_id, user_id, None, deadline, polls=0)
+
+    def record_poll(self, chatroom_id, user_id, timestamp, deadline, polls=1):
+        with self.pending_lock:
+            pending = self.pending_polls.get((chatroom_id, user_id))
+            if pending is None:
+                self.pending_polls[(chatroom_id, user_id)] = [timestamp, polls, deadline]
+            else:
+                pending[0] = timestamp or pending[0]
+                pending[1] += polls
+                pending[2] = deadline
+
+    def flush(self):
+        # Writes the buffered polls.
+        if self.pending_polls:
+            with self.transaction():
+                pass
+
+    def expired(self, now):
+        # (chatroom_id, user_id) of the users whose inactivity deadline has passed.
+        self.flush()
+        return self._connection().execute("SELECT chatroom_id, user_id FROM members WHERE deadline <= ?",
+                                          (now,)).fetchall()
+
+    def changes(self, seq):
+        # (seq, chatroom_id) of the changes from seq on, in order.
+        return self._connection().execute("SELECT seq, chatroom_id FROM changes WHERE seq >= ? ORDER BY seq",
+                                          (seq,)).fetchall()
+
+    def last_change(self):
+        return self._connection().execute("SELECT coalesce(max(seq), 0) FROM changes").fetchone()[0]
+
+    def increment(self, name):
+        # Increments the counter and returns its new value.
+        with self.transaction():
+            connection = self._connection()
+            connection.execute("INSERT INTO counters (name, value) VALUES (?, 1) "
+                               "ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,))
+            return connection.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+
+    def purge(self, before):
+        # Deletes the changes and the chatrooms released before the given time; the last change is kept.
+        with self.transaction():
+            connection = self._connection()
+            connection.execute("DELETE FROM changes WHERE time < ? AND seq < (SELECT max(seq) FROM changes)",
+                               (before,))
+            released = connection.execute("SELECT id FROM chatrooms WHERE released < ?", (before,)).fetchall()
+            connection.executemany("DELETE FROM events WHERE chatroom_id = ?", released)
+            connection.execute("DELETE FROM chatrooms WHERE released < ?", (before,))
+
+    def _write_polls(self, connection):
+        with self.pending_lock:
+            pending, self.pending_polls = self.pending_polls, {}
+        connection.executemany(
+            "UPDATE members SET last_poll = coalesce(?, last_poll), poll_num = poll_num + ?, deadline = ? "
+            "WHERE chatroom_id = ? AND user_id = ?",
+            [(timestamp, polls, deadline, chatroom_id, user_id)
+             for (chatroom_id, user_id), (timestamp, polls, deadline) in pending.items()])
+
+    @contextmanager
+    def _reading(self):
+        # Consecutive reads see the same state: a read transaction is opened unless a transaction is in progress.
+        connection = self._connection()
+        if connection.in_transaction:
+            yield connection
+            return
+        connection.execute("BEGIN")
+        try:
+            yield connection
+        finally:
+            connection.execute("COMMIT")
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Autocommit outside of the explicit transactions.
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+
+def make_state_store(cfg):
+    # cfg["state_store"]: "memory" (the default: the state is kept in the dictionaries of BaseApi, for a
+    # single worker) or "sqlite" (shared by the worker processes of a host).
+    kind = cfg.get('state_store', 'memory')
+    if kind == 'memory':
+        return None
+    if kind == 'sqlite':
+        return SqliteStateStore(cfg.get('state_sqlite_path', os.path.join(cfg['sessions'], 'state.sqlite3')))
+    raise ValueError(f"Unknown state store: {kind}")
+
+
+class EventLog(object):
+    # Write-ahead log of the chatrooms in memory, replayed at startup to serve them again: one JSON line
+    # per change (creation, join, news, message, leave), appended under the lock that orders the change
+    # and committed before the request answers.  Commits are grouped: the first request that waits
+    # writes (and syncs) the lines appended by all the others, which wait for it.
+    # The lines of each chatroom are also kept until its dialog is archived, so that the log is
+    # compacted by rewriting those of the other chatrooms.
+
+    def __init__(self, path, fsync=True, compaction_size=1 << 20):
+        self.path = path
+        self.fsync = fsync
+        self.compaction_size = compaction_size
+        self.lock = threading.Lock()
+        self.committed = threading.Condition(self.lock)
+        # Lines appended and not written yet, and numbers of lines appended and written so far.
+        self.pending = []
+        self.appended = 0
+        self.written = 0
+        self.writing = False
+        self.groups = 0
+        # Lines organized by chatroom id (until the dialog is archived), their size and the size of the log.
+        self.lines = {}
+        self.live_size = 0
+        self.size = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.log_file = open(path, 'ab')
+
+    def replay(self):
+        # Returns the records of the log in order, the chatrooms archived excepted.  A torn line at the
+        # end (a group whose write was interrupted) is truncated.
+        records = []
+        with open(self.path, 'rb') as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    record = None
+                if record is None:
+                    break
+                self._index(record, line)
+                self.size += len(line)
+                records.append(record)
+        if self.size < os.path.getsize(self.path):
+            os.truncate(self.path, self.size)
+        archived = set()
+        for record in records:
+            if record['op'] == "archived":
+                archived.update(record['ids'])
+        return [record for record in records if record['op'] != "archived" and record['id'] not in archived]
+
+    def append(self, record):
+        # Returns the ticket to pass to commit.
+        line = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n").encode('utf-8')
+        with self.lock:
+            self._index(record, line)
+            self.pending.append(line)
+            self.size += len(line)
+            self.appended += 1
+            return self.appended
+
+    def commit(self, ticket):
+        # Blocks until the line of the ticket (and the lines appended before it) are written.
+        with self.lock:
+            while self.written < ticket:
+                if self.writing:
+                    self.committed.wait()
+                    continue
+                # This thread writes the group of the lines pending; those appended meanwhile form the next one.
+                lines, self.pending = self.pending, []
+                appended = self.appended
+                self.writing = True
+                self.lock.release()
+                try:
+                    self.log_file.write(b"".join(lines))
+                    self.log_file.flush()
+                    if self.fsync:
+                        os.fsync(self.log_file.fileno())
+                except:
+                    self.lock.acquire()
+                    self.pending[:0] = lines
+                    self.writing = False
+                    self.committed.notify_all()
+                    raise
+                self.lock.acquire()
+                self.writing = False
+                self.written = appended
+                self.groups += 1
+                self.committed.notify_all()
+
+    def archived(self, chatroom_ids):
+        # Forgets the lines of the chatrooms whose dialogs have been archived, and compacts the log
+        # when they make up most of it.
+        self.commit(self.append({'op': "archived", 'ids': chatroom_ids}))
+        if self.size > max(self.compaction_size, self.live_size * 2):
+            self.compact()
+
+    def compact(self):
+        # Rewrites the log with the lines of the chatrooms not archived yet; appends wait meanwhile.
+        with self.lock:
+            while self.writing:
+                self.committed.wait()
+            compacted_path = f"{self.path}.compact"
+            with open(compacted_path, 'wb') as compacted_file:
+                for lines in self.lines.values():
+                    compacted_file.write(b"".join(lines))
+                compacted_file.flush()
+                os.fsync(compacted_file.fileno())
+            os.replace(compacted_path, self.path)
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            self.log_file.close()
+            self.log_file = open(self.path, 'ab')
+            # The lines pending are in the new log.
+            self.pending = []
+            self.written = self.appended
+            self.size = self.live_size
+            self.committed.notify_all()
+
+    def close(self):
+        self.commit(self.appended)
+        self.log_file.close()
+
+    def _index(self, record, line):
+        # Must be called with self.lock held (or before the log is shared).
+        if record['op'] == "archived":
+            for chatroom_id in record['ids']:
+                self.live_size -= sum(len(line) for line in self.lines.pop(chatroom_id, ()))
+        else:
+            self.lines.setdefault(record['id'], []).append(line)
+            self.live_size += len(line)
+
+
+def make_event_log(cfg):
+    # cfg["event_log"]: path of the write-ahead log of the chatrooms (none by default).  A state store
+    # keeps the chatrooms on its own.
+    if not cfg.get('event_log') or cfg.get('state_store', 'memory') != 'memory':
+        return None
+    return EventLog(cfg['event_log'], fsync=cfg.get('event_log_fsync', "True") == "True",
+                    compaction_size=cfg.get('event_log_compaction_size', 1 << 20))
+
+
+class StoreSessionInterface(SessionInterface):
+    # Server-side sessions in a MemorySessionStore or a SqliteSessionStore, identified by the
+    # session cookie as with flask_session.  A session is only written when it is new, modified,
+    # or past half of its lifetime: the polls of an unchanged session only read the store.
+
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            stored = self.store.get(sid)
+            if stored is not None:
+                data, expires = stored
+                return StoreSession(data, sid=sid, expires=expires)
+        return StoreSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session and session.modified:
+            # Cleared during the request.
+            self.store.delete(session.sid)
+            response.delete_cookie(name, domain=domain, path=path)
+            return
+        now = time.time()
+        if not session.new and not session.modified and session.expires - now > self.ttl / 2:
+            return
+        expires = now + self.ttl
+        self.store.set(session.sid, session, expires)
+        response.set_cookie(name, session.sid, expires=expires, httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
 class BaseApp(Flask):
 
     def __init__(self, import_name, api):
@@ -489,26 +2311,32 @@ class BaseApp(Flask):
         self.news = "initial_value"
         self.cond = "initial_cond"
         self.tweet_lst = "initial_tweet_lst"
-        self.crowd_sourcing_url = self.cfg['crowd_sourcing_url']
-        self.urls_path = self.cfg["urls_path"]
-        Session(self)
-
-        self.system_hash_set = set()
-        for i in range(self.cfg["number_of_dialog"]):
-            self.system_hash_set.add(self.hashing_urlsafe(str(i + self.cfg["experiment_id"] * 2)))
-
-        self.user_hash_set = set()
-        for i in range(self.cfg["number_of_dialog"]):
-            self.user_hash_set.add(self.hashing_urlsafe(str(i + self.cfg["experiment_id"] * 3 + 1)))
-
-        with open(self.urls_path, 'w') as wf:
-            for system_hash in self.system_hash_set:
-                wf.write(f"{self.crowd_sourcing_url}system_index_{system_hash}\n")
-                self.logger.info(f"{self.crowd_sourcing_url}system_index_{system_hash}\n")
-
-            for user_hash in self.user_hash_set:
-                wf.write(f"{self.crowd_sourcing_url}user_index_{user_hash}\n")
-                self.logger.info(f"{self.crowd_sourcing_url}user_index_{user_hash}\n")
+        self.news_catalog = NewsCatalog(self.cfg["news_json"])
+        self.session_store = make_session_store(self.cfg)
+        if self.session_store is None:
+            Session(self)
+        else:
+            self.session_interface = StoreSessionInterface(self.session_store, self.cfg.get('session_ttl', 86400))
+
+        # The crowd sourcing URLs are generated by server/urls.py.
+        self.access_tokens = AccessTokens(load_url_secret(self.cfg), self.cfg["experiment_id"])
+
+        self.request_latencies = {
+            endpoint: self.api.metrics.histogram('chat_request_duration_seconds',
+                                                 "Latency of the requests by endpoint.", endpoint=path)
+            for endpoint, path in METRIC_ENDPOINTS.items()
+        }
+        if self.api.metrics.enabled:
+            @self.before_request
+            def start_request_timer():
+                g.request_start = time.perf_counter()
+
+            @self.after_request
+            def record_request_latency(response):
+                histogram = self.request_latencies.get(request.endpoint)
+                if histogram is not None:
+                    histogram.observe(time.perf_counter() - g.request_start)
+                return response
 
         @self.route(f"/{self.cfg['web_context']}/static/<path:path>")
         def get_static(path):
@@ -538,6 +2366,18 @@ class BaseApp(Flask):
         def admin():
             return self.admin()
 
+        @self.route(f"/{self.cfg['web_context']}/admin/chatrooms")
+        def admin_chatrooms():
+            return self.admin_chatrooms(request)
+
+        @self.route(f"/{self.cfg['web_context']}/admin/counters")
+        def admin_counters():
+            return self.admin_counters()
+
+        @self.route(f"/{self.cfg['web_context']}/metrics")
+        def get_metrics():
+            return self.get_metrics()
+
         @self.route(f"/{self.cfg['web_context']}/join", methods=['POST'])
         def join():
             return self.join(session, request)
@@ -546,6 +2386,10 @@ class BaseApp(Flask):
         def get_chatroom():
             return self.get_chatroom(session, request)
 
+        @self.route(f"/{self.cfg['web_context']}/events")
+        def stream_events():
+            return self.stream_events(session, request)
+
         @self.route(f"/{self.cfg['web_context']}/post", methods=['POST'])
         def post_message():
             return self.post_message(session, request)
@@ -564,13 +2408,6 @@ class BaseApp(Flask):
             abs_base_path = Path(sys.prefix).parent / 'static'
         return send_from_directory(abs_base_path, path)
 
-    def hashing_urlsafe(self, s: str) -> str:
-        h = hashlib.sha256()
-        # SALT = 'タスクの1番'.encode('utf-8')
-        h.update(SALT)
-        h.update(s.encode('utf-8'))
-        return ('0' * 32 + base64.urlsafe_b64encode(h.digest()).rstrip(b'=').decode('ascii'))[-32:]
-
     def version(self):
         version = self.api.version()
         try:
@@ -579,24 +2416,26 @@ class BaseApp(Flask):
             return render_template(template_name_or_list='default_version.html', version=version)
 
     def system_index(self, uid):
-        if uid not in self.system_hash_set:
+        if not self.access_tokens.check("system", uid):
             return render_template(
                 template_name_or_list='errorInvalidAccess.html',
                 news=self.news
             )
         try:
-            with open(self.cfg["news_json"]) as rf:
-                line = json.load(rf)
-                if "news_num" in self.cfg and self.cfg["news_num"] >= 0:
-                    news_num = self.cfg["news_num"]
-                else:
-                    self.cond_id += 1
-                    news_num = self.cond_id % len(line)
+            news_items = self.news_catalog.get_items()
+            if "news_num" in self.cfg and self.cfg["news_num"] >= 0:
+                news_num = self.cfg["news_num"]
+            elif self.api.state_store is not None:
+                # The rotation is shared by the workers.
+                self.cond_id = self.api.state_store.increment("cond_id")
+                news_num = self.cond_id % len(news_items)
+            else:
+                self.cond_id += 1
+                news_num = self.cond_id % len(news_items)
 
-                self.news = (line[news_num]["title"], line[news_num]["url"])
-                self.tweet_lst = line[news_num]["tweets"]
-                for text, tid in self.tweet_lst:
-                    text.replace("&gt;", ">").replace("&lt;", "<")
+            news_item = news_items[news_num]
+            self.news = news_item.news
+            self.tweet_lst = news_item.tweets
             cond_num = self.cfg["cond_num"]
             self.cond = COND[cond_num]
 
@@ -604,8 +2443,10 @@ class BaseApp(Flask):
                 template_name_or_list='system_index.html',
                 news_num=news_num,
                 news=self.news,
+                news_json=news_item.news_json,
                 cond=self.cond,
                 tweet_lst=self.tweet_lst,
+                tweet_lst_json=news_item.tweets_json,
                 msg_count_low=self.cfg["msg_count_low"],
                 msg_count_high=self.cfg["msg_count_high"],
             )
@@ -613,7 +2454,7 @@ class BaseApp(Flask):
             return render_template(template_name_or_list='default_index.html')
 
     def user_index(self, uid):
-        if uid not in self.user_hash_set:
+        if not self.access_tokens.check("user", uid):
             return render_template(
                 template_name_or_list='errorInvalidAccess.html'
             )
@@ -642,6 +2483,42 @@ class BaseApp(Flask):
                 experiment_id=self.cfg['experiment_id'],
                 utc_to_local=utc_to_local)
 
+    def admin_chatrooms(self, request):
+        # JSON list of the chatrooms, by pages:
+        #   cursor: next_cursor of the previous page, limit: entries per page (at most ADMIN_PAGE_LIMIT),
+        #   state: waiting, active and/or released (comma-separated), experiment_id,
+        #   since/until: range of creation times (ISO format, UTC), order: asc (oldest first) or desc.
+        # The page is streamed from a snapshot of the admin index, along with the counters.
+        params = request.args.to_dict()
+        try:
+            cursor = int(params['cursor']) if params.get('cursor') else None
+            limit = min(int(params.get('limit', 50)), ADMIN_PAGE_LIMIT)
+        except ValueError:
+            return '', 400
+        states = set(params['state'].split(',')) if params.get('state') else None
+        order = params.get('order', 'asc')
+        if limit < 1 or order not in ('asc', 'desc') or (states is not None and not states <= set(AdminIndex.STATES)):
+            return '', 400
+        snapshot = self.api.admin_index.snapshot()
+        entries, next_cursor = snapshot.query(cursor, limit, states, params.get('experiment_id'),
+                                              params.get('since'), params.get('until'), order)
+
+        def generate():
+            yield f'{{"counters": {json.dumps(snapshot.counters)}, "chatrooms": ['
+            for i, entry in enumerate(entries):
+                yield ("," if i else "") + json.dumps(convert_admin_entry_to_dict(entry), ensure_ascii=False)
+            yield f'], "next_cursor": {json.dumps(None if next_cursor is None else str(next_cursor))}}}'
+
+        return Response(generate(), mimetype='application/json')
+
+    def admin_counters(self):
+        return Response(json.dumps(self.api.admin_index.snapshot().counters), mimetype='application/json')
+
+    def get_metrics(self):
+        if not self.api.metrics.enabled:
+            return '', 404
+        return Response(self.api.metrics.render(), mimetype='text/plain; version=0.0.4')
+
     def join(self, session, request):
         if 'clientTabId' not in request.form:
             return '', 400
@@ -649,14 +2526,11 @@ class BaseApp(Flask):
         client_tab_id = request.form['clientTabId']
         system_or_user = request.form['systemOrUser']
         news_num = int(request.form['newsNum'])
-        with open(self.cfg["news_json"]) as rf:
-            line = json.load(rf)
-            news = (line[news_num]["title"], line[news_num]["url"])
-            tweet_lst = line[news_num]["tweets"]
-            for text, tid in tweet_lst:
-                text.replace("&gt;", ">").replace("&lt;", "<")
+        news_item = self.news_catalog.get_items()[news_num]
+        news = news_item.news
+        tweet_lst = news_item.tweets
         user_id = f'{session.sid}_{client_tab_id}'
-        data = self.api.join(user_id)
+        data = self.api.join(user_id, system_or_user=system_or_user)
 
         if isinstance(data, str) and data.startswith("Error: MultipleTabAccessForbidden"):
             return self.error_forbidden_access_multiple_tabs()
@@ -678,8 +2552,11 @@ class BaseApp(Flask):
                 is_first_user=(data['chatroom'].initiator == user_id),
                 server_url='',
                 news=news,
+                news_json=news_item.news_json,
                 tweet_lst=tweet_lst,
+                tweet_lst_json=news_item.tweets_json,
                 cond=self.cond,
+                push_transport=self.cfg.get('push_transport', 'polling'),
             )
         except TemplateNotFound:
             return render_template(
@@ -701,6 +2578,7 @@ class BaseApp(Flask):
         client_tab_id = params.get('clientTabId')
         chatroom_id = params.get('id')
         client_timestamp = params.get('timestamp')
+        cursor = parse_cursor(params.get('cursor'))
         user_id = f'{session.sid}_{client_tab_id}'
         data = self.api.get_chatroom(chatroom_id, user_id, client_timestamp if client_timestamp != '' else None)
         response = "{}"
@@ -708,8 +2586,46 @@ class BaseApp(Flask):
             if data == "expired":
                 response = '{"msg": "poll expired"}'
             else:
-                response = self._get_chatroom_response(user_id, data)
-        return jsonify(response)
+                response = self._get_chatroom_response(user_id, data, cursor)
+        return Response(response, mimetype='application/json')
+
+    def stream_events(self, session, request):
+        # Push transport: the changes of the chatroom are streamed as server-sent events,
+        # each one carrying the same data as a /chatroom response with a cursor.
+        params = request.args.to_dict()
+        if 'clientTabId' not in params or 'id' not in params:
+            return '', 400
+        client_tab_id = params.get('clientTabId')
+        chatroom_id = params.get('id')
+        cursor = parse_cursor(params.get('cursor')) or 0
+        user_id = f'{session.sid}_{client_tab_id}'
+        if not self.api.connect_push(chatroom_id, user_id):
+            return '', 404
+
+        def generate(cursor):
+            timestamp = None
+            try:
+                while True:
+                    data = self.api.wait_for_chatroom(chatroom_id, user_id, timestamp,
+                                                      self.cfg.get('push_heartbeat_interval', 15), record_poll=False)
+                    if data is None:
+                        yield "event: end\ndata: {}\n\n"
+                        return
+                    if data == "expired":
+                        # Also lets the server notice closed connections.
+                        yield ": keep-alive\n\n"
+                        continue
+                    if cursor > len(data['chatroom'].events):
+                        cursor = 0
+                    timestamp = data['chatroom'].modified
+                    delta = self._get_chatroom_response(user_id, data, cursor)
+                    cursor = len(data['chatroom'].events)
+                    yield f"data: {delta}\n\n"
+            finally:
+                self.api.disconnect_push(chatroom_id, user_id)
+
+        return Response(stream_with_context(generate(cursor)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
     def post_message(self, session, request):
         if 'clientTabId' not in request.form or 'chatroom' not in request.form or 'message' not in request.form:
@@ -718,12 +2634,13 @@ class BaseApp(Flask):
         chatroom_id = request.form['chatroom']
         message = request.form['message']
         used_tweet = request.form['tweets']
+        cursor = parse_cursor(request.form.get('cursor'))
         user_id = f'{session.sid}_{client_tab_id}'
         data = self.api.post_message(user_id, chatroom_id, message, used_tweet)
         response = "{}"
         if data is not None:
-            response = self._get_chatroom_response(user_id, data)
-        return jsonify(response)
+            response = self._get_chatroom_response(user_id, data, cursor)
+        return Response(response, mimetype='application/json')
 
     def leave_chatroom(self, session, request):
         params = request.args.to_dict()
@@ -737,7 +2654,7 @@ class BaseApp(Flask):
         response = "{}"
         if data is not None:
             response = self._get_chatroom_response(user_id, data)
-        return jsonify(response)
+        return Response(response, mimetype='application/json')
 
     def error_forbidden_access_multiple_tabs(self):
         try:
@@ -749,39 +2666,26 @@ class BaseApp(Flask):
                 template_name_or_list='default_errorForbiddenAccess.html'
             )
 
-    def _get_chatroom_response(self, user_id, data):
-        formatted_events = [events_for_user(evt, user_id) for evt in data['chatroom'].events]
-        try:
-            # assert data['chatroom'] is not None
-            response = render_template(
-                template_name_or_list='chatroom.json',
-                chatroom_id=data['chatroom'].id,
-                experiment_id=data['chatroom'].experiment_id,
-                users=json.dumps(data['chatroom'].users),
-                created=data['chatroom'].created,
-                modified=data['chatroom'].modified,
-                initiator="self" if data['chatroom'].initiator == user_id else "other",
-                closed="true" if data['chatroom'].closed else "false",
-                events=json.dumps(formatted_events, ensure_ascii=False),
-                msg_count_low=data['msg_count_low'],
-                msg_count_high=data['msg_count_high'],
-                poll_interval=data['poll_interval'],
-                delay_for_partner=data['delay_for_partner']
-            )
-        except TemplateNotFound:
-            response = render_template(
-                template_name_or_list='default_chatroom.json',
-                chatroom_id=data['chatroom'].id,
-                experiment_id=data['chatroom'].experiment_id,
-                users=json.dumps(data['chatroom'].users),
-                created=data['chatroom'].created,
-                modified=data['chatroom'].modified,
-                initiator="self" if data['chatroom'].initiator == user_id else "other",
-                closed="true" if data['chatroom'].closed else "false",
-                events=json.dumps(formatted_events, ensure_ascii=False),
-                msg_count_low=data['msg_count_low'],
-                msg_count_high=data['msg_count_high'],
-                poll_interval=data['poll_interval'],
-                delay_for_partner=data['delay_for_partner']
-            )
-        return response
+    def _get_chatroom_response(self, user_id, data, cursor=None):
+        # Clients that know how many events they already have only receive the newer ones.
+        # Without a usable cursor (first poll, reload, reconnect), the full snapshot is sent.
+        # The JSON is encoded once, with the events encoded for the user cached in the chatroom.
+        chatroom = data['chatroom']
+        if cursor is None or cursor > len(chatroom.events):
+            cursor = 0
+        head = json.dumps({
+            'id': chatroom.id,
+            'experimentId': chatroom.experiment_id,
+            'users': chatroom.users,
+            'created': chatroom.created,
+            'modified': chatroom.modified,
+            'initiator': "self" if chatroom.initiator == user_id else "other",
+            'closed': chatroom.closed,
+            'msg_count_low': data['msg_count_low'],
+            'msg_count_high': data['msg_count_high'],
+            'poll_interval': data['poll_interval'],
+            'delay_for_partner': data['delay_for_partner'],
+            'cursor': len(chatroom.events),
+            'full': cursor == 0
+        }, ensure_ascii=False)
+        return f'{head[:-1]}, "latestEvents": [{", ".join(encode_events_for_user(chatroom, user_id, cursor))}]}}'
@@ -0,0 +1,59 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Generates the crowd sourcing URLs of an experiment (system_index_<token> and user_index_<token>).
+# The tokens are checked by the server with the same secret (AccessTokens), so the URLs can be issued
+# at any time, by batches, without restarting it.  The URLs are streamed: millions of them can be
+# written.
+#
+# Usage, in the chat-server directory (the config of the server gives the secret and the experiment):
+#   $ python -m server.urls --config config.json --start 0 --count 1000000 --output urls.txt
+
+import argparse
+import json
+import sys
+
+from .base import AccessTokens, load_url_secret
+
+
+def generate_urls(cfg, start, count, roles=("system", "user")):
+    # Yields the URLs of the indexes [start, start + count) for each role, role after role.
+    tokens = AccessTokens(load_url_secret(cfg), cfg['experiment_id'])
+    for role in roles:
+        for index in range(start, start + count):
+            yield f"{cfg['crowd_sourcing_url']}{role}_index_{tokens.make(role, index)}\n"
+
+
+def write_urls(cfg, output_file, start, count, roles=("system", "user"), chunk_size=10000):
+    lines = []
+    for line in generate_urls(cfg, start, count, roles):
+        lines.append(line)
+        if len(lines) == chunk_size:
+            output_file.write("".join(lines))
+            lines = []
+    output_file.write("".join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates the crowd sourcing URLs of an experiment.")
+    parser.add_argument('--config', default='config.json', help="config of the server")
+    parser.add_argument('--start', type=int, default=0, help="index of the first URL of the batch")
+    parser.add_argument('--count', type=int, help="URLs per role (by default number_of_dialog)")
+    parser.add_argument('--roles', nargs='+', choices=["system", "user"], default=["system", "user"])
+    parser.add_argument('--output', help="output file (by default urls_path; -: standard output)")
+    args = parser.parse_args()
+
+    with open(args.config) as config_file:
+        cfg = json.load(config_file)
+    count = args.count if args.count is not None else cfg['number_of_dialog']
+    output = args.output or cfg['urls_path']
+    if output == "-":
+        write_urls(cfg, sys.stdout, args.start, count, args.roles)
+    else:
+        with open(output, 'w') as output_file:
+            write_urls(cfg, output_file, args.start, count, args.roles)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,8 @@ var isTooShortDialogShown = false;
 var isTooLongDialogShown = false;
 
 var chatroomTimestamp = null;
+// Number of events received so far. The server only sends newer events when it is known.
+var eventCursor = null;
 
 var confirmBeforeStopChat = true;            
 var needsLeavingChatroom = true;
@@ -26,6 +28,8 @@ var isLeaving = false;
 var stopChatConfirmed = false;
 var events = [];
 var pollXhr = null;
+var eventSource = null;
+var pushFailures = 0;
 var dialog = null;
 var waitStartTime = null;
 var waitingInterval = null;
@@ -97,6 +101,9 @@ function updateModel(data) {
         else
             events.push(latestEvents[i]);
     }
+    // Every response carries the cursor, the number of events of the chatroom. full is true when latestEvents
+    // holds all the events rather than those after the cursor of the request; both are merged above.
+    eventCursor = data.cursor;
     updateProgress(data);
 }
 
@@ -205,6 +212,71 @@ function stopDialog() {
     isDialogOver = true;
 }
 
+function handleChatroomData(data) {
+    var needsPolling = true;
+    if ('users' in data && data.users.length > 1) {
+        if (!isDialogStarted) {
+            startDialog();
+        }
+    }
+    else {
+        console.log('data.closed='+data.closed+ ' stopChatConfirmed='+stopChatConfirmed);
+        if (data.closed) {
+            isLeaving = true;
+            $('#message-waiting').hide();
+            $('#notification').css({visibility: 'hidden'});
+            $('#controls').hide();
+            $('#chatbox').removeClass('shadowed');
+            var mainBoxHeight = $('#main-box').css('height');
+            $('#main-box').css('height', 'calc(' + mainBoxHeight + ' - ' + mainBoxMargin + ')');
+            if (!stopChatConfirmed) {
+                $('#stop-chat').hide();
+                $('#message-chat-over').show();
+                $('#chatroom-infobox').show();
+                $('#first-user-left-panel input').attr('disabled', true);
+                //if ($('#table-movie-selector').is(':visible'))
+                //    $('#console').hide();
+                $('#notification').hide();
+                $('#messages').prop('scrollTop', 1000000);
+            }
+            // Show the chatbox in the case where the page is reloaded
+            // when the conversation is over.
+            $('#chatbox-wrapper').show();
+            // Leave the chatroom immediately.
+            $.ajax({
+                url: "leave",
+                data: {
+                    clientTabId: clientTabId,
+                    chatroom: chatroomId,
+                    call: 1
+                },
+                success: function(data) {
+                    needsPolling = false;
+                    if (pollXhr != null) {
+                        pollXhr.abort();
+                        pollXhr = null;
+                    }
+                }
+            });
+        }
+    }
+
+    updateModel(data);
+    updateView();
+
+    if (events.length > 0){
+        if (events[events.length - 1].from == 'other' && events[events.length - 1].type == 'msg') {
+            if (isFirstUser) $('#notification').html(
+                '<p class="msg-info">' +
+                '対話中に少なくとも２回「世間のコメント」を利用しながら自然に対話してください。<br>' +
+                '「世間のコメント」を使用するときは、使用するコメントに<img src="static/images/check_mark.png" width="13px">を入れてください。' +
+                '(<span style="font-size:85%">※<img src="static/images/check_mark.png" width="11px">を入れたコメントが自動的に入力されるわけではありません。)</spanstyle>' +
+                '</p>');
+            else $('#notification').html('<p class="msg-info">あなたから発話してください</p>');
+        }
+    }
+}
+
 function pollServer() {
     pollXhr = $.ajax({
         url: "chatroom",
@@ -212,10 +284,12 @@ function pollServer() {
             clientTabId: clientTabId,
             id: chatroomId,
             timestamp: chatroomTimestamp,
+            cursor: eventCursor,
         },
         timeout: timeoutInMs,
         success: function(result) {
-            var data = JSON.parse(result);
+            // The responses are JSON objects (strings holding JSON from older servers).
+            var data = (typeof result === 'string') ? JSON.parse(result) : result;
             console.dir(data);
             // In the case that the polling request is done just after that the chatroom has been
             // deallocated on the server, the result might be empty so just ignore it.
@@ -226,7 +300,6 @@ function pollServer() {
             // if ('chosenTopic' in data)
             //     $('.topic').text(data['chosenTopic']);
 
-            var needsPolling = true;
             if ('msg' in data && data.msg == "poll expired") {
                 // The poll request has expired and has not produced anything.
                 // Let's poll again.
@@ -234,67 +307,8 @@ function pollServer() {
                     pollServer();
                 return;
             }
-            else if ('users' in data && data.users.length > 1) {
-                if (!isDialogStarted) {
-                    startDialog();
-                }
-            }
-            else {
-                console.log('data.closed='+data.closed+ ' stopChatConfirmed='+stopChatConfirmed);
-                if (data.closed) {
-                    isLeaving = true;
-                    $('#message-waiting').hide();
-                    $('#notification').css({visibility: 'hidden'});
-                    $('#controls').hide();
-                    $('#chatbox').removeClass('shadowed');
-                    var mainBoxHeight = $('#main-box').css('height');
-                    $('#main-box').css('height', 'calc(' + mainBoxHeight + ' - ' + mainBoxMargin + ')');
-                    if (!stopChatConfirmed) {
-                        $('#stop-chat').hide();
-                        $('#message-chat-over').show();
-                        $('#chatroom-infobox').show();
-                        $('#first-user-left-panel input').attr('disabled', true);
-                        //if ($('#table-movie-selector').is(':visible'))
-                        //    $('#console').hide();
-                        $('#notification').hide();
-                        $('#messages').prop('scrollTop', 1000000);
-                    }
-                    // Show the chatbox in the case where the page is reloaded
-                    // when the conversation is over.
-                    $('#chatbox-wrapper').show();
-                    // Leave the chatroom immediately.
-                    $.ajax({
-                        url: "leave",
-                        data: {
-                            clientTabId: clientTabId,
-                            chatroom: chatroomId,
-                            call: 1
-                        },
-                        success: function(data) {
-                            needsPolling = false;
-                            if (pollXhr != null) {
-                                pollXhr.abort();
-                                pollXhr = null;
-                            }
-                        }
-                    });
-                }
-            }
 
-            updateModel(data);
-            updateView();
-
-            if (events.length > 0){
-                if (events[events.length - 1].from == 'other' && events[events.length - 1].type == 'msg') {
-                    if (isFirstUser) $('#notification').html(
-                        '<p class="msg-info">' +
-                        '対話中に少なくとも２回「世間のコメント」を利用しながら自然に対話してください。<br>' +
-                        '「世間のコメント」を使用するときは、使用するコメントに<img src="static/images/check_mark.png" width="13px">を入れてください。' +
-                        '(<span style="font-size:85%">※<img src="static/images/check_mark.png" width="11px">を入れたコメントが自動的に入力されるわけではありません。)</spanstyle>' +
-                        '</p>');
-                    else $('#notification').html('<p class="msg-info">あなたから発話してください</p>');
-                }
-            }
+            handleChatroomData(data);
 
             if (!isLeaving) {
                 pollServer();
@@ -309,6 +323,47 @@ function pollServer() {
     });
 }
 
+// Push transport: the server streams the chatroom changes over a single connection.
+// After a few failed attempts, the client falls back to polling.
+function openEventStream() {
+    eventSource = new EventSource('events?' + $.param({
+        clientTabId: clientTabId,
+        id: chatroomId,
+        cursor: eventCursor == null ? 0 : eventCursor
+    }));
+    eventSource.onmessage = function(e) {
+        pushFailures = 0;
+        var data = JSON.parse(e.data);
+        console.dir(data);
+        handleChatroomData(data);
+    };
+    eventSource.addEventListener('end', function(e) {
+        closeEventStream();
+    });
+    eventSource.onerror = function(e) {
+        console.log('event stream error isLeaving=' + isLeaving);
+        closeEventStream();
+        if (isLeaving)
+            return;
+        pushFailures++;
+        if (pushFailures > 3)
+            pollServer();
+        else
+            setTimeout(openEventStream, 1000);
+    };
+}
+
+function closeEventStream() {
+    if (eventSource != null) {
+        eventSource.close();
+        eventSource = null;
+    }
+}
+
+function usePushTransport() {
+    return typeof PUSH_TRANSPORT !== 'undefined' && PUSH_TRANSPORT == 'sse' && window.EventSource && pushFailures <= 3;
+}
+
 function sendMsg() {
     var msg = $('#new-msg').val().trim();
     /*let tweets = document.getElementsByClassName("tweet-check");
@@ -354,11 +409,13 @@ function sendMsg() {
             clientTabId: clientTabId,
             chatroom: chatroomId,
             message: msg,
-            tweets: now_tweets
+            tweets: now_tweets,
+            cursor: eventCursor
         },
         type: 'POST',
         success: function(result) {
-            var data = JSON.parse(result);
+            // The responses are JSON objects (strings holding JSON from older servers).
+            var data = (typeof result === 'string') ? JSON.parse(result) : result;
             console.dir(data);
             updateModel(data);
             updateView();
@@ -375,7 +432,8 @@ function sendMsg() {
                 showSimpleDialog('注意', '対話が十分な長さになりました。数回のやり取りで自然な形で対話を終了させて下さい。');
                 isTooLongDialogShown = true;
             }
-            pollServer();
+            if (!usePushTransport())
+                pollServer();
         }
     });
 };
@@ -583,7 +641,10 @@ $(document).ready(function() {
     else if (!isFirstUser)
         startDialog();
 
-    pollServer();
+    if (usePushTransport())
+        openEventStream();
+    else
+        pollServer();
 });
 
 console.log('chat.js loaded.');
@@ -0,0 +1,112 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Servers for the tests: a BaseApi (and a BaseApp) per test, with their files in the temporary
+# directory of the test and the background threads stopped at the end.
+#
+#   python -m pytest tests      (in the chat-server directory)
+
+import logging
+from pathlib import Path
+import sys
+
+import pytest
+
+CHAT_SERVER = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(CHAT_SERVER))
+
+from server.base import BaseApi, BaseApp  # noqa: E402
+
+NEWS_JSON = str(CHAT_SERVER / 'used_news' / 'V1.json')
+
+
+def make_cfg(tmp_dir, **options):
+    cfg = {
+        'sessions': f"{tmp_dir}/sessions",
+        # flask_session does not keep the empty sessions of the test clients.
+        'session_store': 'memory',
+        'cookiePath': '/',
+        'archives': f"{tmp_dir}/dialogs",
+        'archive_formats': ["jsonl"],
+        'archive_fsync': "False",
+        'metrics': "False",
+        'web_context': 'ChatCollectionServer',
+        'poll_interval': 2,
+        'delay_for_partner': 3000,
+        'chatroom_cleaning_interval': 3600,
+        'msg_count_low': 6,
+        'msg_count_high': 15,
+        'experiment_id': 0,
+        'number_of_dialog': 1,
+        'crowd_sourcing_url': 'http://localhost/',
+        'urls_path': f"{tmp_dir}/urls.txt",
+        'news_json': NEWS_JSON,
+        'cond_num': 0
+    }
+    cfg.update(options)
+    return cfg
+
+
+def stop_api(api):
+    api.chatroom_cleaner.stop()
+    api.archive_writer.stop()
+    if api.state_store is not None:
+        api.state_watcher.stop()
+    if api.event_log is not None:
+        api.event_log.close()
+
+
+def join_pair(api, system="s1_tab", user="u1_tab"):
+    # A system and a user in the same chatroom; returns its id.
+    chatroom_id = api.join(system, system_or_user="system")['chatroom'].id
+    assert api.join(user, system_or_user="user")['chatroom'].id == chatroom_id
+    return chatroom_id
+
+
+def join_clients(app):
+    # Test clients of a system and a user paired through /join; returns the clients and the chatroom id.
+    clients = [app.test_client(), app.test_client()]
+    for client, role in zip(clients, ("system", "user")):
+        response = client.post(f"/{app.cfg['web_context']}/join",
+                               data={'clientTabId': 'tab', 'systemOrUser': role, 'newsNum': 0})
+        assert response.status_code == 200
+    chatroom = next(iter(app.api.chatrooms.values()))
+    return clients, chatroom.id
+
+
+@pytest.fixture
+def make_api(tmp_path):
+    apis = []
+
+    def make(**options):
+        api = BaseApi(make_cfg(tmp_path, **options), logging.getLogger('test'))
+        apis.append(api)
+        return api
+
+    yield make
+    for api in apis:
+        if api.archive_writer.is_alive():
+            stop_api(api)
+
+
+@pytest.fixture
+def api(make_api):
+    return make_api()
+
+
+@pytest.fixture
+def app(api, monkeypatch):
+    # The templates and the static files are found from the working directory.
+    monkeypatch.chdir(CHAT_SERVER)
+    return BaseApp('chat_server_test', api)
+
+
+@pytest.fixture
+def pair():
+    return join_pair
+
+
+@pytest.fixture
+def clients(app):
+    return join_clients(app)
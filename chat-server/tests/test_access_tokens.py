@@ -0,0 +1,61 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# The tokens of the crowd sourcing URLs, checked with the HMAC of the server secret.
+
+import re
+
+from server.base import AccessTokens, load_url_secret
+from server.urls import generate_urls
+
+
+def test_tokens():
+    tokens = AccessTokens(b"secret", 126)
+    token = tokens.make("system", 42)
+    assert token.startswith("42.")
+    assert tokens.check("system", token)
+    assert AccessTokens(b"secret", 126).check("system", token)
+    # Another role, experiment or secret.
+    assert not tokens.check("user", token)
+    assert not AccessTokens(b"secret", 127).check("system", token)
+    assert not AccessTokens(b"other secret", 126).check("system", token)
+    # Another index with the same MAC, tampered or malformed tokens.
+    mac = token.partition(".")[2]
+    for tampered in (f"43.{mac}", token[:-1] + ("A" if token[-1] != "A" else "B"), "42", "", f"-42.{mac}",
+                     f"x.{mac}", f"{'9' * 19}.{mac}"):
+        assert not tokens.check("system", tampered)
+
+
+def test_secret_is_shared(tmp_path):
+    cfg = {'sessions': str(tmp_path / "sessions")}
+    secret = load_url_secret(cfg)
+    assert secret == load_url_secret(cfg)
+    assert (tmp_path / "sessions" / "url_secret").read_text().strip().encode('utf-8') == secret
+    assert load_url_secret(dict(cfg, url_secret="configured")) == b"configured"
+
+
+def test_generated_urls(app):
+    urls = list(generate_urls(app.cfg, 10, 3))
+    assert len(urls) == 6
+    tokens = [re.fullmatch(r"http://localhost/(system|user)_index_(\S+)\n", url).groups() for url in urls]
+    assert [role for role, _ in tokens] == ["system"] * 3 + ["user"] * 3
+    assert [token.partition(".")[0] for _, token in tokens] == ["10", "11", "12"] * 2
+    assert all(app.access_tokens.check(role, token) for role, token in tokens)
+
+
+def test_index_pages(app):
+    client = app.test_client()
+    (_, system_token), (_, user_token) = [
+        re.search(r"(system|user)_index_(\S+)", url).groups() for url in generate_urls(app.cfg, 0, 1)]
+
+    def get_index(role, token):
+        response = client.get(f"/{app.cfg['web_context']}/{role}_index_{token}")
+        assert response.status_code == 200
+        return response.get_data(as_text=True)
+
+    assert "hidden_news_num" in get_index("system", system_token)
+    assert "validateForm" in get_index("user", user_token)
+    for role, token in (("system", user_token), ("user", system_token), ("system", "0.invalid")):
+        page = get_index(role, token)
+        assert "hidden_news_num" not in page and "validateForm" not in page
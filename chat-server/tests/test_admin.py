@@ -0,0 +1,68 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# The admin API: /admin/chatrooms by pages of the admin index, and /admin/counters.
+
+
+def get_json(client, app, path, expected_status=200, **params):
+    response = client.get(f"/{app.cfg['web_context']}/admin/{path}", query_string=params)
+    assert response.status_code == expected_status
+    return response.get_json() if expected_status == 200 else None
+
+
+def make_chatrooms(api, pair):
+    # 3 active chatrooms, the first one released, and a waiting one.
+    chatroom_ids = [pair(api, f"s{i}_tab", f"u{i}_tab") for i in range(3)]
+    api.post_message("s1_tab", chatroom_ids[1], "hello", "")
+    api.leave_chatroom("s0_tab", chatroom_ids[0], "", "")
+    api.leave_chatroom("u0_tab", chatroom_ids[0], "", "")
+    chatroom_ids.append(api.join("s3_tab", system_or_user="system")['chatroom'].id)
+    return chatroom_ids
+
+
+def test_pages(app, pair):
+    chatroom_ids = make_chatrooms(app.api, pair)
+    client = app.test_client()
+    ids = []
+    cursor = ""
+    while cursor is not None:
+        page = get_json(client, app, "chatrooms", limit=3, cursor=cursor)
+        assert len(page["chatrooms"]) <= 3
+        ids += [entry["id"] for entry in page["chatrooms"]]
+        cursor = page["next_cursor"]
+    assert ids == chatroom_ids
+    page = get_json(client, app, "chatrooms", order="desc", limit=2)
+    assert [entry["id"] for entry in page["chatrooms"]] == chatroom_ids[:1:-1]
+    page = get_json(client, app, "chatrooms", order="desc", cursor=page["next_cursor"])
+    assert [entry["id"] for entry in page["chatrooms"]] == chatroom_ids[1::-1]
+    assert page["next_cursor"] is None
+
+
+def test_entries_and_filters(app, pair):
+    chatroom_ids = make_chatrooms(app.api, pair)
+    client = app.test_client()
+    entries = {entry["id"]: entry for entry in get_json(client, app, "chatrooms")["chatrooms"]}
+    assert [entries[chatroom_id]["state"] for chatroom_id in chatroom_ids] == [
+        "released", "active", "active", "waiting"]
+    assert entries[chatroom_ids[1]]["messages"] == 1
+    assert entries[chatroom_ids[1]]["users"] == ["s1_tab", "u1_tab"]
+    assert entries[chatroom_ids[0]]["released"] is not None
+    page = get_json(client, app, "chatrooms", state="waiting,released")
+    assert [entry["id"] for entry in page["chatrooms"]] == [chatroom_ids[0], chatroom_ids[3]]
+    assert get_json(client, app, "chatrooms", experiment_id="1")["chatrooms"] == []
+    assert get_json(client, app, "chatrooms", until="2000-01-01T00:00:00")["chatrooms"] == []
+    assert len(get_json(client, app, "chatrooms", since="2000-01-01T00:00:00")["chatrooms"]) == 4
+    for params in ({'limit': "0"}, {'limit': "x"}, {'cursor': "x"}, {'order': "random"}, {'state': "closed"}):
+        get_json(client, app, "chatrooms", 400, **params)
+
+
+def test_counters(app, pair):
+    make_chatrooms(app.api, pair)
+    client = app.test_client()
+    counters = get_json(client, app, "counters")
+    assert counters["chatrooms"] == {"waiting": 1, "active": 2, "released": 1}
+    assert counters["created"] == 4
+    assert counters["released"] == 1
+    assert counters["messages"] == 1
+    assert get_json(client, app, "chatrooms", limit=1)["counters"] == counters
@@ -0,0 +1,78 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# The /chatroom long polling of the ASGI mode (server/asgi.py).
+
+import asyncio
+import json
+
+from server.asgi import BaseAsgiApp
+
+
+async def call(asgi_app, path, query, cookie=None):
+    # Calls asgi_app with a GET request; returns the status and the body of the response.
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode('latin-1'),
+             'headers': [(b'cookie', f"{asgi_app.cookie_name}={cookie}".encode('latin-1'))] if cookie else []}
+    messages = []
+
+    async def receive():
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+
+def test_poll_woken_by_post(app, pair):
+    asgi_app = BaseAsgiApp(app)
+    chatroom_id = pair(app.api, "s1_tab", "u1_tab")
+    timestamp = app.api.chatrooms[chatroom_id].snapshot.modified
+
+    async def run():
+        poll = asyncio.ensure_future(call(asgi_app, asgi_app.chatroom_path,
+                                          f"clientTabId=tab&id={chatroom_id}&timestamp={timestamp}", "u1"))
+        await asyncio.sleep(0.05)
+        assert not poll.done()
+        app.api.post_message("s1_tab", chatroom_id, "hello", "")
+        return await asyncio.wait_for(poll, 1)
+
+    status, body = asyncio.run(run())
+    assert status == 200
+    assert [evt['body'] for evt in json.loads(body)['latestEvents']] == ["hello"]
+    assert asgi_app.room_futures == {}
+
+
+def test_poll_without_session_cookie(app, pair):
+    asgi_app = BaseAsgiApp(app)
+    chatroom_id = pair(app.api)
+    status, _ = asyncio.run(call(asgi_app, asgi_app.chatroom_path, f"clientTabId=tab&id={chatroom_id}&timestamp="))
+    assert status == 401
+    status, _ = asyncio.run(call(asgi_app, asgi_app.events_path, f"clientTabId=tab&id={chatroom_id}"))
+    assert status == 401
+
+
+def test_expired_and_cancelled_polls_leave_nothing(app, pair):
+    asgi_app = BaseAsgiApp(app)
+    chatroom_id = pair(app.api, "s1_tab", "u1_tab")
+    chatroom = app.api.chatrooms[chatroom_id]
+    timestamp = chatroom.snapshot.modified
+
+    async def run():
+        expired = [asgi_app.wait_for_chatroom(chatroom_id, user_id, timestamp, 0.05)
+                   for user_id in ("s1_tab", "u1_tab")]
+        assert await asyncio.gather(*expired) == ["expired", "expired"]
+        assert asgi_app.room_futures == {}
+        assert chatroom.change_listeners == []
+
+        cancelled = asyncio.ensure_future(asgi_app.wait_for_chatroom(chatroom_id, "u1_tab", timestamp, 10))
+        await asyncio.sleep(0.05)
+        assert len(chatroom.change_listeners) == 1
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert asgi_app.room_futures == {}
+        assert chatroom.change_listeners == []
+
+    asyncio.run(run())
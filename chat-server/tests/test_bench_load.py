@@ -0,0 +1,79 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# The load-testing harness of benchmarks/bench_load.py, replaying a few dialogs against a server of the test.
+
+import argparse
+import io
+import sys
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+from conftest import CHAT_SERVER
+from server.urls import write_urls
+
+sys.path.insert(0, str(CHAT_SERVER / 'benchmarks'))
+
+from bench_load import LoadTest, load_dialogs, percentiles, read_uids  # noqa: E402
+
+CORPUS = str(CHAT_SERVER.parent / 'V1.jsonl')
+
+
+@pytest.fixture
+def server_url(app):
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/{app.cfg['web_context']}"
+    server.shutdown()
+    thread.join()
+
+
+def make_args(**options):
+    args = dict(pairs=2, time_scale=0.0, typing_speed=4.0, reading_speed=20.0, arrival_delay=0.1, ramp_up=0.1,
+                pair_timeout=10.0, stall_timeout=10.0, seed=0)
+    args.update(options)
+    return argparse.Namespace(**args)
+
+
+def test_percentiles():
+    assert percentiles([]) == {}
+    latencies = percentiles([float(i) for i in range(100, 0, -1)])
+    assert latencies == {"n": 100, "p50": 51.0, "p90": 91.0, "p99": 100.0, "max": 100.0}
+
+
+def test_load_dialogs():
+    dialogs = load_dialogs(CORPUS, 5, 0)
+    assert len(dialogs) == 5
+    assert dialogs == load_dialogs(CORPUS, 5, 0)
+    assert all(dialog['dialog'] and 'tweet_choices' in dialog for dialog in dialogs)
+
+
+def test_replay(app, server_url, tmp_path):
+    urls = io.StringIO()
+    write_urls(app.cfg, urls, 0, 1)
+    urls_path = tmp_path / "urls.txt"
+    urls_path.write_text(urls.getvalue())
+    uids = read_uids(urls_path)
+    assert set(uids) == {"system", "user"}
+
+    dialogs = load_dialogs(CORPUS, 4, 0)
+    test = LoadTest(make_args(), server_url, uids, dialogs)
+    report = test.stats.to_dict(test.run())
+    assert report["errors"] == {}
+    assert report["outcomes"] == {"completed": 4}
+    # Of both bots of each dialog.
+    assert report["pairing_latency"]["n"] == 8
+    # Every utterance is delivered to the partner.
+    assert report["delivery_latency"]["n"] == sum(len(dialog['dialog']) for dialog in dialogs)
+    assert set(report["request_latency"]) >= {"system_index", "user_index", "join", "post", "chatroom", "leave"}
+
+    # The dialogs replayed are archived as they were in the corpus.
+    archived = {chatroom.id: chatroom for chatroom in app.api.released_chatrooms.values()}
+    assert len(archived) == 4
+    for chatroom_id, script in test.scripts.items():
+        messages = [evt for evt in archived[chatroom_id].events if evt.get('type') == 'msg']
+        assert [evt['body'] for evt in messages] == [turn['utterance'] for turn in script['dialog']]
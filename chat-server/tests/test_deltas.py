@@ -0,0 +1,62 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Event deltas of /chatroom and /post: clients that pass a cursor only receive the newer events.
+
+
+def poll(app, client, chatroom_id, cursor=None):
+    params = {'clientTabId': 'tab', 'id': chatroom_id, 'timestamp': ''}
+    if cursor is not None:
+        params['cursor'] = cursor
+    response = client.get(f"/{app.cfg['web_context']}/chatroom", query_string=params)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def post(app, client, chatroom_id, message, cursor=None):
+    data = {'clientTabId': 'tab', 'chatroom': chatroom_id, 'message': message, 'tweets': ""}
+    if cursor is not None:
+        data['cursor'] = cursor
+    return client.post(f"/{app.cfg['web_context']}/post", data=data).get_json()
+
+
+def bodies(data):
+    return [evt['body'] for evt in data['latestEvents']]
+
+
+def test_cursor_returns_newer_events(app, clients):
+    (system, user), chatroom_id = clients
+    for i in range(3):
+        post(app, system, chatroom_id, f"message {i}")
+
+    full = poll(app, user, chatroom_id)
+    assert bodies(full) == ["message 0", "message 1", "message 2"]
+    assert (full['cursor'], full['full']) == (3, True)
+
+    post(app, user, chatroom_id, "message 3")
+    delta = poll(app, system, chatroom_id, cursor=3)
+    assert bodies(delta) == ["message 3"]
+    assert (delta['cursor'], delta['full']) == (4, False)
+    assert delta['latestEvents'][0]['from'] == "other"
+
+    empty = poll(app, system, chatroom_id, cursor=4)
+    assert (bodies(empty), empty['cursor']) == ([], 4)
+
+
+def test_unusable_cursor_returns_all_events(app, clients):
+    (system, user), chatroom_id = clients
+    post(app, system, chatroom_id, "message 0")
+    for cursor in ("5", "-1", "x", "0"):
+        data = poll(app, user, chatroom_id, cursor=cursor)
+        assert bodies(data) == ["message 0"]
+        assert data['full']
+
+
+def test_post_returns_delta(app, clients):
+    (system, user), chatroom_id = clients
+    post(app, system, chatroom_id, "message 0")
+    data = post(app, user, chatroom_id, "message 1", cursor=1)
+    assert bodies(data) == ["message 1"]
+    assert data['latestEvents'][0]['from'] == "self"
+    assert data['cursor'] == 2
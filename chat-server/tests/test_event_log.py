@@ -0,0 +1,103 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# The write-ahead event log: the chatrooms of a server are recovered by the next one.
+
+import json
+
+from conftest import stop_api
+from server.base import EventLog
+
+
+def read_archives(path):
+    return {record['dialog_id']: record for shard in sorted(path.glob("*.jsonl"))
+            for record in map(json.loads, shard.read_text(encoding='utf-8').splitlines())}
+
+
+def read_log(path):
+    return [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+
+
+def test_recovery_after_restart(make_api, pair, tmp_path):
+    event_log = str(tmp_path / "events.log")
+    api = make_api(event_log=event_log)
+    live_id = pair(api, "s1_tab", "u1_tab")
+    news = ["title", "https://example.com/news"]
+    tweets = [["tweet", "1"]]
+    api.set_news(live_id, news, tweets)
+    api.post_message("s1_tab", live_id, "hello", "0")
+    api.post_message("u1_tab", live_id, "hi", "")
+    finished_id = pair(api, "s2_tab", "u2_tab")
+    api.post_message("s2_tab", finished_id, "bye", "")
+    api.leave_chatroom("s2_tab", finished_id, "", "")
+    api.leave_chatroom("u2_tab", finished_id, "", "")
+    waiting_id = api.join("s3_tab", system_or_user="system")['chatroom'].id
+    stop_api(api)
+    assert list(read_archives(tmp_path / "dialogs")) == [finished_id]
+
+    restarted = make_api(event_log=event_log, archives=str(tmp_path / "restarted"))
+    # The live chatrooms are served again.
+    assert list(restarted.chatrooms) == [live_id, waiting_id]
+    chatroom = restarted.chatrooms[live_id].snapshot
+    assert chatroom.users == ("s1_tab", "u1_tab")
+    assert chatroom.initiator == "s1_tab"
+    assert chatroom.closed
+    assert [(evt['from'], evt['body']) for evt in chatroom.events] == [("s1_tab", "hello"), ("u1_tab", "hi")]
+    assert restarted.chatrooms[live_id].news == news
+    assert restarted.chatrooms[live_id].tweets == tweets
+    assert list(restarted.waiting_chatrooms["user"]) == [waiting_id]
+    assert restarted.session_chatrooms == {"s1": {live_id}, "u1": {live_id}, "s3": {waiting_id}}
+    # The archived chatroom is not recovered.
+    assert finished_id not in restarted.released_chatrooms
+
+    # Their users go on.
+    restarted.post_message("u1_tab", live_id, "again", "")
+    assert restarted.join("u3_tab", system_or_user="user")['chatroom'].id == waiting_id
+    stop_api(restarted)
+    assert read_archives(tmp_path / "restarted") == {}
+
+
+def test_released_chatroom_archived_after_restart(make_api, pair, tmp_path):
+    # The server stopped before the dialog of a released chatroom was archived.
+    event_log = tmp_path / "events.log"
+    api = make_api(event_log=str(event_log))
+    chatroom_id = pair(api)
+    api.post_message("s1_tab", chatroom_id, "hello", "")
+    api.leave_chatroom("s1_tab", chatroom_id, "", "")
+    api.leave_chatroom("u1_tab", chatroom_id, "", "")
+    stop_api(api)
+    records = [record for record in read_log(event_log) if record['op'] != "archived"]
+    event_log.write_text("".join(json.dumps(record) + "\n" for record in records), encoding='utf-8')
+
+    restarted = make_api(event_log=str(event_log), archives=str(tmp_path / "restarted"))
+    assert restarted.chatrooms == {}
+    assert chatroom_id in restarted.released_chatrooms
+    stop_api(restarted)
+    archived = read_archives(tmp_path / "restarted")
+    assert [turn['utterance'] for turn in archived[chatroom_id]['dialog']] == ["hello"]
+    assert {"op": "archived", "ids": [chatroom_id]} in read_log(event_log)
+
+
+def test_torn_line_is_truncated(tmp_path):
+    path = tmp_path / "events.log"
+    lines = [json.dumps({'op': "post", 'id': "c1", 'event': {}}), json.dumps({'op': "post", 'id': "c2", 'event': {}})]
+    path.write_text(lines[0] + "\n" + lines[1][:10], encoding='utf-8')
+    event_log = EventLog(str(path), fsync=False)
+    assert [record['id'] for record in event_log.replay()] == ["c1"]
+    assert path.read_text(encoding='utf-8') == lines[0] + "\n"
+    event_log.close()
+
+
+def test_compaction(tmp_path):
+    path = tmp_path / "events.log"
+    event_log = EventLog(str(path), fsync=False, compaction_size=0)
+    for chatroom_id in ("c1", "c2"):
+        event_log.commit(event_log.append({'op': "post", 'id': chatroom_id, 'event': {}}))
+    event_log.archived(["c1"])
+    assert [record['id'] for record in read_log(path)] == ["c2"]
+    event_log.commit(event_log.append({'op': "post", 'id': "c3", 'event': {}}))
+    event_log.close()
+    event_log = EventLog(str(path))
+    assert [record['id'] for record in event_log.replay()] == ["c2", "c3"]
+    event_log.close()
@@ -0,0 +1,67 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Long polling of BaseApi: a waiting poll returns as soon as the chatroom changes.
+
+import threading
+import time
+
+
+def poll_in_thread(api, chatroom_id, user_id, timestamp):
+    result = {}
+
+    def poll():
+        start = time.perf_counter()
+        result['data'] = api.get_chatroom(chatroom_id, user_id, timestamp)
+        result['elapsed'] = time.perf_counter() - start
+
+    thread = threading.Thread(target=poll)
+    thread.start()
+    return thread, result
+
+
+def test_waiter_wakes_on_post(api, pair):
+    chatroom_id = pair(api)
+    timestamp = api.chatrooms[chatroom_id].snapshot.modified
+    thread, result = poll_in_thread(api, chatroom_id, "u1_tab", timestamp)
+    time.sleep(0.1)
+    assert thread.is_alive()
+    api.post_message("s1_tab", chatroom_id, "hello", "")
+    thread.join(1)
+    assert not thread.is_alive()
+    # Woken by the post, well before poll_interval (2 s).
+    assert result['elapsed'] < 1
+    assert [evt['body'] for evt in result['data']['chatroom'].events] == ["hello"]
+
+
+def test_changed_chatroom_returns_at_once(api, pair):
+    chatroom_id = pair(api)
+    api.post_message("s1_tab", chatroom_id, "hello", "")
+    data = api.wait_for_chatroom(chatroom_id, "u1_tab", "2000-01-01T00:00:00", 10)
+    assert len(data['chatroom'].events) == 1
+    assert api.wait_for_chatroom(chatroom_id, "u1_tab", None, 10)['chatroom'].id == chatroom_id
+
+
+def test_waiter_expires(api, pair):
+    chatroom_id = pair(api)
+    timestamp = api.chatrooms[chatroom_id].snapshot.modified
+    start = time.perf_counter()
+    assert api.wait_for_chatroom(chatroom_id, "u1_tab", timestamp, 0.1) == "expired"
+    assert 0.1 <= time.perf_counter() - start < 1
+
+
+def test_waiter_wakes_when_partner_leaves(api, pair):
+    chatroom_id = pair(api)
+    timestamp = api.chatrooms[chatroom_id].snapshot.modified
+    thread, result = poll_in_thread(api, chatroom_id, "u1_tab", timestamp)
+    time.sleep(0.1)
+    api.leave_chatroom("s1_tab", chatroom_id, "", "")
+    thread.join(1)
+    assert not thread.is_alive()
+    assert result['elapsed'] < 1
+    assert result['data']['chatroom'].closed
+
+
+def test_waiter_of_unknown_chatroom(api):
+    assert api.wait_for_chatroom("unknown", "u1_tab", None, 10) is None
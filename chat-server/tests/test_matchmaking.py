@@ -0,0 +1,70 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Matchmaking of BaseApi.join through the waiting queues (waiting_chatrooms) and the chatrooms
+# of each session (session_chatrooms).
+
+from server.base import BaseUser
+
+
+def join(api, user_id, role):
+    return api.join(user_id, system_or_user=role)['chatroom']
+
+
+def test_oldest_waiting_chatroom_first(api):
+    first = join(api, "s1_tab", "system")
+    second = join(api, "s2_tab", "system")
+    assert first.id != second.id
+    assert list(api.waiting_chatrooms["user"]) == [first.id, second.id]
+    assert join(api, "u1_tab", "user").id == first.id
+    assert join(api, "u2_tab", "user").id == second.id
+    assert api.waiting_chatrooms == {"system": {}, "user": {}}
+    assert set(api.chatrooms[first.id].users) == {"s1_tab", "u1_tab"}
+
+
+def test_user_waits_for_system(api):
+    chatroom = join(api, "u1_tab", "user")
+    assert list(api.waiting_chatrooms["system"]) == [chatroom.id]
+    # A second user does not join the chatroom of the first one.
+    assert join(api, "u2_tab", "user").id != chatroom.id
+    assert join(api, "s1_tab", "system").id == chatroom.id
+    assert api.chatrooms[chatroom.id].initiator == "s1_tab"
+
+
+def test_left_waiting_chatroom_is_not_matched(api):
+    chatroom = join(api, "s1_tab", "system")
+    assert api.session_chatrooms == {"s1": {chatroom.id}}
+    api.leave_chatroom("s1_tab", chatroom.id, "", "")
+    assert api.waiting_chatrooms["user"] == {}
+    assert api.session_chatrooms == {}
+    assert chatroom.id not in api.chatrooms
+    assert join(api, "u1_tab", "user").id != chatroom.id
+
+
+def test_session_chatrooms_cleanup(api, pair):
+    chatroom_id = pair(api, "s1_tab", "u1_tab")
+    assert api.session_chatrooms == {"s1": {chatroom_id}, "u1": {chatroom_id}}
+    api.leave_chatroom("s1_tab", chatroom_id, "", "")
+    assert api.session_chatrooms == {"u1": {chatroom_id}}
+    api.leave_chatroom("u1_tab", chatroom_id, "", "")
+    assert api.session_chatrooms == {}
+    assert chatroom_id in api.released_chatrooms
+
+
+def test_multiple_tabs(make_api):
+    api = make_api(prevent_multiple_tabs="True")
+    join(api, "s1_tab1", "system")
+    assert api.join("s1_tab2", system_or_user="system").startswith("Error: MultipleTabAccessForbidden")
+
+
+def test_attributes_must_match(api):
+    class TeamUser(BaseUser):
+        def has_matching_attribs(self, other):
+            return api.users[other].attribs["team"] == self.attribs["team"]
+
+    api.user_class = TeamUser
+    red = api.join("s1_tab", {"team": "red"}, "system")['chatroom']
+    blue = api.join("s2_tab", {"team": "blue"}, "system")['chatroom']
+    assert api.join("u1_tab", {"team": "blue"}, "user")['chatroom'].id == blue.id
+    assert api.join("u2_tab", {"team": "red"}, "user")['chatroom'].id == red.id
@@ -0,0 +1,82 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# /metrics in the Prometheus text format, recorded by the hot paths of the server.
+
+import pytest
+
+from conftest import CHAT_SERVER, join_clients
+from server.base import BaseApp, Metrics
+
+
+@pytest.fixture
+def metrics_app(make_api, monkeypatch):
+    monkeypatch.chdir(CHAT_SERVER)
+    return BaseApp('chat_server_test', make_api(metrics="True", metrics_lock_sample_rate=1.0))
+
+
+def get_samples(app):
+    # Values by sample ("name{labels}"), and the types of the families.
+    response = app.test_client().get(f"/{app.cfg['web_context']}/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    samples = {}
+    types = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            types[name] = kind
+        elif not line.startswith("#"):
+            sample, value = line.rsplit(" ", 1)
+            samples[sample] = float(value)
+    return samples, types
+
+
+def test_metrics_of_requests(metrics_app):
+    app = metrics_app
+    (system, user), chatroom_id = join_clients(app)
+    response = user.post(f"/{app.cfg['web_context']}/post",
+                         data={'clientTabId': 'tab', 'chatroom': chatroom_id, 'message': "hello", 'tweets': ""})
+    assert response.status_code == 200
+    response = system.get(f"/{app.cfg['web_context']}/chatroom",
+                          query_string={'clientTabId': 'tab', 'id': chatroom_id, 'timestamp': ''})
+    assert response.status_code == 200
+    samples, types = get_samples(app)
+    assert types['chat_request_duration_seconds'] == 'histogram'
+    assert types['chat_long_polls_total'] == 'counter'
+    assert types['chat_chatrooms'] == 'gauge'
+    assert samples['chat_request_duration_seconds_count{endpoint="/join"}'] == 2
+    assert samples['chat_request_duration_seconds_count{endpoint="/post"}'] == 1
+    assert samples['chat_request_duration_seconds_count{endpoint="/chatroom"}'] == 1
+    assert samples['chat_request_duration_seconds_bucket{endpoint="/join",le="+Inf"}'] == 2
+    assert samples['chat_long_polls_total{outcome="changed"}'] == 1
+    assert samples['chat_long_poll_wait_seconds_count'] == 1
+    assert samples['chat_chatrooms{state="live"}'] == 1
+    assert samples['chat_users'] == 2
+    assert samples['chat_lock_wait_seconds_count{lock="mutex"}'] > 0
+
+
+def test_histogram_buckets():
+    metrics = Metrics()
+    histogram = metrics.histogram('test_seconds', "Test.", (0.1, 1.0), path="/a\"b")
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value)
+    lines = metrics.render().splitlines()
+    assert lines == [
+        "# HELP test_seconds Test.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{path="/a\\"b",le="0.1"} 1',
+        'test_seconds_bucket{path="/a\\"b",le="1.0"} 3',
+        'test_seconds_bucket{path="/a\\"b",le="+Inf"} 4',
+        'test_seconds_sum{path="/a\\"b"} 6.05',
+        'test_seconds_count{path="/a\\"b"} 4',
+    ]
+
+
+def test_disabled_metrics(app):
+    # metrics is "False" in the configuration of the tests.
+    assert not app.api.metrics.enabled
+    assert app.api.metrics.families == {}
+    response = app.test_client().get(f"/{app.cfg['web_context']}/metrics")
+    assert response.status_code == 404
@@ -0,0 +1,65 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# The news and tweets of cfg["news_json"], loaded once by NewsCatalog and reloaded when the file is modified.
+
+import json
+import os
+
+from markupsafe import Markup
+
+from conftest import NEWS_JSON
+from server.base import NewsCatalog
+
+
+def write_news(path, entries, mtime_ns=None):
+    path.write_text(json.dumps(entries), encoding='utf-8')
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_items_of_news_json():
+    with open(NEWS_JSON) as rf:
+        entries = json.load(rf)
+    catalog = NewsCatalog(NEWS_JSON)
+    items = catalog.get_items()
+    assert len(items) == len(entries)
+    assert items[0].news == (entries[0]["title"], entries[0]["url"])
+    assert [tid for _, tid in items[0].tweets] == [tid for _, tid in entries[0]["tweets"]]
+    assert json.loads(items[0].news_json) == list(items[0].news)
+    assert json.loads(items[0].tweets_json) == items[0].tweets
+    # Loaded once.
+    assert catalog.get_items() is items
+
+
+def test_tweets_are_unescaped(tmp_path):
+    path = tmp_path / "news.json"
+    write_news(path, [{"title": "title", "url": "https://example.com/news",
+                       "tweets": [["a &gt; b &amp;&amp; c &lt; d", "1"]]}])
+    item = NewsCatalog(str(path)).get_items()[0]
+    assert item.tweets == [["a > b && c < d", "1"]]
+    # Safe in a <script> element of the templates.
+    assert isinstance(item.tweets_json, Markup)
+    assert "<" not in item.tweets_json and ">" not in item.tweets_json
+    assert json.loads(item.tweets_json) == item.tweets
+
+
+def test_reload_when_modified(tmp_path):
+    path = tmp_path / "news.json"
+    entry = {"title": "first", "url": "https://example.com/first", "tweets": [["tweet", "1"]]}
+    write_news(path, [entry], 1_000_000_000_000_000_000)
+    catalog = NewsCatalog(str(path))
+    items = catalog.get_items()
+    assert [item.news[0] for item in items] == ["first"]
+    assert catalog.get_items() is items
+    write_news(path, [entry, dict(entry, title="second")], 1_000_000_001_000_000_000)
+    assert [item.news[0] for item in catalog.get_items()] == ["first", "second"]
+
+
+def test_join_sets_news_of_catalog(app, clients):
+    _, chatroom_id = clients
+    news_item = app.news_catalog.get_items()[0]
+    chatroom = app.api.chatrooms[chatroom_id]
+    assert chatroom.news == news_item.news
+    assert chatroom.tweets == news_item.tweets
@@ -0,0 +1,84 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# The JSON of the chatroom responses, built from the snapshot and the events encoded for each user.
+
+import json
+
+from server.base import events_for_user
+
+MESSAGES = ["hello", "こんにちは", 'quotes " and \\ backslash', "new\nline", "</script>"]
+
+
+def expected_response(data, user_id, cursor):
+    # The payload as it was encoded with json.dumps of a dict, with the settings of the chatroom.
+    chatroom = data['chatroom']
+    if cursor is None or cursor > len(chatroom.events):
+        cursor = 0
+    return {
+        'id': chatroom.id,
+        'experimentId': chatroom.experiment_id,
+        'users': list(chatroom.users),
+        'created': chatroom.created,
+        'modified': chatroom.modified,
+        'initiator': "self" if chatroom.initiator == user_id else "other",
+        'closed': chatroom.closed,
+        'msg_count_low': data['msg_count_low'],
+        'msg_count_high': data['msg_count_high'],
+        'poll_interval': data['poll_interval'],
+        'delay_for_partner': data['delay_for_partner'],
+        'latestEvents': [events_for_user(evt, user_id) for evt in chatroom.events[cursor:]],
+        'cursor': len(chatroom.events),
+        'full': cursor == 0
+    }
+
+
+def test_response_matches_payload(app, pair):
+    api = app.api
+    chatroom_id = pair(api)
+    for i, message in enumerate(MESSAGES):
+        api.post_message("s1_tab" if i % 2 == 0 else "u1_tab", chatroom_id, message, "")
+    for user_id in ("s1_tab", "u1_tab"):
+        data = api.get_chatroom(chatroom_id, user_id, None)
+        for cursor in (None, 0, 2, len(MESSAGES), len(MESSAGES) + 1):
+            response = app._get_chatroom_response(user_id, data, cursor)
+            assert json.loads(response) == expected_response(data, user_id, cursor)
+            # As with ensure_ascii=False.
+            assert "\\u" not in response
+
+
+def test_encoded_events_are_cached(app, pair):
+    api = app.api
+    chatroom_id = pair(api)
+    api.post_message("s1_tab", chatroom_id, "hello", "")
+    data = api.get_chatroom(chatroom_id, "u1_tab", None)
+    app._get_chatroom_response("u1_tab", data, None)
+    encoded = data['chatroom'].encoded_events["u1_tab"]
+    assert [json.loads(evt)['from'] for evt in encoded] == ["other"]
+
+    # The events of the newer snapshots are encoded once, for each user.
+    api.post_message("u1_tab", chatroom_id, "hi", "")
+    data = api.get_chatroom(chatroom_id, "u1_tab", None)
+    assert json.loads(app._get_chatroom_response("u1_tab", data, 1)) == expected_response(data, "u1_tab", 1)
+    cached = data['chatroom'].encoded_events["u1_tab"]
+    assert cached[0] is encoded[0]
+    assert [json.loads(evt)['from'] for evt in cached] == ["other", "self"]
+    assert "s1_tab" not in data['chatroom'].encoded_events
+
+
+def test_responses_of_endpoints(app, clients):
+    (system, user), chatroom_id = clients
+    response = system.post(f"/{app.cfg['web_context']}/post",
+                           data={'clientTabId': 'tab', 'chatroom': chatroom_id, 'message': MESSAGES[1], 'tweets': ""})
+    assert response.mimetype == 'application/json'
+    payload = response.get_json()
+    assert [(evt['from'], evt['body']) for evt in payload['latestEvents']] == [("self", MESSAGES[1])]
+    assert payload['initiator'] == "self"
+
+    response = user.get(f"/{app.cfg['web_context']}/chatroom",
+                        query_string={'clientTabId': 'tab', 'id': chatroom_id, 'timestamp': ''})
+    assert response.mimetype == 'application/json'
+    payload = response.get_json()
+    assert [(evt['from'], evt['body']) for evt in payload['latestEvents']] == [("other", MESSAGES[1])]
+    assert (payload['initiator'], payload['full'], payload['msg_count_low']) == ("other", True, 6)
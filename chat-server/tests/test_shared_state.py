@@ -0,0 +1,80 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Shared state: two workers (BaseApi) with the same SQLite state store serve one experiment.
+
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def workers(make_api):
+    return [make_api(state_store="sqlite", state_watch_interval=0.01) for _ in range(2)]
+
+
+def wait_until(api, chatroom_id, user_id, predicate, timeout=2):
+    # Polls the worker until predicate(chatroom snapshot) is true.
+    deadline = time.monotonic() + timeout
+    timestamp = "2000-01-01T00:00:00"
+    while time.monotonic() < deadline:
+        data = api.wait_for_chatroom(chatroom_id, user_id, timestamp, deadline - time.monotonic())
+        if data is None or data == "expired":
+            return data
+        if predicate(data['chatroom']):
+            return data
+        timestamp = data['chatroom'].modified
+    return "expired"
+
+
+def test_users_of_two_workers_are_paired(workers):
+    first, second = workers
+    chatroom_id = first.join("s1_tab", system_or_user="system")['chatroom'].id
+    data = second.join("u1_tab", system_or_user="user")
+    assert data['chatroom'].id == chatroom_id
+    assert data['chatroom'].users == ("s1_tab", "u1_tab")
+    assert first.state_store.increment("cond_id") + 1 == second.state_store.increment("cond_id")
+    # The first worker sees the user joined through the second one.
+    data = wait_until(first, chatroom_id, "s1_tab", lambda chatroom: len(chatroom.users) == 2)
+    assert data['chatroom'].users == ("s1_tab", "u1_tab")
+
+
+def test_messages_are_propagated(workers):
+    first, second = workers
+    chatroom_id = first.join("s1_tab", system_or_user="system")['chatroom'].id
+    second.join("u1_tab", system_or_user="user")
+    timestamp = second.get_chatroom(chatroom_id, "u1_tab", None)['chatroom'].modified
+
+    # A long poll of the second worker is woken by a post on the first one.
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(
+        data=second.wait_for_chatroom(chatroom_id, "u1_tab", timestamp, 2)))
+    thread.start()
+    time.sleep(0.1)
+    first.post_message("s1_tab", chatroom_id, "hello", "")
+    thread.join()
+    assert [evt['body'] for evt in result['data']['chatroom'].events] == ["hello"]
+
+    second.post_message("u1_tab", chatroom_id, "hi", "")
+    data = wait_until(first, chatroom_id, "s1_tab", lambda chatroom: len(chatroom.events) == 2)
+    assert [evt['body'] for evt in data['chatroom'].events] == ["hello", "hi"]
+
+
+def test_leave_through_another_worker(workers):
+    first, second = workers
+    chatroom_id = first.join("s1_tab", system_or_user="system")['chatroom'].id
+    second.join("u1_tab", system_or_user="user")
+    second.leave_chatroom("u1_tab", chatroom_id, "", "")
+    data = wait_until(first, chatroom_id, "s1_tab", lambda chatroom: chatroom.leaved_users)
+    assert data['chatroom'].closed
+    assert data['chatroom'].leaved_users['U2']['user_id'] == "u1_tab"
+    assert data['chatroom'].users == ("s1_tab",)
+
+
+def test_left_waiting_chatroom_is_not_matched(workers):
+    first, second = workers
+    chatroom_id = first.join("s1_tab", system_or_user="system")['chatroom'].id
+    first.leave_chatroom("s1_tab", chatroom_id, "", "")
+    assert second.join("u1_tab", system_or_user="user")['chatroom'].id != chatroom_id
@@ -0,0 +1,72 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Chatroom state read from immutable snapshots, and the narrowed locks of join, post and leave.
+
+import threading
+import time
+
+from server.base import ChatroomSnapshot
+
+
+def test_returned_snapshot_does_not_change(api, pair):
+    chatroom_id = pair(api)
+    api.post_message("s1_tab", chatroom_id, "message 0", "")
+    snapshot = api.get_chatroom(chatroom_id, "u1_tab", None)['chatroom']
+    assert isinstance(snapshot, ChatroomSnapshot)
+    api.post_message("u1_tab", chatroom_id, "message 1", "")
+    api.leave_chatroom("s1_tab", chatroom_id, "", "")
+    assert [evt['body'] for evt in snapshot.events] == ["message 0"]
+    assert snapshot.users == ("s1_tab", "u1_tab")
+    latest = api.chatrooms[chatroom_id].snapshot
+    assert latest.version > snapshot.version
+    assert [evt['body'] for evt in latest.events] == ["message 0", "message 1"]
+    assert latest.users == ("u1_tab",)
+
+
+def test_concurrent_posts_joins_and_leaves(api, pair):
+    # Threads post in their own chatroom while others join and leave: no event is lost.
+    chatroom_ids = [pair(api, f"s{i}_tab", f"u{i}_tab") for i in range(4)]
+    errors = []
+
+    def post(i):
+        try:
+            for k in range(100):
+                api.post_message(f"s{i}_tab" if k % 2 == 0 else f"u{i}_tab", chatroom_ids[i], f"{k}", "")
+        except Exception as e:
+            errors.append(e)
+
+    def join_and_leave(i):
+        # Only systems join, so that the waiting chatrooms of the threads are not matched together.
+        try:
+            for k in range(50):
+                chatroom_id = api.join(f"js{i}-{k}_tab", system_or_user="system")['chatroom'].id
+                api.leave_chatroom(f"js{i}-{k}_tab", chatroom_id, "", "")
+        except Exception as e:
+            errors.append(e)
+
+    threads = ([threading.Thread(target=post, args=(i,)) for i in range(4)] +
+               [threading.Thread(target=join_and_leave, args=(i,)) for i in range(2)])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    for chatroom_id in chatroom_ids:
+        snapshot = api.chatrooms[chatroom_id].snapshot
+        assert [evt['body'] for evt in snapshot.events] == [f"{k}" for k in range(100)]
+    assert set(api.chatrooms) == set(chatroom_ids)
+    assert api.waiting_chatrooms == {"system": {}, "user": {}}
+    assert set(api.session_chatrooms) == {f"{role}{i}" for role in "su" for i in range(4)}
+
+
+def test_cleaner_kicks_out_inactive_users(make_api, pair):
+    # Inactive after 3 poll intervals.
+    api = make_api(poll_interval=0.05)
+    chatroom_id = pair(api)
+    time.sleep(0.3)
+    api.clean_inactive_users()
+    assert chatroom_id not in api.chatrooms
+    assert chatroom_id in api.released_chatrooms
+    assert api.session_chatrooms == {}
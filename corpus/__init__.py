@@ -0,0 +1,5 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Tools for the corpus files (V1.jsonl, V2.jsonl, V3.jsonl, all.jsonl).
@@ -0,0 +1,227 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Columnar binary format for the corpus, and converters from and to the jsonl files.
+#
+# News URLs, tweet ids and tweet_choices lists are interned: a dialog only holds the index of
+# its news and of its (shared) list of choices, and tweet ids are int64.  The utterances of all
+# the dialogs are stored in one contiguous UTF-8 buffer with an offset array, the speakers as a
+# byte array and the used tweets as index arrays.  The file is memory-mapped and every column
+# is a zero-copy memoryview on the mapping.
+#
+#   python -m corpus.columnar to-columnar all.jsonl all.nccf
+#   python -m corpus.columnar to-jsonl all.nccf all.jsonl
+
+import argparse
+from array import array
+import json
+import mmap
+import struct
+import sys
+
+from .reader import Dialog, Utterance, dialog_to_dict, iter_dialogs
+
+
+FILE_MAGIC = b'NCCF'
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct('=4sII')
+
+# Columns, in file order, with their typecodes.
+COLUMNS = {
+    # Interned strings: UTF-8 buffer and n + 1 offsets.
+    'dialog_ids': 'B',
+    'dialog_id_offsets': 'Q',
+    'news_urls': 'B',
+    'news_url_offsets': 'Q',
+    # Interned tweet ids and tweet_choices lists (indexes of tweet_ids, n + 1 offsets).
+    'tweet_ids': 'q',
+    'choice_lists': 'i',
+    'choice_list_offsets': 'Q',
+    # Per dialog: news, list of choices, and n + 1 offsets of its utterances.
+    'dialog_news': 'i',
+    'dialog_choices': 'i',
+    'dialog_utterances': 'Q',
+    # Per utterance: speaker (b'S', b'U'), text (n + 1 offsets), used_tweet field present or not,
+    # and used tweets (indexes of tweet_ids, n + 1 offsets).
+    'speakers': 'B',
+    'texts': 'B',
+    'text_offsets': 'Q',
+    'used_present': 'B',
+    'used_tweets': 'i',
+    'used_offsets': 'Q',
+}
+
+
+class ColumnarWriter(object):
+
+    def __init__(self):
+        self.columns = {name: array(typecode) for name, typecode in COLUMNS.items()}
+        for name in ('dialog_id_offsets', 'news_url_offsets', 'choice_list_offsets', 'dialog_utterances',
+                     'text_offsets', 'used_offsets'):
+            self.columns[name].append(0)
+        self.news_ids = {}
+        self.tweet_ids = {}
+        self.choice_list_ids = {}
+
+    def add(self, dialog):
+        columns = self.columns
+        self._add_string('dialog_ids', dialog.dialog_id)
+        if dialog.news_url not in self.news_ids:
+            self.news_ids[dialog.news_url] = len(self.news_ids)
+            self._add_string('news_urls', dialog.news_url)
+        columns['dialog_news'].append(self.news_ids[dialog.news_url])
+
+        choices = tuple(self._tweet_id(tweet_id) for tweet_id in dialog.tweet_choices)
+        if choices not in self.choice_list_ids:
+            self.choice_list_ids[choices] = len(self.choice_list_ids)
+            columns['choice_lists'].extend(choices)
+            columns['choice_list_offsets'].append(len(columns['choice_lists']))
+        columns['dialog_choices'].append(self.choice_list_ids[choices])
+
+        for utt in dialog.dialog:
+            columns['speakers'].append(ord(utt.speaker))
+            columns['texts'].frombytes(utt.utterance.encode('utf-8'))
+            columns['text_offsets'].append(len(columns['texts']))
+            columns['used_present'].append(utt.used_tweet is not None)
+            columns['used_tweets'].extend(self._tweet_id(tweet_id) for tweet_id in utt.used_tweet or ())
+            columns['used_offsets'].append(len(columns['used_tweets']))
+        columns['dialog_utterances'].append(len(columns['speakers']))
+
+    def write(self, path):
+        directory = {}
+        offset = 0
+        for name in COLUMNS:
+            # Columns are 8-byte aligned.
+            offset += -offset % 8
+            size = len(self.columns[name]) * self.columns[name].itemsize
+            directory[name] = (offset, size)
+            offset += size
+        header = json.dumps({"byteorder": sys.byteorder, "columns": directory}).encode('utf-8')
+        base = FILE_HEADER.size + len(header)
+        base += -base % 8
+        with open(path, 'wb') as output_file:
+            output_file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, len(header)))
+            output_file.write(header)
+            for name in COLUMNS:
+                output_file.write(b'\0' * (base + directory[name][0] - output_file.tell()))
+                self.columns[name].tofile(output_file)
+
+    def _add_string(self, name, value):
+        self.columns[name].frombytes(value.encode('utf-8'))
+        self.columns[f"{name[:-1]}_offsets"].append(len(self.columns[name]))
+
+    def _tweet_id(self, tweet_id):
+        if tweet_id not in self.tweet_ids:
+            self.tweet_ids[tweet_id] = len(self.tweet_ids)
+            self.columns['tweet_ids'].append(int(tweet_id))
+        return self.tweet_ids[tweet_id]
+
+
+class ColumnarCorpus(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_size = FILE_HEADER.unpack_from(self.map)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise ValueError(f"{path} is not a columnar corpus file")
+        header = json.loads(self.map[FILE_HEADER.size:FILE_HEADER.size + header_size])
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError(f"{path} has been written on a {header['byteorder']}-endian machine")
+        base = FILE_HEADER.size + header_size
+        base += -base % 8
+        view = memoryview(self.map)
+        self.columns = {}
+        for name, typecode in COLUMNS.items():
+            offset, size = header['columns'][name]
+            self.columns[name] = view[base + offset:base + offset + size].cast(typecode)
+        view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.columns['dialog_news'])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, i):
+        columns = self.columns
+        tweet_ids = columns['tweet_ids']
+        start, end = columns['dialog_utterances'][i], columns['dialog_utterances'][i + 1]
+        utterances = []
+        for j in range(start, end):
+            used_tweet = None
+            if columns['used_present'][j]:
+                used_tweet = tuple(str(tweet_ids[k]) for k in
+                                   columns['used_tweets'][columns['used_offsets'][j]:columns['used_offsets'][j + 1]])
+            utterances.append(Utterance(chr(columns['speakers'][j]), self.utterance(j), used_tweet))
+        return Dialog(
+            dialog_id=self._string('dialog_ids', i),
+            news_url=self.news_url(columns['dialog_news'][i]),
+            tweet_choices=tuple(str(tweet_ids[k]) for k in self.choice_list(columns['dialog_choices'][i])),
+            dialog=tuple(utterances)
+        )
+
+    def news_url(self, news_id):
+        return self._string('news_urls', news_id)
+
+    def choice_list(self, choice_list_id):
+        offsets = self.columns['choice_list_offsets']
+        return self.columns['choice_lists'][offsets[choice_list_id]:offsets[choice_list_id + 1]]
+
+    def utterance(self, j):
+        offsets = self.columns['text_offsets']
+        return str(self.columns['texts'][offsets[j]:offsets[j + 1]], 'utf-8')
+
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        self.map.close()
+        self.file.close()
+
+    def _string(self, name, i):
+        offsets = self.columns[f"{name[:-1]}_offsets"]
+        return str(self.columns[name][offsets[i]:offsets[i + 1]], 'utf-8')
+
+
+def jsonl_to_columnar(paths, output_path):
+    writer = ColumnarWriter()
+    for path in paths:
+        for dialog in iter_dialogs(path):
+            writer.add(dialog)
+    writer.write(output_path)
+
+
+def columnar_to_jsonl(path, output_path):
+    with ColumnarCorpus(path) as corpus, open(output_path, 'w', encoding='utf-8') as output_file:
+        for dialog in corpus:
+            output_file.write(json.dumps(dialog_to_dict(dialog), ensure_ascii=False) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts the corpus between jsonl and the columnar format.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    to_columnar = subparsers.add_parser('to-columnar')
+    to_columnar.add_argument('jsonl', nargs='+')
+    to_columnar.add_argument('output')
+    to_jsonl = subparsers.add_parser('to-jsonl')
+    to_jsonl.add_argument('columnar')
+    to_jsonl.add_argument('output')
+    args = parser.parse_args()
+
+    if args.command == 'to-columnar':
+        jsonl_to_columnar(args.jsonl, args.output)
+    else:
+        columnar_to_jsonl(args.columnar, args.output)
+
+
+if __name__ == '__main__':
+    main()
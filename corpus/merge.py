@@ -0,0 +1,194 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Merges corpus files (collection rounds) into one corpus without duplicates, and reconciles
+# the result with a reference file such as all.jsonl.
+#
+# Files are streamed in priority order and each dialog is reduced to three digests:
+#   - its dialog_id,
+#   - its text: news_url, speakers and utterances,
+#   - its annotations: tweet_choices and the used_tweet of each utterance.
+# Dialogs are deduplicated on dialog_id and on text with hash tables, so the cost is linear in
+# the number of dialogs.  Reported conflicts:
+#   - duplicate: same text and annotations as a kept dialog (under the same id or not), dropped,
+#   - id_conflict: same dialog_id as a kept dialog but another text, dropped,
+#   - near_duplicate: same text as a kept dialog but other annotations, dropped; the differing
+#     fields and turns are reported.
+#
+#   python -m corpus.merge V1.jsonl V2.jsonl V3.jsonl --output merged.jsonl --reference all.jsonl --report report.json
+
+import argparse
+from collections import namedtuple
+import hashlib
+import json
+import sys
+
+
+# Digests of a dialog.  used_tweet holds one digest per utterance.
+Fingerprint = namedtuple('Fingerprint', ['dialog_id', 'text', 'annotations', 'tweet_choices', 'used_tweet',
+                                         'source'])
+
+
+def digest(value):
+    return hashlib.blake2b(json.dumps(value, ensure_ascii=False).encode('utf-8'), digest_size=16).digest()
+
+
+def fingerprint(record, source):
+    used_tweet = tuple(digest(utt.get('used_tweet')) for utt in record['dialog'])
+    tweet_choices = digest(record['tweet_choices'])
+    return Fingerprint(
+        dialog_id=record['dialog_id'],
+        text=digest([record['news_url'], [[utt['speaker'], utt['utterance']] for utt in record['dialog']]]),
+        annotations=digest([tweet_choices.hex(), [d.hex() for d in used_tweet]]),
+        tweet_choices=tweet_choices,
+        used_tweet=used_tweet,
+        source=source
+    )
+
+
+def differences(kept, other):
+    fields = []
+    if kept.tweet_choices != other.tweet_choices:
+        fields.append("tweet_choices")
+    turns = [turn for turn, (a, b) in enumerate(zip(kept.used_tweet, other.used_tweet)) if a != b]
+    if turns:
+        fields.append("used_tweet")
+    return fields, turns
+
+
+def conflict(kind, kept, other, **details):
+    return {
+        "kind": kind,
+        "dialog_id": other.dialog_id,
+        "source": other.source,
+        "kept_dialog_id": kept.dialog_id,
+        "kept_source": kept.source,
+        **details
+    }
+
+
+def iter_records(path):
+    with open(path, encoding='utf-8') as input_file:
+        for line in input_file:
+            if line.strip():
+                yield line, json.loads(line)
+
+
+class CorpusMerger(object):
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_text = {}
+        self.conflicts = []
+        self.sources = {}
+
+    def add(self, path, output_file=None):
+        # Streams the dialogs of path and writes those that are kept to output_file.
+        counts = self.sources.setdefault(path, {"dialogs": 0, "kept": 0, "duplicate": 0, "id_conflict": 0,
+                                                "near_duplicate": 0})
+        for line, record in iter_records(path):
+            counts["dialogs"] += 1
+            current = fingerprint(record, path)
+            kind, kept = self._classify(current)
+            if kind is None:
+                self.by_id[current.dialog_id] = current
+                self.by_text[current.text] = current
+                counts["kept"] += 1
+                if output_file is not None:
+                    output_file.write(line if line.endswith('\n') else line + '\n')
+                continue
+            counts[kind] += 1
+            if kind == "near_duplicate":
+                fields, turns = differences(kept, current)
+                self.conflicts.append(conflict(kind, kept, current, fields=fields, turns=turns))
+            else:
+                self.conflicts.append(conflict(kind, kept, current))
+
+    def reconcile(self, path):
+        # Compares a reference file with the merged dialogs.
+        summary = {"dialogs": 0, "identical": 0, "same_content_other_id": 0, "near_duplicate": 0,
+                   "id_conflict": 0, "only_in_reference": 0}
+        details = []
+        matched = set()
+        for _, record in iter_records(path):
+            summary["dialogs"] += 1
+            current = fingerprint(record, path)
+            kept = self.by_text.get(current.text)
+            if kept is not None:
+                matched.add(kept.text)
+                if kept.annotations != current.annotations:
+                    fields, turns = differences(kept, current)
+                    summary["near_duplicate"] += 1
+                    details.append(conflict("near_duplicate", kept, current, fields=fields, turns=turns))
+                elif kept.dialog_id != current.dialog_id:
+                    summary["same_content_other_id"] += 1
+                    details.append(conflict("same_content_other_id", kept, current))
+                else:
+                    summary["identical"] += 1
+            elif current.dialog_id in self.by_id:
+                summary["id_conflict"] += 1
+                details.append(conflict("id_conflict", self.by_id[current.dialog_id], current))
+            else:
+                summary["only_in_reference"] += 1
+                details.append({"kind": "only_in_reference", "dialog_id": current.dialog_id, "source": path})
+        missing = [kept for text, kept in self.by_text.items() if text not in matched]
+        summary["missing_from_reference"] = len(missing)
+        details.extend({"kind": "missing_from_reference", "dialog_id": kept.dialog_id, "source": kept.source}
+                       for kept in missing)
+        return {"path": path, "summary": summary, "details": details}
+
+    def report(self):
+        return {
+            "sources": self.sources,
+            "merged": len(self.by_text),
+            "conflicts": self.conflicts
+        }
+
+    def _classify(self, current):
+        # Returns the kind of conflict with a kept dialog, and that dialog.
+        kept = self.by_text.get(current.text)
+        if kept is not None:
+            if kept.annotations == current.annotations:
+                return "duplicate", kept
+            return "near_duplicate", kept
+        kept = self.by_id.get(current.dialog_id)
+        if kept is not None:
+            return "id_conflict", kept
+        return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merges corpus files without duplicates.")
+    parser.add_argument('corpus', nargs='+', help="corpus files, in priority order")
+    parser.add_argument('--output', help="merged corpus file")
+    parser.add_argument('--reference', help="corpus file to reconcile with the merged corpus, e.g. all.jsonl")
+    parser.add_argument('--report', help="report file (JSON), printed on the standard output by default")
+    args = parser.parse_args()
+
+    merger = CorpusMerger()
+    output_file = open(args.output, 'w', encoding='utf-8') if args.output else None
+    try:
+        for path in args.corpus:
+            merger.add(path, output_file)
+    finally:
+        if output_file is not None:
+            output_file.close()
+    report = merger.report()
+    if args.reference:
+        report["reference"] = merger.reconcile(args.reference)
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+    summary = {"merged": report["merged"], "conflicts": len(report["conflicts"])}
+    if args.reference:
+        summary["reference"] = report["reference"]["summary"]
+    sys.stderr.write(json.dumps(summary) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Ranking of the candidate tweets (tweet_choices) given the dialog so far, as a baseline for a
+# system that weaves tweets into its replies, and its evaluation against used_tweet.
+#
+# Texts are split into character n-grams (no tokenizer is needed for Japanese) and the tweets
+# are stored as a sparse matrix of BM25 or L2-normalized TF-IDF weights, both by rows (CSR, the
+# n-grams of each tweet) and by columns (the postings of each n-gram).  A query is the news title
+# and the previous utterances.  The candidates of a query are scored at once, in one of two ways:
+#   - by rows: the rows of the candidates are concatenated (and cached, since the dialogs of a
+#     news share their tweet_choices), multiplied by the query weights in a single pass with
+#     map and summed per row,
+#   - by columns: the postings of the query n-grams are added to the scores of all the tweets,
+#     whatever the number of candidates.
+# The cheaper way is chosen for each query from the number of non-zeros of the candidates and
+# the number of n-grams of the query.
+#
+# The tweet texts come from the news files of the chat server (chat-server/used_news/*.json);
+# dialogs whose candidates are not in these files are skipped by the evaluation.
+#
+#   python -m corpus.ranking V1.jsonl V2.jsonl --news chat-server/used_news/V1.json chat-server/used_news/V2.json
+
+import argparse
+from array import array
+from collections import Counter, OrderedDict
+import html
+from itertools import accumulate
+import json
+import math
+import operator
+from pathlib import Path
+import random
+import re
+import sys
+import time
+import unicodedata
+
+from .reader import iter_dialogs
+
+
+ROOT = Path(__file__).resolve().parents[1]
+SPACES = re.compile(r'\s+')
+# Cost of an n-gram of the query when scoring by columns, relative to a non-zero of the candidates
+# when scoring by rows (measured on the news files of the chat server).
+COLUMN_COST = 8
+
+
+def normalize(text):
+    return SPACES.sub(' ', unicodedata.normalize('NFKC', text).lower()).strip()
+
+
+def char_ngrams(text, ngram_range):
+    text = normalize(text)
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        for i in range(len(text) - n + 1):
+            yield text[i:i + n]
+
+
+def load_news(paths):
+    # Returns the tweet texts by tweet id and the news titles by url, from news files of the chat server.
+    tweets = {}
+    titles = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as input_file:
+            for news in json.load(input_file):
+                titles[news["url"]] = news["title"]
+                for text, tweet_id in news["tweets"]:
+                    tweets[tweet_id] = html.unescape(text)
+    return tweets, titles
+
+
+class TweetRanker(object):
+    # Not thread-safe: the query weights are written in a buffer shared by the calls.
+
+    def __init__(self, method='bm25', ngram_range=(2, 3), k1=1.2, b=0.75, cache_size=1024):
+        if method not in ('bm25', 'tfidf'):
+            raise ValueError(f"Unknown ranking method: {method}")
+        self.method = method
+        self.ngram_range = ngram_range
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+        self.idf = array('d')
+        self.rows = {}
+        self.indptr = array('q', [0])
+        self.indices = array('i')
+        self.weights = array('d')
+        self.postings_ptr = array('q', [0])
+        self.postings_rows = array('i')
+        self.postings_weights = array('d')
+        self.query_buffer = []
+        self.cache_size = cache_size
+        self.blocks = OrderedDict()
+
+    def fit(self, tweets):
+        # tweets: dict of texts by tweet id.
+        counts = [(tweet_id, Counter(char_ngrams(text, self.ngram_range))) for tweet_id, text in tweets.items()]
+        df = Counter()
+        for _, tf in counts:
+            df.update(tf.keys())
+        n_docs = len(counts)
+        self.vocabulary = {term: i for i, term in enumerate(sorted(df))}
+        if self.method == 'bm25':
+            self.idf = array('d', (math.log(1 + (n_docs - df[term] + 0.5) / (df[term] + 0.5)) for term in sorted(df)))
+        else:
+            self.idf = array('d', (math.log((1 + n_docs) / (1 + df[term])) + 1 for term in sorted(df)))
+        avgdl = sum(sum(tf.values()) for _, tf in counts) / n_docs if n_docs else 0.0
+
+        self.rows = {}
+        self.indptr = array('q', [0])
+        self.indices = array('i')
+        self.weights = array('d')
+        self.blocks.clear()
+        for tweet_id, tf in counts:
+            terms = sorted((self.vocabulary[term], n) for term, n in tf.items())
+            if self.method == 'bm25':
+                norm = self.k1 * (1 - self.b + self.b * sum(tf.values()) / avgdl)
+                weights = [self.idf[t] * n * (self.k1 + 1) / (n + norm) for t, n in terms]
+            else:
+                weights = self._tfidf(terms)
+            self.rows[tweet_id] = len(self.indptr) - 1
+            self.indices.extend(t for t, _ in terms)
+            self.weights.extend(weights)
+            self.indptr.append(len(self.indices))
+
+        # Transpose: postings (row, weight) of each n-gram.
+        columns = [[] for _ in self.vocabulary]
+        for row in range(len(self.indptr) - 1):
+            for i in range(self.indptr[row], self.indptr[row + 1]):
+                columns[self.indices[i]].append((row, self.weights[i]))
+        self.postings_ptr = array('q', [0])
+        self.postings_rows = array('i')
+        self.postings_weights = array('d')
+        for postings in columns:
+            self.postings_rows.extend(row for row, _ in postings)
+            self.postings_weights.extend(weight for _, weight in postings)
+            self.postings_ptr.append(len(self.postings_rows))
+        self.query_buffer = [0.0] * len(self.vocabulary)
+        return self
+
+    def query_vector(self, texts):
+        tf = Counter()
+        for text in texts:
+            tf.update(term for term in char_ngrams(text, self.ngram_range) if term in self.vocabulary)
+        if self.method == 'bm25':
+            return {self.vocabulary[term]: float(n) for term, n in tf.items()}
+        terms = [(self.vocabulary[term], n) for term, n in tf.items()]
+        return dict(zip((t for t, _ in terms), self._tfidf(terms)))
+
+    def score(self, query, candidates):
+        # Scores of the candidate tweet ids for a query vector; 0 for unknown tweets.
+        candidates = tuple(candidates)
+        indices, weights, bounds = self._block(candidates)
+        if len(indices) > COLUMN_COST * len(query):
+            return self._score_by_columns(query, candidates)
+        buffer = self.query_buffer
+        for term, weight in query.items():
+            buffer[term] = weight
+        try:
+            products = list(map(operator.mul, map(buffer.__getitem__, indices), weights))
+        finally:
+            for term in query:
+                buffer[term] = 0.0
+        return [sum(products[start:end]) for start, end in zip(bounds, bounds[1:])]
+
+    def rank(self, texts, candidates):
+        scores = self.score(self.query_vector(texts), candidates)
+        return sorted(zip(candidates, scores), key=lambda item: -item[1])
+
+    def _block(self, candidates):
+        # Concatenated rows of the candidates and the bounds of each row.
+        block = self.blocks.get(candidates)
+        if block is not None:
+            self.blocks.move_to_end(candidates)
+            return block
+        indices = array('i')
+        weights = array('d')
+        sizes = []
+        for tweet_id in candidates:
+            row = self.rows.get(tweet_id)
+            if row is None:
+                sizes.append(0)
+                continue
+            start, end = self.indptr[row], self.indptr[row + 1]
+            indices.extend(self.indices[start:end])
+            weights.extend(self.weights[start:end])
+            sizes.append(end - start)
+        block = (indices, weights, [0] + list(accumulate(sizes)))
+        self.blocks[candidates] = block
+        if len(self.blocks) > self.cache_size:
+            self.blocks.popitem(last=False)
+        return block
+
+    def _score_by_columns(self, query, candidates):
+        scores = [0.0] * (len(self.indptr) - 1)
+        ptr, rows, weights = self.postings_ptr, self.postings_rows, self.postings_weights
+        for term, query_weight in query.items():
+            start, end = ptr[term], ptr[term + 1]
+            for row, weight in zip(rows[start:end], weights[start:end]):
+                scores[row] += query_weight * weight
+        return [scores[self.rows[tweet_id]] if tweet_id in self.rows else 0.0 for tweet_id in candidates]
+
+    def _tfidf(self, terms):
+        # Sublinear, L2-normalized TF-IDF weights of (term id, count).
+        weights = [(1 + math.log(n)) * self.idf[t] for t, n in terms]
+        norm = math.sqrt(sum(w * w for w in weights)) or 1.0
+        return [w / norm for w in weights]
+
+
+def iter_examples(corpus_paths, tweets, titles, context_turns=None):
+    # One example per utterance of the system role using tweets: the news title and the previous
+    # utterances, the candidates not used yet, and the tweets used in the utterance.
+    for path in corpus_paths:
+        for dialog in iter_dialogs(path):
+            if dialog.news_url not in titles or not all(tweet_id in tweets for tweet_id in dialog.tweet_choices):
+                continue
+            used = set()
+            for turn, utt in enumerate(dialog.dialog):
+                if utt.used_tweet:
+                    previous = [u.utterance for u in dialog.dialog[:turn]]
+                    if context_turns is not None:
+                        previous = previous[max(0, len(previous) - context_turns):]
+                    candidates = [tweet_id for tweet_id in dialog.tweet_choices if tweet_id not in used]
+                    gold = set(utt.used_tweet) & set(candidates)
+                    if gold:
+                        yield dialog.dialog_id, turn, [titles[dialog.news_url]] + previous, candidates, gold
+                    used.update(utt.used_tweet)
+
+
+def evaluate_rankings(rankings, ks=(1, 3, 5)):
+    # rankings: list of (ranked candidate ids, gold ids).
+    totals = Counter()
+    for ranked, gold in rankings:
+        first = next(i for i, tweet_id in enumerate(ranked) if tweet_id in gold)
+        totals["mrr"] += 1 / (first + 1)
+        for k in ks:
+            totals[f"recall@{k}"] += len(gold.intersection(ranked[:k])) / len(gold)
+    n = len(rankings)
+    return {"examples": n, **{name: value / n for name, value in totals.items()}} if n else {"examples": 0}
+
+
+def evaluate(ranker, examples, seed=0):
+    # Metrics of the ranker and of two baselines: the presented order and a random order.
+    rng = random.Random(seed)
+    results = {"ranker": [], "presented_order": [], "random": []}
+    scored = 0
+    elapsed = 0.0
+    for _, _, texts, candidates, gold in examples:
+        start = time.perf_counter()
+        ranked = [tweet_id for tweet_id, _ in ranker.rank(texts, candidates)]
+        elapsed += time.perf_counter() - start
+        scored += len(candidates)
+        results["ranker"].append((ranked, gold))
+        results["presented_order"].append((candidates, gold))
+        shuffled = list(candidates)
+        rng.shuffle(shuffled)
+        results["random"].append((shuffled, gold))
+    metrics = {name: evaluate_rankings(rankings) for name, rankings in results.items()}
+    metrics["throughput"] = {"candidates": scored, "seconds": elapsed,
+                             "candidates_per_second": scored / elapsed if elapsed else 0.0}
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ranks the candidate tweets and evaluates against used_tweet.")
+    parser.add_argument('corpus', nargs='+')
+    parser.add_argument('--news', nargs='+', default=[str(ROOT / 'chat-server' / 'used_news' / 'V1.json'),
+                                                      str(ROOT / 'chat-server' / 'used_news' / 'V2.json')],
+                        help="news files with the tweet texts")
+    parser.add_argument('--method', choices=['bm25', 'tfidf'], default='bm25')
+    parser.add_argument('--ngram', type=int, nargs=2, default=[2, 3], metavar=('MIN', 'MAX'))
+    parser.add_argument('--context-turns', type=int, help="number of previous utterances in the query (all by default)")
+    args = parser.parse_args()
+
+    tweets, titles = load_news(args.news)
+    ranker = TweetRanker(method=args.method, ngram_range=tuple(args.ngram)).fit(tweets)
+    examples = list(iter_examples(args.corpus, tweets, titles, args.context_turns))
+    json.dump(evaluate(ranker, examples), sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Streaming reader for the corpus files (V1.jsonl, V2.jsonl, V3.jsonl, all.jsonl).
+#
+# Dialogs are read lazily, one line at a time, as Dialog records.  Lookups by dialog_id or
+# news_url go through a sidecar index (<file>.idx) that maps the hashes of the keys to the
+# byte offsets of the lines.  The index is built on the first lookup, rebuilt when the corpus
+# file changes, and memory-mapped: a lookup is a binary search in the mapped arrays and a
+# seek in the mapped corpus file.
+#
+#   python -m corpus.reader V1.jsonl --dialog-id 2022111200101
+#   python -m corpus.reader V1.jsonl --news-url https://www.asahi.com/articles/ASQ3X4DG0Q3XUTIL017.html
+
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+
+Utterance = namedtuple('Utterance', ['speaker', 'utterance', 'used_tweet'])
+Dialog = namedtuple('Dialog', ['dialog_id', 'news_url', 'tweet_choices', 'dialog'])
+
+
+def dialog_from_dict(record):
+    # used_tweet is None for the utterances without the field (those of the user role).
+    return Dialog(
+        dialog_id=record['dialog_id'],
+        news_url=record['news_url'],
+        tweet_choices=tuple(record['tweet_choices']),
+        dialog=tuple(Utterance(utt['speaker'], utt['utterance'],
+                               tuple(utt['used_tweet']) if 'used_tweet' in utt else None)
+                     for utt in record['dialog'])
+    )
+
+
+def dialog_to_dict(dialog):
+    # Same field order as the published files.
+    utterances = []
+    for utt in dialog.dialog:
+        if utt.used_tweet is None:
+            utterances.append({"speaker": utt.speaker, "utterance": utt.utterance})
+        else:
+            utterances.append({"speaker": utt.speaker, "used_tweet": list(utt.used_tweet),
+                               "utterance": utt.utterance})
+    return {
+        "news_url": dialog.news_url,
+        "tweet_choices": list(dialog.tweet_choices),
+        "dialog_id": dialog.dialog_id,
+        "dialog": utterances
+    }
+
+
+def iter_dialogs(path):
+    with open(path, encoding='utf-8') as input_file:
+        for line in input_file:
+            if line.strip():
+                yield dialog_from_dict(json.loads(line))
+
+
+def key_hash(key):
+    # Null keys (the news_url of the dialogs archived without news) all get the hash 0.
+    if key is None:
+        return 0
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+# Index file layout (native byte order, the index is a local cache):
+#   header: magic, version, size and mtime of the corpus file, number of dialogs
+#   dialog_ids: n sorted key hashes (Q), n line offsets (Q)
+#   news_urls:  n sorted key hashes (Q), n line offsets (Q)
+INDEX_MAGIC = b'NCIX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('=4sIQQQ')
+
+
+def build_index(path, index_path):
+    by_id = []
+    by_news = []
+    offset = 0
+    with open(path, 'rb') as input_file:
+        for line in input_file:
+            if line.strip():
+                record = json.loads(line)
+                by_id.append((key_hash(record['dialog_id']), offset))
+                by_news.append((key_hash(record['news_url']), offset))
+            offset += len(line)
+    stat = os.stat(path)
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, 'wb') as output_file:
+        output_file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, stat.st_size, stat.st_mtime_ns, len(by_id)))
+        for entries in (by_id, by_news):
+            entries.sort()
+            array('Q', [key for key, _ in entries]).tofile(output_file)
+            array('Q', [offset for _, offset in entries]).tofile(output_file)
+    os.replace(tmp_path, index_path)
+
+
+class CorpusReader(object):
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or f"{path}.idx"
+        self.corpus_file = None
+        self.corpus_map = None
+        self.index_file = None
+        self.index_map = None
+        self.tables = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return iter_dialogs(self.path)
+
+    def get(self, dialog_id):
+        for dialog in self._lookup('dialog_id', dialog_id):
+            return dialog
+        return None
+
+    def find_by_news(self, news_url):
+        return list(self._lookup('news_url', news_url))
+
+    def close(self):
+        for keys, offsets in (self.tables or {}).values():
+            keys.release()
+            offsets.release()
+        self.tables = None
+        for resource in (self.index_map, self.index_file, self.corpus_map, self.corpus_file):
+            if resource is not None:
+                resource.close()
+        self.corpus_file = self.corpus_map = self.index_file = self.index_map = None
+
+    def _lookup(self, field, key):
+        self._open()
+        keys, offsets = self.tables[field]
+        hashed = key_hash(key)
+        for i in range(bisect_left(keys, hashed), bisect_right(keys, hashed)):
+            offset = offsets[i]
+            end = self.corpus_map.find(b'\n', offset)
+            record = json.loads(self.corpus_map[offset:end if end >= 0 else len(self.corpus_map)])
+            # Hash collisions are told apart by the key itself.
+            if record[field] == key:
+                yield dialog_from_dict(record)
+
+    def _open(self):
+        if self.tables is not None:
+            return
+        stat = os.stat(self.path)
+        if not self._index_is_valid(stat):
+            build_index(self.path, self.index_path)
+        self.corpus_file = open(self.path, 'rb')
+        self.corpus_map = mmap.mmap(self.corpus_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index_file = open(self.index_path, 'rb')
+        self.index_map = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        n_dialogs = INDEX_HEADER.unpack_from(self.index_map)[4]
+        view = memoryview(self.index_map)
+        arrays = []
+        for i in range(4):
+            start = INDEX_HEADER.size + i * n_dialogs * 8
+            arrays.append(view[start:start + n_dialogs * 8].cast('Q'))
+        view.release()
+        self.tables = {'dialog_id': (arrays[0], arrays[1]), 'news_url': (arrays[2], arrays[3])}
+
+    def _index_is_valid(self, stat):
+        try:
+            with open(self.index_path, 'rb') as index_file:
+                header = index_file.read(INDEX_HEADER.size)
+        except FileNotFoundError:
+            return False
+        if len(header) < INDEX_HEADER.size:
+            return False
+        magic, version, size, mtime, _ = INDEX_HEADER.unpack(header)
+        return (magic, version, size, mtime) == (INDEX_MAGIC, INDEX_VERSION, stat.st_size, stat.st_mtime_ns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Looks up dialogs in a corpus file.")
+    parser.add_argument('corpus')
+    parser.add_argument('--dialog-id')
+    parser.add_argument('--news-url')
+    args = parser.parse_args()
+
+    with CorpusReader(args.corpus) as reader:
+        if args.dialog_id:
+            dialogs = [dialog for dialog in [reader.get(args.dialog_id)] if dialog is not None]
+        elif args.news_url:
+            dialogs = reader.find_by_news(args.news_url)
+        else:
+            dialogs = reader
+        for dialog in dialogs:
+            sys.stdout.write(json.dumps(dialog_to_dict(dialog), ensure_ascii=False) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Statistics of the corpus: the table of README.md and distributions (utterance lengths,
+# utterances per speaker, positions of the utterances using tweets, tweets used per dialog).
+#
+# Counters are computed by chunks over the columns of the columnar format (corpus.columnar),
+# with map/compress/Counter over the arrays instead of a loop over the records.  They can be
+# saved in a state file along with the number of bytes read from each corpus file: dialogs
+# appended to the files afterwards are added to the counters without reading the rest again.
+#
+# The table of README.md is the one published with the corpus, it is not regenerated: --check
+# compares the cells computed from the data with the cells of the table, as strings.  Counts are
+# written as integers and averages rounded to one decimal (format(value, '.1f')).  The published
+# cells that do not follow from the data are listed in KNOWN_DIFFERENCES, with the computed cell:
+# any other difference, or a known difference that changes, fails the check.
+#
+#   python -m corpus.stats                  # prints the table and the distributions
+#   python -m corpus.stats --check          # fails if the values differ from the table of README.md
+#   python -m corpus.stats --state stats.json
+
+import argparse
+from collections import Counter
+import hashlib
+from itertools import chain, compress, repeat
+import json
+import operator
+from pathlib import Path
+import sys
+
+from .columnar import ColumnarWriter
+from .reader import dialog_from_dict
+
+
+ROOT = Path(__file__).resolve().parents[1]
+VERSIONS = ["V1", "V2", "V3"]
+TOTAL_LABEL = "V1+V2+V3"
+LENGTH_BIN = 10
+CHUNK_SIZE = 10000
+STATE_VERSION = 2
+DIGEST_BLOCK_SIZE = 1 << 20
+
+TABLE_COLUMNS = ["dialogs", "utterances", "utterances_per_dialog", "presented_per_dialog", "dialogs_with_tweet",
+                 "used_per_dialog"]
+COUNT_COLUMNS = {"dialogs", "utterances", "dialogs_with_tweet"}
+# (label, column): (published cell, computed cell, reason)
+KNOWN_DIFFERENCES = {
+    ("V1", "presented_per_dialog"): ("12.8", "12.7", "2573 tweets presented in 202 dialogs: 12.74"),
+    ("V1", "used_per_dialog"): ("2.0", "1.9", "393 tweets used in 202 dialogs: 1.946"),
+    ("V2", "used_per_dialog"): ("2.9", "3.0", "660 tweets used in 223 dialogs: 2.960"),
+    (TOTAL_LABEL, "dialogs"): ("1047", "1046", "V1.jsonl, V2.jsonl and V3.jsonl hold 202 + 223 + 621 dialogs"),
+    (TOTAL_LABEL, "used_per_dialog"): ("2.9", "2.8", "2957 tweets used in 1046 dialogs: 2.827")
+}
+
+
+def differences(offsets, start, end):
+    # offsets[start + 1:end + 1] - offsets[start:end]
+    return list(map(operator.sub, offsets[start + 1:end + 1], offsets[start:end]))
+
+
+class CorpusStats(object):
+
+    def __init__(self):
+        self.dialogs = 0
+        self.utterances = 0
+        self.presented = 0
+        self.dialogs_with_tweet = 0
+        self.used_tweets = 0
+        self.speakers = Counter()
+        self.speaker_chars = Counter()
+        self.utterance_lengths = Counter()
+        self.used_positions = Counter()
+        self.used_per_dialog = Counter()
+
+    def add_columns(self, columns, start=0, end=None):
+        # Adds the dialogs [start, end) of a columnar corpus (ColumnarCorpus.columns or ColumnarWriter.columns).
+        end = len(columns['dialog_news']) if end is None else end
+        if end <= start:
+            return
+        dialog_utterances = columns['dialog_utterances']
+        first, last = dialog_utterances[start], dialog_utterances[end]
+        self.dialogs += end - start
+        self.utterances += last - first
+
+        choice_sizes = differences(columns['choice_list_offsets'], 0, len(columns['choice_list_offsets']) - 1)
+        self.presented += sum(map(choice_sizes.__getitem__, columns['dialog_choices'][start:end]))
+
+        used_offsets = columns['used_offsets']
+        used_bounds = list(map(used_offsets.__getitem__, dialog_utterances[start:end + 1]))
+        used_per_dialog = differences(used_bounds, 0, end - start)
+        self.dialogs_with_tweet += len(used_per_dialog) - used_per_dialog.count(0)
+        self.used_tweets += sum(used_per_dialog)
+        self.used_per_dialog.update(used_per_dialog)
+
+        # Position of each utterance in its dialog, then those of the utterances using tweets.
+        utterance_counts = differences(dialog_utterances, start, end)
+        positions = list(chain.from_iterable(map(range, utterance_counts)))
+        used_per_utterance = differences(used_offsets, first, last)
+        self.used_positions.update(compress(positions, used_per_utterance))
+
+        text_offsets = columns['text_offsets']
+        texts = columns['texts']
+        lengths = list(map(len, map(str, map(texts.__getitem__, map(slice, text_offsets[first:last],
+                                                                      text_offsets[first + 1:last + 1])),
+                                    repeat('utf-8'))))
+        self.utterance_lengths.update(map(operator.floordiv, lengths, repeat(LENGTH_BIN)))
+        speakers = bytes(columns['speakers'][first:last])
+        for code in set(speakers):
+            speaker = chr(code)
+            self.speakers[speaker] += speakers.count(code)
+            self.speaker_chars[speaker] += sum(compress(lengths, map(code.__eq__, speakers)))
+
+    def merge(self, other):
+        for name, value in vars(other).items():
+            if isinstance(value, Counter):
+                getattr(self, name).update(value)
+            else:
+                setattr(self, name, getattr(self, name) + value)
+        return self
+
+    def table_values(self):
+        # Columns of the table of README.md (TABLE_COLUMNS).  As in the published table, the used tweets
+        # per dialog are averaged over all the dialogs, those without used tweets included.
+        return (self.dialogs, self.utterances, self.utterances / self.dialogs, self.presented / self.dialogs,
+                self.dialogs_with_tweet, self.used_tweets / self.dialogs)
+
+    def table_cells(self):
+        return tuple(f"{value}" if column in COUNT_COLUMNS else f"{value:.1f}"
+                     for column, value in zip(TABLE_COLUMNS, self.table_values()))
+
+    def table_row(self, label):
+        return f"|{label}|" + "".join(f"{cell}|" for cell in self.table_cells())
+
+    def distributions(self):
+        return {
+            "utterance_length": {f"{k * LENGTH_BIN}-{k * LENGTH_BIN + LENGTH_BIN - 1}": v
+                                 for k, v in sorted(self.utterance_lengths.items())},
+            "speakers": {speaker: {"utterances": n, "mean_length": self.speaker_chars[speaker] / n}
+                         for speaker, n in sorted(self.speakers.items())},
+            "used_tweet_position": dict(sorted(self.used_positions.items())),
+            "used_tweets_per_dialog": dict(sorted(self.used_per_dialog.items()))
+        }
+
+    def to_dict(self):
+        return {name: dict(value) if isinstance(value, Counter) else value for name, value in vars(self).items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for name, value in data.items():
+            if isinstance(getattr(stats, name), Counter):
+                # JSON keys are strings.
+                value = Counter({int(k) if str(k).lstrip('-').isdigit() else k: v for k, v in value.items()})
+            setattr(stats, name, value)
+        return stats
+
+
+def consumed_digest(path, size):
+    # Digest of the bytes [0, size) of a file, the bytes already counted, to tell an append from a rewrite.
+    digest = hashlib.sha1()
+    with open(path, 'rb') as input_file:
+        while size > 0:
+            block = input_file.read(min(size, DIGEST_BLOCK_SIZE))
+            if not block:
+                break
+            digest.update(block)
+            size -= len(block)
+    return digest
+
+
+def update_from_jsonl(stats, path, offset=0, digest=None):
+    # Adds the complete lines of path after offset to stats and returns the new offset.  The lines
+    # read are added to digest (the digest of the bytes before offset).
+    with open(path, 'rb') as input_file:
+        input_file.seek(offset)
+        writer = ColumnarWriter()
+        for line in input_file:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            if digest is not None:
+                digest.update(line)
+            if line.strip():
+                writer.add(dialog_from_dict(json.loads(line)))
+            if len(writer.columns['dialog_news']) >= CHUNK_SIZE:
+                stats.add_columns(writer.columns)
+                writer = ColumnarWriter()
+        stats.add_columns(writer.columns)
+    return offset
+
+
+def compute(sources, state=None):
+    # sources: list of (version, path).  state: dict loaded from the state file, updated in place.
+    state = {} if state is None else state
+    if state.get("version") != STATE_VERSION:
+        state.clear()
+        state["version"] = STATE_VERSION
+    saved_sources = state.setdefault("sources", {})
+    results = {}
+    for version, path in sources:
+        saved = saved_sources.get(version)
+        stat = Path(path).stat()
+        if saved is not None and saved["path"] == str(path) and (saved["size"], saved["mtime"]) == (
+                stat.st_size, stat.st_mtime_ns):
+            results[version] = CorpusStats.from_dict(saved["stats"])
+            continue
+        # The file was changed: appended to if the bytes counted are the same.
+        digest = None
+        if saved is not None and saved["path"] == str(path) and stat.st_size >= saved["offset"]:
+            digest = consumed_digest(path, saved["offset"])
+            if digest.hexdigest() != saved["digest"]:
+                digest = None
+        if digest is None:
+            saved = {"path": str(path), "offset": 0, "stats": CorpusStats().to_dict()}
+            digest = hashlib.sha1()
+        stats = CorpusStats.from_dict(saved["stats"])
+        saved["offset"] = update_from_jsonl(stats, path, saved["offset"], digest)
+        saved.update(digest=digest.hexdigest(), size=stat.st_size, mtime=stat.st_mtime_ns, stats=stats.to_dict())
+        saved_sources[version] = saved
+        results[version] = stats
+    return results
+
+
+def render_table_rows(results):
+    rows = [stats.table_row(version) for version, stats in results.items()]
+    rows.append(total_stats(results).table_row(TOTAL_LABEL))
+    return rows
+
+
+def total_stats(results):
+    total = CorpusStats()
+    for stats in results.values():
+        total.merge(stats)
+    return total
+
+
+def parse_table(readme):
+    # Cells of the rows of the table of README.md, by label.
+    labels = set(VERSIONS) | {TOTAL_LABEL}
+    table = {}
+    for line in readme.split('\n'):
+        cells = line.split('|')
+        if line.startswith('|') and cells[1] in labels:
+            table[cells[1]] = tuple(cells[2:2 + len(TABLE_COLUMNS)])
+    return table
+
+
+def compare_table(results, published):
+    # Differences (label, column, published cell, computed cell) between the computed table and the
+    # published one, other than KNOWN_DIFFERENCES.  A known difference whose cells have changed is reported.
+    computed = {version: stats.table_cells() for version, stats in results.items()}
+    computed[TOTAL_LABEL] = total_stats(results).table_cells()
+    differences = []
+    for label, cells in computed.items():
+        for column, cell, published_cell in zip(TABLE_COLUMNS, cells, published[label]):
+            known = KNOWN_DIFFERENCES.get((label, column))
+            if cell != published_cell or known is not None:
+                if known is None or known[:2] != (published_cell, cell):
+                    differences.append((label, column, published_cell, cell))
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Computes the statistics of the corpus.")
+    parser.add_argument('--root', default=str(ROOT), help="directory of V1.jsonl, V2.jsonl, V3.jsonl and README.md")
+    parser.add_argument('--state', help="state file for the incremental updates")
+    parser.add_argument('--check', action='store_true', help="compare the values with the table of README.md")
+    args = parser.parse_args()
+
+    state = None
+    if args.state and Path(args.state).exists():
+        state = json.loads(Path(args.state).read_text())
+    state = {} if state is None else state
+    results = compute([(version, Path(args.root) / f"{version}.jsonl") for version in VERSIONS], state)
+    if args.state:
+        Path(args.state).write_text(json.dumps(state))
+
+    if args.check:
+        published = parse_table((Path(args.root) / "README.md").read_text(encoding='utf-8'))
+        differences = compare_table(results, published)
+        for label, column, published_value, value in differences:
+            sys.stderr.write(f"{label} {column}: README.md {published_value}, computed {value}\n")
+        if differences:
+            sys.exit(1)
+    else:
+        print('\n'.join(render_table_rows(results)))
+        distributions = {version: stats.distributions() for version, stats in results.items()}
+        distributions[TOTAL_LABEL] = total_stats(results).distributions()
+        json.dump(distributions, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
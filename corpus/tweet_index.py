@@ -0,0 +1,243 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Inverted index of the tweets presented to the system role (tweet_choices) and used in
+# its utterances (used_tweet).
+#
+# Tweet ids are stored as int64 arrays.  The postings of the used tweets, (tweet, dialog, turn),
+# are sorted by tweet so that the dialogs and utterances using a tweet are found by binary
+# search.  Dialogs are sorted by (corpus version, news_url), so that the aggregates per news
+# and per version are sums over contiguous slices of the per-dialog arrays, and the counts
+# per turn position are kept in one table per version.
+#
+#   python -m corpus.tweet_index V1.jsonl V2.jsonl V3.jsonl --save tweets.idx --usage news
+#   python -m corpus.tweet_index --load tweets.idx --tweet 1508589089817526272
+
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+import json
+from pathlib import Path
+import struct
+import sys
+
+from .reader import iter_dialogs
+
+
+INDEX_MAGIC = b'NCTI'
+INDEX_HEADER = struct.Struct('=4sQ')
+
+# name: typecode of the arrays of the index.
+ARRAYS = {
+    # Per dialog, in (version, news) order.
+    'dialog_version': 'i',
+    'dialog_news': 'i',
+    'dialog_presented': 'i',
+    'dialog_used': 'i',
+    # Contiguous runs of dialogs with the same (version, news).
+    'block_version': 'i',
+    'block_news': 'i',
+    'block_start': 'i',
+    'block_end': 'i',
+    # Postings sorted by tweet id.
+    'used_tweet': 'q',
+    'used_dialog': 'i',
+    'used_turn': 'i',
+    'presented_tweet': 'q',
+    'presented_dialog': 'i',
+    # Per version and turn position (version * max_turns + turn).
+    'turn_utterances': 'i',
+    'turn_with_tweet': 'i',
+    'turn_used': 'i',
+}
+
+
+def usage(presented, used):
+    return {"presented": presented, "used": used, "rate": used / presented if presented else 0.0}
+
+
+class TweetIndex(object):
+
+    def __init__(self, versions, news_urls, dialog_ids, max_turns, arrays):
+        self.versions = versions
+        self.news_urls = news_urls
+        self.dialog_ids = dialog_ids
+        self.max_turns = max_turns
+        self.arrays = arrays
+
+    @classmethod
+    def build(cls, sources):
+        # sources: list of (version, path of a corpus file).
+        versions = [version for version, _ in sources]
+        news_ids = {}
+        dialogs = []
+        max_turns = 0
+        for version_id, (_, path) in enumerate(sources):
+            for dialog in iter_dialogs(path):
+                news_id = news_ids.setdefault(dialog.news_url, len(news_ids))
+                choices = set(int(tweet_id) for tweet_id in dialog.tweet_choices)
+                used = [(turn, int(tweet_id)) for turn, utt in enumerate(dialog.dialog)
+                        for tweet_id in utt.used_tweet or ()]
+                system_turns = [(turn, bool(utt.used_tweet)) for turn, utt in enumerate(dialog.dialog)
+                                if utt.speaker == "S"]
+                max_turns = max(max_turns, len(dialog.dialog))
+                dialogs.append((version_id, news_id, dialog.dialog_id, choices, used, system_turns))
+        dialogs.sort(key=lambda d: (d[0], d[1]))
+
+        arrays = {name: array(typecode) for name, typecode in ARRAYS.items()}
+        for name in ('turn_utterances', 'turn_with_tweet', 'turn_used'):
+            arrays[name] = array('i', bytes(4 * len(versions) * max_turns))
+        used_postings = []
+        presented_postings = []
+        last_block = None
+        for i, (version_id, news_id, _, choices, used, system_turns) in enumerate(dialogs):
+            arrays['dialog_version'].append(version_id)
+            arrays['dialog_news'].append(news_id)
+            arrays['dialog_presented'].append(len(choices))
+            arrays['dialog_used'].append(len(choices.intersection(tweet_id for _, tweet_id in used)))
+            if (version_id, news_id) != last_block:
+                if last_block is not None:
+                    arrays['block_end'].append(i)
+                arrays['block_version'].append(version_id)
+                arrays['block_news'].append(news_id)
+                arrays['block_start'].append(i)
+                last_block = (version_id, news_id)
+            row = version_id * max_turns
+            for turn, with_tweet in system_turns:
+                arrays['turn_utterances'][row + turn] += 1
+                arrays['turn_with_tweet'][row + turn] += with_tweet
+            for turn, tweet_id in used:
+                arrays['turn_used'][row + turn] += 1
+                used_postings.append((tweet_id, i, turn))
+            presented_postings.extend((tweet_id, i) for tweet_id in choices)
+        if last_block is not None:
+            arrays['block_end'].append(len(dialogs))
+
+        used_postings.sort()
+        arrays['used_tweet'] = array('q', [p[0] for p in used_postings])
+        arrays['used_dialog'] = array('i', [p[1] for p in used_postings])
+        arrays['used_turn'] = array('i', [p[2] for p in used_postings])
+        presented_postings.sort()
+        arrays['presented_tweet'] = array('q', [p[0] for p in presented_postings])
+        arrays['presented_dialog'] = array('i', [p[1] for p in presented_postings])
+
+        news_urls = sorted(news_ids, key=news_ids.get)
+        return cls(versions, news_urls, [d[2] for d in dialogs], max_turns, arrays)
+
+    def save(self, path):
+        header = json.dumps({
+            "versions": self.versions,
+            "news_urls": self.news_urls,
+            "dialog_ids": self.dialog_ids,
+            "max_turns": self.max_turns,
+            "lengths": {name: len(self.arrays[name]) for name in ARRAYS}
+        }, ensure_ascii=False).encode('utf-8')
+        with open(path, 'wb') as output_file:
+            output_file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(header)))
+            output_file.write(header)
+            for name in ARRAYS:
+                self.arrays[name].tofile(output_file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as input_file:
+            magic, header_size = INDEX_HEADER.unpack(input_file.read(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC:
+                raise ValueError(f"{path} is not a tweet index")
+            header = json.loads(input_file.read(header_size))
+            arrays = {}
+            for name, typecode in ARRAYS.items():
+                arrays[name] = array(typecode)
+                arrays[name].fromfile(input_file, header['lengths'][name])
+        return cls(header['versions'], header['news_urls'], header['dialog_ids'], header['max_turns'], arrays)
+
+    def postings(self, tweet_id):
+        # (dialog_id, turn) of the utterances that used the tweet.
+        tweets = self.arrays['used_tweet']
+        tweet_id = int(tweet_id)
+        return [(self.dialog_ids[self.arrays['used_dialog'][i]], self.arrays['used_turn'][i])
+                for i in range(bisect_left(tweets, tweet_id), bisect_right(tweets, tweet_id))]
+
+    def presentations(self, tweet_id):
+        # dialog_ids of the dialogs where the tweet was presented.
+        tweets = self.arrays['presented_tweet']
+        tweet_id = int(tweet_id)
+        return [self.dialog_ids[self.arrays['presented_dialog'][i]]
+                for i in range(bisect_left(tweets, tweet_id), bisect_right(tweets, tweet_id))]
+
+    def usage_by_news(self, version=None):
+        # Fraction of the presented tweets that were used, per news_url.
+        totals = {}
+        for presented, used, _, news_id in self._block_sums(version):
+            total = totals.setdefault(news_id, [0, 0])
+            total[0] += presented
+            total[1] += used
+        return {self.news_urls[news_id]: usage(*total) for news_id, total in totals.items()}
+
+    def usage_by_version(self):
+        totals = [[0, 0] for _ in self.versions]
+        for presented, used, version_id, _ in self._block_sums(None):
+            totals[version_id][0] += presented
+            totals[version_id][1] += used
+        return {version: usage(*total) for version, total in zip(self.versions, totals)}
+
+    def usage_by_turn(self, version=None):
+        # Per turn position: utterances of the system role, those with at least one tweet and the tweets used.
+        version_ids = range(len(self.versions)) if version is None else [self.versions.index(version)]
+        result = {}
+        for turn in range(self.max_turns):
+            utterances = sum(self.arrays['turn_utterances'][v * self.max_turns + turn] for v in version_ids)
+            if utterances == 0:
+                continue
+            with_tweet = sum(self.arrays['turn_with_tweet'][v * self.max_turns + turn] for v in version_ids)
+            result[turn] = {
+                "utterances": utterances,
+                "with_tweet": with_tweet,
+                "used_tweets": sum(self.arrays['turn_used'][v * self.max_turns + turn] for v in version_ids),
+                "rate": with_tweet / utterances
+            }
+        return result
+
+    def _block_sums(self, version):
+        version_id = None if version is None else self.versions.index(version)
+        presented = self.arrays['dialog_presented']
+        used = self.arrays['dialog_used']
+        for block_version, news_id, start, end in zip(self.arrays['block_version'], self.arrays['block_news'],
+                                                      self.arrays['block_start'], self.arrays['block_end']):
+            if version_id is None or block_version == version_id:
+                yield sum(presented[start:end]), sum(used[start:end]), block_version, news_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds and queries the tweet usage index.")
+    parser.add_argument('corpus', nargs='*', help="corpus files, the version is the file name without extension")
+    parser.add_argument('--load', help="load a saved index instead of building it")
+    parser.add_argument('--save', help="save the index")
+    parser.add_argument('--tweet', help="print the utterances that used a tweet")
+    parser.add_argument('--usage', choices=['news', 'version', 'turn'], help="print the usage rates")
+    parser.add_argument('--version', help="restrict the usage rates per news or turn to one version")
+    args = parser.parse_args()
+
+    if args.load:
+        index = TweetIndex.load(args.load)
+    else:
+        index = TweetIndex.build([(Path(path).stem, path) for path in args.corpus])
+    if args.save:
+        index.save(args.save)
+    if args.tweet:
+        result = {"used": index.postings(args.tweet), "presented": index.presentations(args.tweet)}
+    elif args.usage == 'news':
+        result = index.usage_by_news(args.version)
+    elif args.usage == 'version':
+        result = index.usage_by_version()
+    elif args.usage == 'turn':
+        result = index.usage_by_turn(args.version)
+    else:
+        return
+    json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
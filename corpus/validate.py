@@ -0,0 +1,196 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Validation of collected dialogs before a release.  Rules:
+#   - used_tweet_not_in_choices: a used_tweet id is not in the tweet_choices of the dialog,
+#   - speaker_not_alternating: two consecutive utterances of the same speaker,
+#   - unknown_speaker: a speaker other than S and U,
+#   - empty_utterance: an empty or whitespace-only utterance,
+#   - untrimmed_utterance (warning): leading or trailing whitespace, such as the "\n" that ends
+#     the last utterance of the dialogs collected so far,
+#   - msg_count_low / msg_count_high: the numbers of utterances per speaker are out of the range
+#     of the chat server (msg_count_low and msg_count_high of chat-server/config.json).  As in
+#     chat.js, a dialog can be stopped once one of the speakers has sent msg_count_low messages
+#     and is too long once one of them has sent more than msg_count_high messages,
+#   - invalid_record: a line that is not a dialog, or an utterance whose text is not a string or whose
+#     used_tweet is not a list of tweet ids (reported with its turn).
+#
+# Files are read in one pass, by chunks of lines that are validated by a pool of processes.
+# The report (JSON) holds the counts per file and rule, and one entry per issue with the line
+# number and the dialog_id.  The exit status is 1 if an error is found (or a warning, with
+# --strict).
+#
+#   python -m corpus.validate V1.jsonl V2.jsonl V3.jsonl --report validation.json
+#   python -m corpus.validate all.jsonl --jobs 8 --chunk-size 4194304
+
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import json
+import os
+from pathlib import Path
+import sys
+
+
+ROOT = Path(__file__).resolve().parents[1]
+CONFIG_PATH = ROOT / 'chat-server' / 'config.json'
+CHUNK_SIZE = 1 << 22
+RULES = ['used_tweet_not_in_choices', 'speaker_not_alternating', 'unknown_speaker', 'empty_utterance',
+         'untrimmed_utterance', 'msg_count_low', 'msg_count_high', 'invalid_record']
+WARNINGS = {'untrimmed_utterance'}
+
+
+def issue(rule, line, dialog_id=None, turn=None, **details):
+    return {"rule": rule, "severity": "warning" if rule in WARNINGS else "error", "line": line,
+            "dialog_id": dialog_id, "turn": turn, **details}
+
+
+def validate_record(record, line, msg_count_low, msg_count_high):
+    # Issues of one dialog (a dict of a line of a corpus file).
+    try:
+        dialog_id = record['dialog_id']
+        choices = set(record['tweet_choices'])
+        utterances = record['dialog']
+        if not isinstance(utterances, list) or not all(isinstance(utt, dict) for utt in utterances):
+            raise TypeError("dialog is not a list of utterances")
+        speakers = [utt['speaker'] for utt in utterances]
+        texts = [utt['utterance'] for utt in utterances]
+    except KeyError as e:
+        dialog_id = record.get('dialog_id')
+        return [issue('invalid_record', line, dialog_id, error=f"missing field {e}")]
+    except TypeError as e:
+        dialog_id = record.get('dialog_id') if isinstance(record, dict) else None
+        return [issue('invalid_record', line, dialog_id, error=str(e))]
+
+    issues = []
+    previous = None
+    for turn, (utt, speaker, text) in enumerate(zip(utterances, speakers, texts)):
+        if speaker not in ('S', 'U'):
+            issues.append(issue('unknown_speaker', line, dialog_id, turn, speaker=speaker))
+        elif speaker == previous:
+            issues.append(issue('speaker_not_alternating', line, dialog_id, turn, speaker=speaker))
+        previous = speaker
+        if not isinstance(text, str):
+            issues.append(issue('invalid_record', line, dialog_id, turn, error="utterance is not a string"))
+        elif not text.strip():
+            issues.append(issue('empty_utterance', line, dialog_id, turn, utterance=text))
+        elif text != text.strip():
+            issues.append(issue('untrimmed_utterance', line, dialog_id, turn, utterance=text))
+        used = utt.get('used_tweet')
+        used = [] if used is None else used
+        if not isinstance(used, list) or not all(isinstance(tweet_id, str) for tweet_id in used):
+            issues.append(issue('invalid_record', line, dialog_id, turn, error="used_tweet is not a list of tweet ids"))
+            continue
+        unknown = [tweet_id for tweet_id in used if tweet_id not in choices]
+        if unknown:
+            issues.append(issue('used_tweet_not_in_choices', line, dialog_id, turn, tweets=unknown))
+
+    counts = {"S": speakers.count('S'), "U": speakers.count('U')}
+    if max(counts.values()) < msg_count_low:
+        issues.append(issue('msg_count_low', line, dialog_id, counts=counts, msg_count_low=msg_count_low))
+    elif max(counts.values()) > msg_count_high:
+        issues.append(issue('msg_count_high', line, dialog_id, counts=counts, msg_count_high=msg_count_high))
+    return issues
+
+
+def validate_chunk(path, start, end, msg_count_low, msg_count_high):
+    # Validates the lines of path in [start, end); line numbers are relative to the chunk (from 1).
+    # Dialogs with at least one error are counted as invalid.
+    issues = []
+    dialogs = 0
+    invalid_dialogs = 0
+    lines = 0
+    with open(path, 'rb') as input_file:
+        input_file.seek(start)
+        for raw in input_file.read(end - start).splitlines():
+            lines += 1
+            if not raw.strip():
+                continue
+            dialogs += 1
+            try:
+                record = json.loads(raw)
+            except ValueError as e:
+                found = [issue('invalid_record', lines, error=str(e))]
+            else:
+                found = validate_record(record, lines, msg_count_low, msg_count_high)
+            if any(found_issue["severity"] == "error" for found_issue in found):
+                invalid_dialogs += 1
+            issues.extend(found)
+    return lines, dialogs, invalid_dialogs, issues
+
+
+def iter_chunks(path, chunk_size):
+    # (start, end) byte ranges of about chunk_size bytes, ending at line boundaries.
+    size = os.path.getsize(path)
+    with open(path, 'rb') as input_file:
+        start = 0
+        while start < size:
+            input_file.seek(min(start + chunk_size, size))
+            input_file.readline()
+            end = min(input_file.tell(), size)
+            yield start, end
+            start = end
+
+
+def validate(paths, msg_count_low, msg_count_high, jobs=None, chunk_size=CHUNK_SIZE):
+    jobs = os.cpu_count() if jobs is None else jobs
+    tasks = [(str(path), start, end) for path in paths for start, end in iter_chunks(path, chunk_size)]
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(validate_chunk, *zip(*tasks), repeat(msg_count_low), repeat(msg_count_high)))
+    else:
+        results = [validate_chunk(path, start, end, msg_count_low, msg_count_high) for path, start, end in tasks]
+
+    # Chunks are in file order: line numbers are offset by the lines of the previous chunks.
+    files = {}
+    issues = []
+    lines_before = {}
+    for (path, _, _), (lines, dialogs, invalid_dialogs, chunk_issues) in zip(tasks, results):
+        summary = files.setdefault(path, {"dialogs": 0, "invalid_dialogs": 0, "issues": Counter()})
+        summary["dialogs"] += dialogs
+        summary["invalid_dialogs"] += invalid_dialogs
+        offset = lines_before.get(path, 0)
+        for found in chunk_issues:
+            found["path"] = path
+            found["line"] += offset
+            summary["issues"][found["rule"]] += 1
+        issues.extend(chunk_issues)
+        lines_before[path] = offset + lines
+    for summary in files.values():
+        summary["issues"] = {rule: summary["issues"][rule] for rule in RULES if summary["issues"][rule]}
+    return {
+        "config": {"msg_count_low": msg_count_low, "msg_count_high": msg_count_high},
+        "files": files,
+        "issues": issues
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validates corpus files before a release.")
+    parser.add_argument('corpus', nargs='+')
+    parser.add_argument('--config', default=str(CONFIG_PATH), help="config.json of the chat server")
+    parser.add_argument('--jobs', type=int, help="number of processes (number of CPUs by default)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="bytes per chunk of lines")
+    parser.add_argument('--report', help="report file (JSON), printed on the standard output by default")
+    parser.add_argument('--strict', action='store_true', help="fail on warnings too")
+    args = parser.parse_args()
+
+    with open(args.config) as config_file:
+        cfg = json.load(config_file)
+    report = validate(args.corpus, cfg['msg_count_low'], cfg['msg_count_high'], args.jobs, args.chunk_size)
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+    sys.stderr.write(json.dumps(report["files"]) + "\n")
+    if any(found["severity"] == "error" or args.strict for found in report["issues"]):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
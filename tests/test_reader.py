@@ -0,0 +1,43 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Lookups of the corpus reader through the offset index.
+#
+#   python -m pytest tests
+
+import json
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from corpus.reader import CorpusReader  # noqa: E402
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def test_lookups(tmp_path):
+    path = tmp_path / "V1.jsonl"
+    path.write_bytes((ROOT / "V1.jsonl").read_bytes())
+    records = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+    with CorpusReader(str(path)) as reader:
+        assert reader.get(records[10]['dialog_id']).dialog_id == records[10]['dialog_id']
+        assert reader.get("unknown") is None
+        news_url = records[0]['news_url']
+        assert [dialog.dialog_id for dialog in reader.find_by_news(news_url)] == [
+            record['dialog_id'] for record in records if record['news_url'] == news_url]
+
+
+def test_null_news_url(tmp_path):
+    # As archived by the chat server for a chatroom without news.
+    path = tmp_path / "archive.jsonl"
+    records = [{"news_url": None, "tweet_choices": [], "dialog_id": "d0",
+                "dialog": [{"speaker": "S", "used_tweet": [], "utterance": "hello"}]},
+               {"news_url": "https://example.com/news", "tweet_choices": ["1"], "dialog_id": "d1",
+                "dialog": [{"speaker": "S", "used_tweet": ["1"], "utterance": "hello"}]}]
+    path.write_text("".join(json.dumps(record) + "\n" for record in records), encoding='utf-8')
+    with CorpusReader(str(path)) as reader:
+        assert reader.get("d0").news_url is None
+        assert [dialog.dialog_id for dialog in reader.find_by_news(None)] == ["d0"]
+        assert [dialog.dialog_id for dialog in reader.find_by_news("https://example.com/news")] == ["d1"]
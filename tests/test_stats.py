@@ -0,0 +1,81 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# The statistics computed from V1/V2/V3.jsonl against the table published in README.md.
+#
+#   python -m pytest tests
+
+import os
+from pathlib import Path
+import shutil
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from corpus.stats import (KNOWN_DIFFERENCES, ROOT, VERSIONS, compare_table, compute, parse_table,  # noqa: E402
+                          render_table_rows)
+
+
+def corpus_sources(root=ROOT):
+    return [(version, Path(root) / f"{version}.jsonl") for version in VERSIONS]
+
+
+def readme_table():
+    return parse_table((ROOT / "README.md").read_text(encoding='utf-8'))
+
+
+def test_readme_table():
+    # Every cell of the table of README.md equals the computed one, but the known differences.
+    results = compute(corpus_sources())
+    published = readme_table()
+    assert sorted(published) == sorted(VERSIONS + ["V1+V2+V3"])
+    assert compare_table(results, published) == []
+
+
+def test_known_differences_are_reported():
+    # A cell of the table that changes, known difference or not, fails the check.
+    results = compute(corpus_sources())
+    published = readme_table()
+    published["V3"] = ("621", "6924", "11.1", "12.3", "599", "3.2")
+    assert compare_table(results, published) == [("V3", "used_per_dialog", "3.2", "3.1")]
+    published = readme_table()
+    (label, column), (published_cell, computed_cell, _) = next(iter(KNOWN_DIFFERENCES.items()))
+    published[label] = tuple(computed_cell if cell == published_cell else cell for cell in published[label])
+    assert compare_table(results, published) == [(label, column, computed_cell, computed_cell)]
+
+
+def test_used_tweets_per_dialog_over_all_dialogs():
+    results = compute(corpus_sources())
+    expected = {"V1": 1.95, "V2": 2.96, "V3": 3.07}
+    for version, stats in results.items():
+        assert stats.dialogs_with_tweet < stats.dialogs
+        assert abs(stats.table_values()[-1] - expected[version]) < 0.005
+
+
+def test_incremental_update(tmp_path):
+    for version in VERSIONS:
+        shutil.copy(ROOT / f"{version}.jsonl", tmp_path / f"{version}.jsonl")
+    sources = corpus_sources(tmp_path)
+    state = {}
+    compute(sources, state)
+
+    # Appended dialogs.
+    lines = (ROOT / "V1.jsonl").read_text(encoding='utf-8').splitlines(keepends=True)
+    with open(tmp_path / "V3.jsonl", 'a', encoding='utf-8') as output_file:
+        output_file.writelines(lines[:10])
+    results = compute(sources, state)
+    assert results["V3"].dialogs == 631
+    assert render_table_rows(results) == render_table_rows(compute(sources))
+
+    # A dialog rewritten after the first 4096 bytes, same size.
+    path = tmp_path / "V2.jsonl"
+    data = bytearray(path.read_bytes())
+    position = data.index(b'"speaker": "S"', len(data) // 2)
+    data[position + 12:position + 13] = b'X'
+    stat = path.stat()
+    path.write_bytes(bytes(data))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    results = compute(sources, state)
+    assert render_table_rows(results) == render_table_rows(compute(sources))
+    assert results["V2"].speakers["X"] == 1
@@ -0,0 +1,58 @@
+#  Copyright (c) 2023 Fuka Narita.
+#  This source code is licensed under the MIT license found in the
+#  LICENSE file in the root directory of this source tree.
+
+# Malformed records are reported as invalid_record instead of stopping the validation.
+#
+#   python -m pytest tests
+
+import json
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from corpus.validate import validate, validate_record  # noqa: E402
+
+
+def dialog(utterances, dialog_id="d0"):
+    return {"dialog_id": dialog_id, "tweet_choices": ["1", "2"], "dialog": utterances}
+
+
+def utterances(n=6, **fields):
+    return [{"speaker": "SU"[turn % 2], "utterance": f"utterance {turn}", "used_tweet": [], **fields}
+            for turn in range(n * 2)]
+
+
+MALFORMED = [
+    dialog([{"speaker": "S", "utterance": None}] + utterances()[1:], "null_utterance"),
+    dialog([{"speaker": "S", "utterance": 5}] + utterances()[1:], "number_utterance"),
+    dialog(["utterance"] + utterances()[1:], "string_element"),
+    dialog([{"speaker": "S", "utterance": "a", "used_tweet": 5}] + utterances()[1:], "scalar_used_tweet"),
+    dialog([{"speaker": "S", "utterance": "a", "used_tweet": [["1"]]}] + utterances()[1:], "nested_used_tweet"),
+    dialog(5, "scalar_dialog"),
+    [1, 2, 3]
+]
+
+
+def test_valid_record():
+    assert validate_record(dialog(utterances(used_tweet=["1"])), 1, 6, 15) == []
+
+
+def test_malformed_records():
+    for record in MALFORMED:
+        issues = validate_record(record, 1, 6, 15)
+        assert [found["rule"] for found in issues] == ["invalid_record"], record
+    assert validate_record(MALFORMED[0], 1, 6, 15)[0]["turn"] == 0
+    assert validate_record(MALFORMED[3], 1, 6, 15)[0]["turn"] == 0
+
+
+def test_malformed_records_in_pool(tmp_path):
+    path = tmp_path / "corpus.jsonl"
+    records = [dialog(utterances())] + MALFORMED + [dialog(utterances(), "d1")]
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+    report = validate([path], 6, 15, jobs=2, chunk_size=64)
+    summary = report["files"][str(path)]
+    assert summary["dialogs"] == len(records)
+    assert summary["invalid_dialogs"] == len(MALFORMED)
+    assert sorted(found["line"] for found in report["issues"]) == list(range(2, len(MALFORMED) + 2))